@@ -1,2 +1,15 @@
 # bot/__init__.py
-from .bot import dp
+# Nothing is imported eagerly: bot.bot.create_dispatcher() builds the bot on demand
+import os
+import time
+
+# startup time is measured from the first import of the package
+IMPORTED_AT = time.perf_counter()
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cryptol.settings')
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
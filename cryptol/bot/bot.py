@@ -1,26 +1,63 @@
 # Imports: Python Standard Library
+import io
 import os
+import re
+import csv
 import decimal
-import requests
-import aiohttp
 import asyncio
+import logging
+import aiohttp
+import time
 # Setup Django
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cryptol.settings')
-import django
-django.setup()
+from bot import IMPORTED_AT, setup_django
+setup_django()
 # Imports: Third Party
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.utils.exceptions import MessageNotModified
+from aiohttp import web
 from asgiref.sync import sync_to_async
-
-from django.contrib.auth.models import User
-from portfolio.models import UserCoin, Portfolio, TelegramUser, CoinHistory
-
-API_TOKEN = ''
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+from django.conf import settings
+from django.db import connections
+
+from portfolio import repository
+from portfolio.models import UserCoin, TelegramUser, PriceAlert
+from portfolio.alerts import alert_index, load_new_alerts, mark_fired
+from portfolio.analytics import COST_METHODS, FIFO
+from portfolio.catalog import catalog, load_catalog, refresh_catalog
+from portfolio.coingecko import CoinGeckoError, client as coingecko
+from portfolio.feeds import PriceBus, make_feed
+from portfolio.fx import CURRENCY_SYMBOLS, currency_symbol, display_currencies, fx_rates
+from portfolio.jobs import CLEANUP, PRICE_LEASE, SNAPSHOTS, run_job
+from portfolio.leases import acquire_lease
+from portfolio.ledger import MAX_QUANTITY, MIN_QUANTITY, InsufficientQuantity, QuantityTooLarge
+from portfolio.metrics import metrics
+from portfolio.quotes import price_cache
+from portfolio.refresher import save_prices, stored_prices, tracked_coin_ids
+from portfolio.sender import SendQueue
+from portfolio.transfer import TradeImportError
+from portfolio.valuation import value_portfolio
+
+from bot.middleware import InstrumentationMiddleware, ThrottlingMiddleware
+from bot.storage import make_storage
+
+logger = logging.getLogger(__name__)
+
+# Built by create_dispatcher() rather than at import time
+bot = None
+dp = None
+# every outgoing message goes through the queue to stay under Telegram's limits
+sender = None
+# cache, history and alerts all follow the price feed through the bus
+price_bus = None
+# the price feed this worker runs while it is the leader
+feed = None
+feed_task = None
+# background tasks started by on_startup, cancelled by on_shutdown
+tasks = []
+# scheduled jobs the leader runs next to its loop, by job name
+job_tasks = {}
 
 class Form(StatesGroup):
     coin_id = State()
@@ -31,268 +68,587 @@ class SellForm(StatesGroup):
     coin_id = State()
     quantity = State()
 
-def get_user_coins(portfolio):
-    return list(UserCoin.objects.filter(portfolio=portfolio))
-
-@sync_to_async
-def async_get_user_coins(portfolio):
-    return get_user_coins(portfolio)
-
-@sync_to_async
-def get_or_create_user(user_id):
-    user, created = User.objects.get_or_create(username=user_id)
-    TelegramUser.objects.get_or_create(user=user, telegram_id=user_id)
-    return user, created
-
-def coin_exists(coin_id):
-    response = requests.get(f'https://api.coingecko.com/api/v3/coins/{coin_id}')
-    return response.status_code == 200
+async def coin_exists(coin_id):
+    if catalog:  # local catalog is loaded, no network call needed
+        return catalog.exists(coin_id)
+    return await coingecko.coin_exists(coin_id)
 
 async def get_current_price(coin_id):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://api.coingecko.com/api/v3/simple/price?ids={coin_id}&vs_currencies=usd") as response:
-            print(f"Response status: {response.status}")  # Debug line
-            print(f"Response content: {await response.text()}")  # Debug line
-            data = await response.json()
-            if coin_id in data:
-                return data[coin_id]['usd']
-            else:
-                raise ValueError(f"Бот не смог найти такую монету: {coin_id}")
-
-@sync_to_async
-def create_or_update_user_coin(portfolio, coin_id, new_price, new_quantity):
-    try:
-        user_coin = UserCoin.objects.get(portfolio=portfolio, coin_id=coin_id)
-        old_total_price = user_coin.price * user_coin.quantity
-        new_total_price = new_price * new_quantity
-        user_coin.quantity += new_quantity
-        user_coin.price = round((old_total_price + new_total_price) / user_coin.quantity, 2)
-        user_coin.save()
-    except UserCoin.DoesNotExist:
-        user_coin = UserCoin.objects.create(
-            portfolio=portfolio,
-            coin_id=coin_id,
-            price=new_price,
-            quantity=new_quantity
-        )
-    return user_coin
-
-@sync_to_async
-def save_price_history(user_coin, price):
-    CoinHistory.objects.create(user_coin=user_coin, price=price)
+    price = await price_cache.get(coin_id)
+    if price is None:
+        raise ValueError(f"Бот не смог найти такую монету: {coin_id}")
+    return price
 
-@sync_to_async
-def get_user(telegram_id):
-    try:
-        return TelegramUser.objects.get(telegram_id=telegram_id).user
-    except TelegramUser.DoesNotExist:
-        return None
-
-@sync_to_async
-def get_or_create_portfolio(user):
-    return Portfolio.objects.get_or_create(user=user)
-
-@sync_to_async
-def get_portfolio_data(user):
-    portfolio = Portfolio.objects.get(user=user)
-    user_coins = UserCoin.objects.filter(portfolio=portfolio)
-    data = []
-    for coin in user_coins:
-        coin_data = {
-            "coin_id": coin.coin_id,
-            "quantity": coin.quantity,
-            "price": coin.price
-        }
-        data.append(coin_data)
-    return data
-
-@sync_to_async
-def delete_all_user_coins(portfolio):
-    UserCoin.objects.filter(portfolio=portfolio).delete()
-
-@dp.callback_query_handler(lambda c: c.data == 'add')
 async def process_callback_add(callback_query: types.CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
-    await bot.send_message(callback_query.from_user.id, 'Пожалуйста используйте команду /add чтобы добавить монету в портфель.')
+    await sender.send(callback_query.from_user.id, 'Пожалуйста используйте команду /add чтобы добавить монету в портфель.')
 
 from asgiref.sync import sync_to_async
+
+def send_alerts(notifications):
+    # broadcasts wait behind interactive replies, the queue paces them
+    for telegram_id, coin_id, direction, threshold in notifications:
+        sender.broadcast(
+            telegram_id,
+            f"🔔 Цена {coin_id} {'поднялась выше' if direction == PriceAlert.ABOVE else 'опустилась ниже'} {threshold.normalize():f}",
+        )
+
+async def check_alerts(prices):
+    await sync_to_async(load_new_alerts)(alert_index)
+    fired = alert_index.match(prices)
+    if fired:
+        send_alerts(await sync_to_async(mark_fired)(fired))
+
+REFRESH_INTERVAL = 20
+# A worker that stops renewing the lease is replaced after this many seconds
+LEADER_LEASE_TTL = 3 * REFRESH_INTERVAL
+# held by the one bot worker that checks alerts and runs the price feed
+BOT_LEASE = 'bot-leader'
+
+async def cache_prices(prices):
+    price_cache.update(prices)
+
+async def record_prices(prices):
+    started = time.perf_counter()
+    rows = await sync_to_async(save_prices)(prices)
+    logger.info("prices updated coins=%d rows=%d seconds=%.3f", len(prices), rows, time.perf_counter() - started)
+
+def start_feed():
+    """The running price feed: started on first use, restarted if its task has ended."""
+    global feed, feed_task
+    if feed is None:
+        feed = make_feed(price_bus)
+    if feed_task is not None and feed_task.done():
+        # run() only returns by failing; without a feed prices, history and alerts stop
+        error = None if feed_task.cancelled() else feed_task.exception()
+        logger.error("price feed stopped, restarting error=%r", error)
+        feed_task = None
+    if feed_task is None:
+        feed_task = asyncio.create_task(feed.run())
+    return feed
+
+async def stop_feed():
+    global feed, feed_task
+    if feed_task is not None:
+        feed_task.cancel()
+        await asyncio.gather(feed_task, return_exceptions=True)
+    feed = feed_task = None
+
+def start_jobs(jobs):
+    """Run each job in a task of its own, unless its previous run is still going.
+
+    A long job awaited in the leader loop would hold up the lease renewals.
+    """
+    for job in jobs:
+        task = job_tasks.get(job.name)
+        if task is None or task.done():
+            job_tasks[job.name] = asyncio.create_task(run_job(job))
+
+async def check_stored_prices(since):
+    """Alerts and the cache follow the prices `runjobs` stored since `since`; returns the new mark."""
+    prices, since = await sync_to_async(stored_prices)(since)
+    if prices:
+        await cache_prices(prices)
+        await check_alerts(prices)
+    return since
+
 async def update_coin_prices_async():
+    stored_since = None
     while True:
         try:
-            coins = await sync_to_async(UserCoin.objects.all)()
-            for coin in coins:
-                coin_id = await sync_to_async(getattr)(coin, 'coin_id')
-                new_price = await get_current_price(coin_id)
-                await sync_to_async(setattr)(coin, 'price', new_price)  # обновляем текущую цену
-                await sync_to_async(coin.save)()
-        except Exception as e:
-            print(f"Cannot update coin prices due to error: {e}")
-        else:
-            print("Prices updated")
-        await asyncio.sleep(20)  # ждем 20 секунд
-
-loop = asyncio.get_event_loop()
+            # one bot worker leads: it checks alerts, runs the jobs and fetches prices
+            if not await sync_to_async(acquire_lease)(BOT_LEASE, ttl=LEADER_LEASE_TTL):
+                await stop_feed()
+            # it fetches them itself unless `runjobs` holds the price lease
+            elif await sync_to_async(acquire_lease)(PRICE_LEASE, ttl=LEADER_LEASE_TTL):
+                coin_ids = await sync_to_async(tracked_coin_ids)()
+                start_feed().set_coins(coin_ids)
+                stored_since = None
+                # all display currencies in one request, so /portfolio converts from the cache
+                await fx_rates.refresh(await sync_to_async(display_currencies)())
+                # claimed through the same slots as `manage.py runjobs`, so they run once either way
+                start_jobs([SNAPSHOTS, CLEANUP])
+            else:
+                await stop_feed()
+                # the `prices` job stores prices but cannot send alerts, they are checked here
+                stored_since = await check_stored_prices(stored_since)
+        except Exception:
+            logger.exception("cannot update coin prices")
+        await asyncio.sleep(REFRESH_INTERVAL)  # ждем 20 секунд
+
+CATALOG_REFRESH_INTERVAL = 6 * 60 * 60
+# an empty catalog is looked for again this often: the leader may still be downloading it
+CATALOG_RETRY_INTERVAL = 30
+
+async def update_catalog_async():
+    loaded = await load_catalog()
+    if loaded:
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL)  # loaded from the database, refresh later
+    while True:
+        try:
+            # the leader downloads the coin list, other workers reload it from the database
+            if await sync_to_async(acquire_lease)('catalog-refresher', ttl=2 * CATALOG_REFRESH_INTERVAL):
+                created, updated, deleted = await refresh_catalog()
+                logger.info("coin catalog updated created=%d updated=%d deleted=%d", created, updated, deleted)
+                loaded = True
+            else:
+                loaded = await load_catalog()
+        except Exception:
+            logger.exception("cannot update coin catalog")
+        await asyncio.sleep(CATALOG_REFRESH_INTERVAL if loaded else CATALOG_RETRY_INTERVAL)
 
-@dp.message_handler(commands=['start'])
 async def start(message: types.Message):
     user_id = message.from_user.id
-    user, created = await get_or_create_user(user_id)
+    created = await repository.register(user_id)
 
     if created:
-        await bot.send_message(user_id, "Добро пожаловать! Вы зарегистрированы.")
+        await sender.send(user_id, "Добро пожаловать! Вы зарегистрированы.")
     else:
-        await bot.send_message(user_id, "Добро пожаловать обратно!")
+        await sender.send(user_id, "Добро пожаловать обратно!")
 
-@dp.message_handler(commands=['add'])
 async def cmd_add(message: types.Message, state: FSMContext):
     try:
         coin_id = message.text.split(" ")[1]
     except IndexError:
-        await bot.send_message(message.chat.id, "Пожалуйста, укажите название монеты. Например, `/add bitcoin`.")
+        await sender.send(message.chat.id, "Пожалуйста, укажите название монеты. Например, `/add bitcoin`.")
         return
 
-    if not coin_exists(coin_id):
-        await bot.send_message(message.chat.id, f"Произошла ошибка: Монета с таким именем {coin_id} не найдена. Пожалуйста, убедитесь, что вы ввели имя монеты правильно.")
+    if not await coin_exists(coin_id):
+        reply = f"Произошла ошибка: Монета с таким именем {coin_id} не найдена. Пожалуйста, убедитесь, что вы ввели имя монеты правильно."
+        suggestions = catalog.suggest(coin_id)
+        if suggestions:
+            reply += "\nВозможно, вы имели в виду: " + ", ".join(suggestions)
+        await sender.send(message.chat.id, reply)
         return
 
     price = await get_current_price(coin_id)
 
     await state.update_data(coin_id=coin_id, price=price)  # save coin_id and price to state
     await Form.quantity.set()
-    await bot.send_message(message.chat.id, f"Сколько монет вы хотите добавить?")
+    await sender.send(message.chat.id, f"Сколько монет вы хотите добавить?")
 
-@dp.message_handler(commands=['sell'])
 async def cmd_sell(message: types.Message, state: FSMContext):
     try:
         coin_id = message.text.split(" ")[1]
     except IndexError:
-        await bot.send_message(message.chat.id, "Пожалуйста, укажите название монеты. Например, `/sell bitcoin`.")
+        await sender.send(message.chat.id, "Пожалуйста, укажите название монеты. Например, `/sell bitcoin`.")
         return
 
     await state.update_data(coin_id=coin_id)  # save coin_id to state
     await SellForm.quantity.set()
-    await bot.send_message(message.chat.id, f"Сколько монет вы хотите продать?")
+    await sender.send(message.chat.id, f"Сколько монет вы хотите продать?")
+
+def parse_quantity(text):
+    """A quantity the ledger can store, or None for anything else (nan and infinity included)."""
+    try:
+        quantity = decimal.Decimal((text or '').strip())
+    except decimal.InvalidOperation:
+        return None
+    if not quantity.is_finite() or not MIN_QUANTITY <= quantity < MAX_QUANTITY:
+        return None
+    return quantity
 
-@dp.message_handler(state=SellForm.quantity)
 async def process_sell_quantity(message: types.Message, state: FSMContext):
     async with state.proxy() as data:
         coin_id = data['coin_id']
-        quantity_to_sell = message.text
+        quantity_to_sell = parse_quantity(message.text)
+        if quantity_to_sell is None:
+            await sender.send(message.chat.id, f"Неправильный ввод. Введите действительное число.")
+            return
 
         try:
-            quantity_to_sell = Decimal(quantity_to_sell)
-        except decimal.InvalidOperation:
-            await bot.send_message(message.chat.id, f"Неправильный ввод. Введите действительное число.")
-            return
+            sell_price = await price_cache.get(coin_id)
+        except (CoinGeckoError, aiohttp.ClientError, asyncio.TimeoutError):
+            sell_price = None  # the sale is still recorded, only without a price
 
-        user = await get_user(message.from_user.id)
-        portfolio, _ = await get_or_create_portfolio(user)
-        user_coins = await async_get_user_coins(portfolio)
-
-        for user_coin in user_coins:
-            if await sync_to_async(getattr)(user_coin, 'coin_id') == coin_id:
-                user_coin_quantity = await sync_to_async(getattr)(user_coin, 'quantity')
-                user_coin_quantity = Decimal(user_coin_quantity)
-                if user_coin_quantity < quantity_to_sell:
-                    await bot.send_message(message.chat.id, "У вас недостаточно монет для продажи.")
-                else:
-                    await sync_to_async(setattr)(user_coin, 'quantity', str(user_coin_quantity - quantity_to_sell))
-                    await sync_to_async(user_coin.save)()
-                    await bot.send_message(message.chat.id, f"Вы продали {quantity_to_sell} монет {coin_id}")
-                break
+        try:
+            await repository.sell(message.from_user.id, coin_id, quantity_to_sell, sell_price)
+        except TelegramUser.DoesNotExist:
+            await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        except UserCoin.DoesNotExist:
+            await sender.send(message.chat.id, "У вас нет такой монеты в вашем портфеле.")
+        except InsufficientQuantity:
+            await sender.send(message.chat.id, "У вас недостаточно монет для продажи.")
         else:
-            await bot.send_message(message.chat.id, "У вас нет такой монеты в вашем портфеле.")
+            await sender.send(message.chat.id, f"Вы продали {quantity_to_sell} монет {coin_id}")
 
     await state.finish()
 
-@dp.message_handler(state=Form.coin_id)
 async def process_coin_id(message: types.Message, state: FSMContext):
     async with state.proxy() as data:
         data['coin_id'] = message.text
         data['price'] = await get_current_price(message.text)
     await Form.next()
 
-@dp.message_handler(state=Form.quantity)
 async def process_quantity(message: types.Message, state: FSMContext):
     async with state.proxy() as data:
-        new_quantity = Decimal(message.text)
-        telegram_user = await sync_to_async(TelegramUser.objects.get)(telegram_id=message.from_user.id)
+        new_quantity = parse_quantity(message.text)
+        if new_quantity is None:
+            await sender.send(message.chat.id, f"Неправильный ввод. Введите действительное число.")
+            return
+        new_price = data['price']
+        try:
+            await repository.buy(message.from_user.id, data['coin_id'], new_price, new_quantity)
+        except TelegramUser.DoesNotExist:
+            await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        except QuantityTooLarge:
+            await sender.send(
+                message.chat.id,
+                f"Слишком много монет: в портфеле может быть не больше {MAX_QUANTITY - MIN_QUANTITY:f} монет {data['coin_id']}.",
+            )
+        else:
+            await sender.send(
+                message.chat.id,
+                f"Монета {data['coin_id']} добавлена по цене {new_price} в количестве {new_quantity}"
+            )
+    await state.finish()
+
+from decimal import Decimal
+
+PAGE_SIZE = 10
+
+def page_count(valuation):
+    return max(1, -(-len(valuation.coins) // PAGE_SIZE))
+
+def render_portfolio(valuation, symbol='$', page=0):
+    # only the coins of one page are rendered, the totals come from the valuation
+    pages = page_count(valuation)
+    header = "📊 *Ваш портфель:*\n\n" if pages == 1 else f"📊 *Ваш портфель* (стр. {page + 1}/{pages}):\n\n"
+    parts = [header]
+    for coin in valuation.coins[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        parts.append(
+            f"🪙 *Монета*: `{coin.coin_id}`\n"
+            f"💰 *Количество*: `{coin.quantity}`\n"
+            f"📉 *Средняя цена покупки*: `{symbol}{coin.average_price}`\n"
+            f"📈 *Текущая стоимость*: `{symbol}{coin.current_price}`\n"
+            f"💸 *Общая стоимость*: `{symbol}{coin.value}`\n"
+            f"🔀 *Изменение цены*: `{coin.pnl_percent}%` (`{symbol}{coin.pnl}`)\n\n"
+        )
+    parts.append(f"\n💼 *Общая стоимость портфеля*: `{symbol}{valuation.value}`")
+    parts.append(f"\n⚖️ *Изменение общей стоимости портфеля*: `{valuation.pnl_percent}%` (`{symbol}{valuation.pnl}`)")
+    return "".join(parts)
 
-        user = await sync_to_async(getattr)(telegram_user, 'user')
+def portfolio_keyboard(page, pages, snapshot=None):
+    if pages == 1:
+        return None
+    # the snapshot the first page came from travels with the buttons, so every page shows the same one
+    suffix = ''.join(f':{part}' for part in snapshot or ())
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton('◀️', callback_data=f'portfolio:{page - 1}{suffix}'))
+    buttons.append(types.InlineKeyboardButton(f'{page + 1}/{pages}', callback_data=f'portfolio:{page}{suffix}'))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton('▶️', callback_data=f'portfolio:{page + 1}{suffix}'))
+    return types.InlineKeyboardMarkup().row(*buttons)
+
+async def load_valuation(telegram_id):
+    """(currency, valuation, warnings, snapshot): the cached valuation, or a fresh one that is cached.
+
+    `snapshot` is the (version, stamp, currency) the valuation is cached under.
+    """
+    view = await repository.load_portfolio(telegram_id)
+    currency, valuation = view.account.currency, view.valuation
+    warnings = []
+    if valuation is None:
+        prices = await price_cache.get_many(holding.coin_id for holding in view.holdings)
+        # a currency no longer offered (btc, eth) is shown in USD
+        rate = await fx_rates.rate(currency) if currency in CURRENCY_SYMBOLS else None
+        if rate is None:
+            warnings.append(f"Нет курса для валюты {currency.upper()}, стоимость показана в USD.")
+            currency, rate = 'usd', 1
+        valuation = value_portfolio(view.holdings, prices, rate)
+        await repository.store_valuation(view, currency, valuation)
+    return currency, valuation, warnings, (view.account.version, view.stamp, currency)
 
-        portfolio, created = await sync_to_async(Portfolio.objects.get_or_create)(user=user)
+async def cmd_portfolio(message: types.Message):
+    try:
+        currency, valuation, warnings, snapshot = await load_valuation(message.from_user.id)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
 
-        new_price = data['price']  # remove await here
-        user_coin = await create_or_update_user_coin(
-            portfolio=portfolio,
-            coin_id=data['coin_id'],
-            new_price=new_price,
-            new_quantity=new_quantity
+    for warning in warnings:
+        await sender.send(message.chat.id, warning)
+    for coin_id in valuation.missing_quantity:
+        await sender.send(message.chat.id, f"У монеты {coin_id} не определено количество.")
+    for coin_id in valuation.missing_price:
+        await sender.send(message.chat.id, f"Бот не смог найти такую монету: {coin_id}")
+    await sender.send(
+        message.chat.id,
+        render_portfolio(valuation, currency_symbol(currency)),
+        parse_mode='Markdown',
+        reply_markup=portfolio_keyboard(0, page_count(valuation), snapshot),
+    )
+
+PORTFOLIO_CALLBACK = re.compile(r'portfolio:(\d+)(?::(\d+):(\d+):([a-z]+))?')
+
+async def process_callback_portfolio(callback_query: types.CallbackQuery):
+    await bot.answer_callback_query(callback_query.id)
+    page, version, stamp, currency = PORTFOLIO_CALLBACK.fullmatch(callback_query.data).groups()
+    telegram_id = callback_query.from_user.id
+    try:
+        valuation = None
+        if version:
+            # the first page's valuation: one lookup, however many coins the portfolio holds
+            valuation = await repository.load_snapshot(telegram_id, int(version), int(stamp), currency)
+        if valuation is not None:
+            snapshot = (version, stamp, currency)
+        else:
+            # holdings changed or the snapshot expired, start over from the current one
+            currency, valuation, _, snapshot = await load_valuation(telegram_id)
+    except TelegramUser.DoesNotExist:
+        return
+    # the portfolio may have shrunk since the keyboard was sent
+    pages = page_count(valuation)
+    page = min(int(page), pages - 1)
+    try:
+        await sender.edit_text(
+            callback_query.message.chat.id,
+            callback_query.message.message_id,
+            render_portfolio(valuation, currency_symbol(currency), page),
+            parse_mode='Markdown',
+            reply_markup=portfolio_keyboard(page, pages, snapshot),
         )
-        await sync_to_async(CoinHistory.objects.create)(user_coin=user_coin, price=new_price)  # and here
-        await bot.send_message(
+    except MessageNotModified:
+        pass  # the current page was pressed
+
+async def cmd_currency(message: types.Message):
+    currency = message.get_args().strip().lower()
+    if currency not in CURRENCY_SYMBOLS:
+        await sender.send(
             message.chat.id,
-            f"Монета {data['coin_id']} добавлена по цене {new_price} в количестве {new_quantity}"
+            "Пожалуйста, укажите валюту. Например, `/currency eur`.\n"
+            "Доступные валюты: " + ", ".join(sorted(CURRENCY_SYMBOLS)),
         )
-    await state.finish()
+        return
+    try:
+        await repository.set_currency(message.from_user.id, currency)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    await sender.send(message.chat.id, f"Портфель теперь показывается в {currency.upper()}.")
 
-from decimal import Decimal, ROUND_DOWN
+HISTORY_DAYS = 30
+
+async def cmd_history(message: types.Message):
+    try:
+        history = await repository.history(message.from_user.id, HISTORY_DAYS)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    if not history['series']:
+        await sender.send(message.chat.id, "История портфеля пока пуста, загляните позже.")
+        return
+
+    first = history['series'][0]
+    parts = [
+        f"📜 *История портфеля за {HISTORY_DAYS} дней:*\n\n",
+        f"💼 *Стоимость*: `${first['value']}` → `${history['series'][-1]['value']}`\n",
+        f"⚖️ *Прибыль за все время*: `{history['pnl_percent']}%` (`${history['pnl']}`)\n",
+    ]
+    if history['best']:
+        parts.append(f"🚀 *Самый прибыльный актив*: `{history['best']['coin_id']}` (`${history['best']['pnl']}`)\n")
+        parts.append(f"🔻 *Самый убыточный актив*: `{history['worst']['coin_id']}` (`${history['worst']['pnl']}`)\n")
+    await sender.send(message.chat.id, "".join(parts), parse_mode='Markdown')
+
+def render_pnl(analytics):
+    pnl, risk = analytics.pnl, analytics.risk
+    parts = [
+        f"📈 *Прибыль и убыток* (метод {pnl.method.upper()}):\n\n",
+        f"✅ *Реализованная*: `${pnl.realized}`\n",
+        f"⏳ *Нереализованная*: `${pnl.unrealized}`\n",
+    ]
+    if risk.portfolio_volatility is not None:
+        parts.append(f"🎢 *Волатильность за год*: `{risk.portfolio_volatility:.2%}`\n")
+        parts.append(f"🕳 *Максимальная просадка*: `{risk.portfolio_drawdown:.2%}`\n")
+    if pnl.missing_price:
+        missing = ", ".join(f"`{coin_id}`" for coin_id in pnl.missing_price[:PAGE_SIZE])
+        parts.append(f"\nБез цены, не учтены: {missing}{' …' if len(pnl.missing_price) > PAGE_SIZE else ''}\n")
+    if pnl.unpriced:
+        unpriced = ", ".join(f"`{coin_id}`" for coin_id in pnl.unpriced[:PAGE_SIZE])
+        parts.append(
+            f"\nПроданы или удалены без цены, их прибыль не учтена: {unpriced}"
+            f"{' …' if len(pnl.unpriced) > PAGE_SIZE else ''}\n"
+        )
+    return "".join(parts)
+
+async def cmd_pnl(message: types.Message):
+    method = message.get_args().strip().lower() or FIFO
+    if method not in COST_METHODS:
+        await sender.send(message.chat.id, "Пожалуйста, укажите метод учета: `/pnl fifo`, `/pnl lifo` или `/pnl average`.")
+        return
+    try:
+        analytics = await repository.analytics(message.from_user.id, method)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    await sender.send(message.chat.id, render_pnl(analytics), parse_mode='Markdown')
+
+ALERT_PATTERN = re.compile(r'^/alert(?:@\w+)?\s+(\S+)\s*([<>])\s*(\d+(?:[.,]\d+)?)\s*$')
+
+async def cmd_alert(message: types.Message):
+    match = ALERT_PATTERN.match(message.text)
+    if not match:
+        await sender.send(message.chat.id, "Пожалуйста, укажите монету и цену. Например, `/alert bitcoin > 70000`.")
+        return
+    coin_id, sign, threshold = match.groups()
+    if not await coin_exists(coin_id):
+        await sender.send(message.chat.id, f"Произошла ошибка: Монета с таким именем {coin_id} не найдена.")
+        return
+
+    direction = PriceAlert.ABOVE if sign == '>' else PriceAlert.BELOW
+    try:
+        await repository.add_alert(message.from_user.id, coin_id, direction, Decimal(threshold.replace(',', '.')))
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    await sender.send(message.chat.id, f"Уведомление создано: {coin_id} {sign} {threshold}")
+
+IMPORT_FORMATS = {'.csv': 'csv', '.json': 'json'}
+IMPORT_MAX_SIZE = 5 * 1024 * 1024
+
+async def process_import(message: types.Message):
+    document = message.document
+    fmt = IMPORT_FORMATS.get(os.path.splitext(document.file_name or '')[1].lower())
+    if fmt is None:
+        await sender.send(
+            message.chat.id,
+            "Пришлите файл .csv или .json со столбцами coin_id, side, quantity, price, date.",
+        )
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_SIZE:
+        await sender.send(message.chat.id, "Файл слишком большой, максимум 5 МБ.")
+        return
+
+    # aiogram writes into an io.IOBase only; anything else is taken for a path
+    with io.BytesIO() as file:
+        await document.download(destination=file)
+        try:
+            # the in-memory catalog when it is loaded, the CatalogCoin table otherwise
+            result = await repository.import_file(message.from_user.id, file, fmt, catalog.exists if catalog else None)
+        except TelegramUser.DoesNotExist:
+            await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+            return
+        except TradeImportError as e:
+            lines = "\n".join(f"Запись {line}: {error}" for line, error in e.errors)
+            await sender.send(message.chat.id, f"Файл не импортирован, ничего не изменено:\n{lines}")
+            return
+        except (ValueError, csv.Error) as e:
+            await sender.send(message.chat.id, f"Не удалось прочитать файл: {e}")
+            return
+    await sender.send(
+        message.chat.id,
+        f"Импортировано сделок: {result.trades}, монет: {result.coins} (новых: {result.created}).",
+    )
+
+async def cmd_export(message: types.Message):
+    fmt = message.get_args().strip().lower() or 'csv'
+    if fmt not in IMPORT_FORMATS.values():
+        await sender.send(message.chat.id, "Пожалуйста, укажите формат. Например, `/export csv` или `/export json`.")
+        return
+    try:
+        file = await repository.export_file(message.from_user.id, fmt)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    with file:
+        await sender.send_document(message.chat.id, types.InputFile(file, filename=f'portfolio.{fmt}'))
 
-@dp.message_handler(commands=['portfolio'])
-async def cmd_portfolio(message: types.Message):
-    telegram_id = message.from_user.id
-    user = await get_user(telegram_id)
-    portfolio, _ = await get_or_create_portfolio(user)
-    user_coins = await async_get_user_coins(portfolio)
-    total_portfolio_value = Decimal(0)
-    total_portfolio_cost = Decimal(0)
-
-    reply = "📊 *Ваш портфель:*\n\n"
-    for user_coin in user_coins:
-        coin_id = await sync_to_async(getattr)(user_coin, 'coin_id')
-        quantity = await sync_to_async(getattr)(user_coin, 'quantity')
-        if quantity is None:
-            await bot.send_message(message.chat.id, f"У монеты {coin_id} не определено количество.")
-            continue
-        quantity = Decimal(quantity).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        current_price = Decimal(await get_current_price(coin_id)).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        total_coin_value = (quantity * current_price).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        average_price = Decimal(await sync_to_async(getattr)(user_coin, 'price')).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        total_coin_cost = (average_price * quantity).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-
-        # Calculate change in price
-        price_change = (current_price - average_price).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        price_change_percent = ((price_change / average_price) * 100 if average_price != 0 else 0).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-        price_change_usd = (price_change * quantity).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-
-        total_portfolio_value += total_coin_value
-        total_portfolio_cost += total_coin_cost
-        reply += f"🪙 *Монета*: `{coin_id}`\n" \
-                 f"💰 *Количество*: `{quantity}`\n" \
-                 f"📉 *Средняя цена покупки*: `${average_price}`\n" \
-                 f"📈 *Текущая стоимость*: `${current_price}`\n" \
-                 f"💸 *Общая стоимость*: `${total_coin_value}`\n" \
-                 f"🔀 *Изменение цены*: `{price_change_percent}%` (`${price_change_usd}`)\n\n"
-
-    total_portfolio_change_percent = (((total_portfolio_value - total_portfolio_cost) / total_portfolio_cost) * 100 if total_portfolio_cost != 0 else 0).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-    total_portfolio_change_usd = (total_portfolio_value - total_portfolio_cost).quantize(Decimal('0.00'), rounding=ROUND_DOWN)
-
-    reply += f"\n💼 *Общая стоимость портфеля*: `${total_portfolio_value}`"
-    reply += f"\n⚖️ *Изменение общей стоимости портфеля*: `{total_portfolio_change_percent}%` (`${total_portfolio_change_usd}`)"
-
-    await bot.send_message(message.chat.id, reply, parse_mode='Markdown')
-
-@dp.message_handler(commands=['clear'])
 async def cmd_clear(message: types.Message):
-    telegram_id = message.from_user.id
-    user = await get_user(telegram_id)
-    portfolio, _ = await get_or_create_portfolio(user)
-    await delete_all_user_coins(portfolio)
-    await bot.send_message(message.chat.id, "Все монеты в вашем портфеле были удалены.")
+    try:
+        await repository.clear(message.from_user.id)
+    except TelegramUser.DoesNotExist:
+        await sender.send(message.chat.id, "Сначала зарегистрируйтесь командой /start.")
+        return
+    await sender.send(message.chat.id, "Все монеты в вашем портфеле были удалены.")
+
+def register_handlers(dp):
+    dp.register_callback_query_handler(process_callback_add, lambda c: c.data == 'add')
+    dp.register_callback_query_handler(process_callback_portfolio, lambda c: PORTFOLIO_CALLBACK.fullmatch(c.data or ''))
+    dp.register_message_handler(start, commands=['start'])
+    dp.register_message_handler(cmd_add, commands=['add'])
+    dp.register_message_handler(cmd_sell, commands=['sell'])
+    dp.register_message_handler(process_sell_quantity, state=SellForm.quantity)
+    dp.register_message_handler(process_coin_id, state=Form.coin_id)
+    dp.register_message_handler(process_quantity, state=Form.quantity)
+    dp.register_message_handler(cmd_portfolio, commands=['portfolio'])
+    dp.register_message_handler(cmd_currency, commands=['currency'])
+    dp.register_message_handler(cmd_history, commands=['history'])
+    dp.register_message_handler(cmd_pnl, commands=['pnl'])
+    dp.register_message_handler(cmd_alert, commands=['alert'])
+    dp.register_message_handler(process_import, content_types=types.ContentType.DOCUMENT)
+    dp.register_message_handler(cmd_export, commands=['export'])
+    dp.register_message_handler(cmd_clear, commands=['clear'])
+
+def create_dispatcher(token=None, storage=None):
+    """Build the bot, its dispatcher, send queue and price bus and register the handlers."""
+    global bot, dp, sender, price_bus
+    started = time.perf_counter()
+    bot = Bot(token=token or os.environ.get('BOT_TOKEN', ''))
+    dp = Dispatcher(bot, storage=storage or make_storage())
+    sender = SendQueue(bot)
+    price_bus = PriceBus()
+    dp.middleware.setup(InstrumentationMiddleware())
+    # "please wait" replies are queued without waiting for them to be sent
+    dp.middleware.setup(ThrottlingMiddleware(
+        lambda chat_id, text: sender.send(chat_id, text),
+        rate=settings.BOT_THROTTLE_RATE,
+        burst=settings.BOT_THROTTLE_BURST,
+        max_in_flight=settings.BOT_MAX_IN_FLIGHT,
+    ))
+    register_handlers(dp)
+    metrics.collect('bot_send_queue_depth', lambda: {(('lane', lane),): depth for lane, depth in sender.depth().items()})
+    metrics.collect('bot_messages_total', lambda: {(('result', key),): value for key, value in sender.stats.items()}, 'counter')
+    logger.info("dispatcher created seconds=%.3f", time.perf_counter() - started)
+    return dp
+
+async def metrics_view(request):
+    # handler, send queue and CoinGecko metrics live in the bot process, so it serves its own
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+async def serve_metrics(port, host='0.0.0.0'):
+    """Serve /metrics on `port` for a polling bot, which has no web app of its own."""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
 
 async def on_startup(dp):
-    asyncio.create_task(update_coin_prices_async())
+    sender.start()
+    price_bus.subscribe(cache_prices)
+    price_bus.subscribe(record_prices)
+    price_bus.subscribe(check_alerts)
+    tasks.append(asyncio.create_task(update_coin_prices_async()))
+    tasks.append(asyncio.create_task(update_catalog_async()))
+    # time from importing the package until the bot is ready for updates
+    logger.info("bot started seconds=%.3f", time.perf_counter() - IMPORTED_AT)
+
+async def on_shutdown(dp):
+    for task in [*tasks, *job_tasks.values()]:
+        task.cancel()
+    await asyncio.gather(*tasks, *job_tasks.values(), return_exceptions=True)
+    tasks.clear()
+    job_tasks.clear()
+    # the feed and the bus consumers outlive the leader loop that started them;
+    # stopped before the CoinGecko client closes, so nothing reopens its session
+    await stop_feed()
+    await price_bus.close()
+    await sender.close()
+    await coingecko.close()
+    await sync_to_async(connections.close_all)()
+
+async def on_polling_startup(dp):
+    if settings.BOT_METRICS_PORT:
+        dp['metrics_server'] = await serve_metrics(settings.BOT_METRICS_PORT)
+    await on_startup(dp)
+
+async def on_polling_shutdown(dp):
+    await on_shutdown(dp)
+    if 'metrics_server' in dp.data:
+        await dp['metrics_server'].cleanup()
 
 if __name__ == '__main__':
     from aiogram import executor
-    executor.start_polling(dp, on_startup=on_startup)
+    executor.start_polling(create_dispatcher(), on_startup=on_polling_startup, on_shutdown=on_polling_shutdown)
@@ -0,0 +1,133 @@
+import contextvars
+import logging
+import time
+
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from portfolio.metrics import QueryCount, current_queries, metrics
+from portfolio.sender import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Name of the handler that took the update being processed
+current_handler_name = contextvars.ContextVar('current_handler_name', default='unhandled')
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """Latency and query count of every update, labelled by the handler that took it."""
+
+    async def on_pre_process_update(self, update, data):
+        data['instrumentation'] = (
+            time.perf_counter(),
+            current_queries.set(QueryCount()),
+            current_handler_name.set('unhandled'),
+        )
+
+    async def on_process_message(self, message, data):
+        current_handler_name.set(current_handler.get().__name__)
+
+    async def on_process_callback_query(self, callback_query, data):
+        current_handler_name.set(current_handler.get().__name__)
+
+    async def on_post_process_update(self, update, results, data):
+        started, queries_token, handler_token = data.pop('instrumentation')
+        elapsed = time.perf_counter() - started
+        handler = current_handler_name.get()
+        queries = current_queries.get().count
+        current_queries.reset(queries_token)
+        current_handler_name.reset(handler_token)
+        metrics.inc('bot_updates_total', handler=handler)
+        metrics.inc('bot_update_queries_total', queries, handler=handler)
+        metrics.observe('bot_update_seconds', elapsed, handler=handler)
+        logger.debug("update handled handler=%s seconds=%.4f queries=%d", handler, elapsed, queries)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Keeps one user from starving the others on the event loop.
+
+    Every user gets a token bucket per command (plain messages such as the
+    answers to /add share one). A command sent again while the same command
+    from the same chat is still being handled is dropped: the reply of the
+    first one answers both. Above `max_in_flight` updates being handled at
+    once new ones are turned away. Turned away users get a short "please
+    wait" through `reply(chat_id, text)`, once per throttled stretch; a
+    callback query is answered with it instead.
+    """
+
+    def __init__(self, reply, rate=1, burst=3, max_in_flight=100, clock=time.monotonic):
+        super().__init__()
+        self.reply = reply
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self._clock = clock
+        self._buckets = {}  # (user_id, command) -> TokenBucket
+        self._warned = set()  # bucket keys already told to wait
+        self._in_flight = set()  # (chat_id, command text) being handled
+        self.active = 0
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.idle}
+                self._warned &= set(self._buckets)
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, self._clock)
+        return bucket
+
+    async def _admit(self, chat_id, user_id, command, duplicate_key, data, reject):
+        if self.active >= self.max_in_flight:
+            metrics.inc('bot_throttled_total', reason='overload')
+            await reject("⏳ Бот сейчас перегружен, попробуйте через несколько секунд.")
+            raise CancelHandler()
+        if duplicate_key is not None and duplicate_key in self._in_flight:
+            metrics.inc('bot_throttled_total', reason='coalesced')
+            await reject(None)
+            raise CancelHandler()
+        key = (user_id, command)
+        bucket = self._bucket(key)
+        if bucket.wait_time() > 0:
+            metrics.inc('bot_throttled_total', reason='rate')
+            if key not in self._warned:
+                self._warned.add(key)
+                await reject("⏳ Слишком много запросов, подождите немного.")
+            raise CancelHandler()
+        bucket.consume()
+        self._warned.discard(key)
+        self.active += 1
+        if duplicate_key is not None:
+            self._in_flight.add(duplicate_key)
+        data['throttling'] = duplicate_key
+
+    def _release(self, data):
+        if 'throttling' in data:
+            self.active -= 1
+            self._in_flight.discard(data.pop('throttling'))
+
+    async def on_process_message(self, message, data):
+        command = message.get_command(pure=True)
+        duplicate_key = (message.chat.id, message.text) if command else None
+
+        async def reject(text):
+            if text is not None:
+                self.reply(message.chat.id, text)
+
+        await self._admit(message.chat.id, message.from_user.id, command or '', duplicate_key, data, reject)
+
+    async def on_post_process_message(self, message, results, data):
+        self._release(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        chat_id = callback_query.message.chat.id if callback_query.message else callback_query.from_user.id
+        command = (callback_query.data or '').split(':')[0]
+
+        async def reject(text):
+            await callback_query.answer(text)  # also stops the spinner of a dropped duplicate
+
+        await self._admit(
+            chat_id, callback_query.from_user.id, f'callback:{command}', (chat_id, callback_query.data), data, reject,
+        )
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._release(data)
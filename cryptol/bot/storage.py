@@ -0,0 +1,101 @@
+import copy
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+from portfolio.models import BotState
+
+KEEP = object()
+
+
+def read_state(chat, user):
+    row = BotState.objects.filter(chat=chat, user=user).values_list('state', 'data', 'bucket').first()
+    return row or (None, {}, {})
+
+
+def write_state(chat, user, state=KEEP, data=KEEP, bucket=KEEP, merge=False):
+    """Change one conversation in a single transaction; empty conversations are deleted."""
+    with transaction.atomic():
+        row = BotState.objects.select_for_update().filter(chat=chat, user=user).first()
+        if row is None:
+            row = BotState(chat=chat, user=user, data={}, bucket={})
+        if state is not KEEP:
+            row.state = state
+        if data is not KEEP:
+            row.data = {**row.data, **data} if merge else data
+        if bucket is not KEEP:
+            row.bucket = {**row.bucket, **bucket} if merge else bucket
+        if row.state is None and not row.data and not row.bucket:
+            if row.pk is not None:
+                row.delete()
+        else:
+            row.save()
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM storage kept in the Django database.
+
+    Every bot worker sees the same conversations, and an /add or /sell in
+    progress survives a restart. Each call is one thread hop to the database.
+    """
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def address(self, chat, user):
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state, _, _ = await sync_to_async(read_state)(*self.address(chat, user))
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, data, _ = await sync_to_async(read_state)(*self.address(chat, user))
+        return copy.deepcopy(data) if data else copy.deepcopy(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await sync_to_async(write_state)(*self.address(chat, user), state=self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await sync_to_async(write_state)(*self.address(chat, user), data=data or {})
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await sync_to_async(write_state)(*self.address(chat, user), data={**(data or {}), **kwargs}, merge=True)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        changes = {'state': None, 'data': {}} if with_data else {'state': None}
+        await sync_to_async(write_state)(*self.address(chat, user), **changes)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, _, bucket = await sync_to_async(read_state)(*self.address(chat, user))
+        return copy.deepcopy(bucket) if bucket else copy.deepcopy(default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await sync_to_async(write_state)(*self.address(chat, user), bucket=bucket or {})
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await sync_to_async(write_state)(*self.address(chat, user), bucket={**(bucket or {}), **kwargs}, merge=True)
+
+
+def make_storage(kind=None):
+    """FSM storage selected by settings.BOT_FSM_STORAGE: 'database', 'redis' or 'memory'."""
+    kind = kind or settings.BOT_FSM_STORAGE
+    if kind == 'database':
+        return DatabaseStorage()
+    if kind == 'redis':
+        # needs aioredis, which is only installed where Redis is used
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        return RedisStorage2(**settings.BOT_REDIS)
+    if kind == 'memory':
+        return MemoryStorage()
+    raise ImproperlyConfigured(f"Unknown BOT_FSM_STORAGE: {kind!r}")
@@ -0,0 +1,485 @@
+import asyncio
+import io
+import itertools
+import subprocess
+import sys
+from decimal import Decimal
+from unittest import mock
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from portfolio.alerts import AlertIndex
+from portfolio.analytics import PortfolioPnl, RiskMetrics
+from portfolio.jobs import PRICE_LEASE
+from portfolio.leases import acquire_lease
+from portfolio.ledger import QuantityTooLarge
+from portfolio.models import BotState, PriceAlert, TelegramUser
+from portfolio.refresher import save_prices
+from portfolio.repository import Analytics
+from portfolio.transfer import ImportResult
+from portfolio.valuation import Holding, value_portfolio
+
+from .middleware import ThrottlingMiddleware
+from .storage import DatabaseStorage, make_storage
+
+
+class DatabaseStorageTests(TestCase):
+    def setUp(self):
+        self.storage = DatabaseStorage()
+
+    def call(self, method, **kwargs):
+        return async_to_sync(getattr(self.storage, method))(chat=1, user=2, **kwargs)
+
+    def test_state_and_data_round_trip(self):
+        self.assertIsNone(self.call('get_state'))
+        self.call('set_state', state='Form:quantity')
+        self.call('update_data', data={'coin_id': 'bitcoin'}, price=10)
+        self.call('update_data', price=20)
+        self.assertEqual(self.call('get_state'), 'Form:quantity')
+        self.assertEqual(self.call('get_data'), {'coin_id': 'bitcoin', 'price': 20})
+        self.assertEqual(BotState.objects.get().chat, '1')
+
+    def test_empty_conversations_are_deleted(self):
+        self.call('set_state', state='Form:quantity')
+        self.call('set_data', data={'coin_id': 'bitcoin'})
+        self.call('reset_state', with_data=False)
+        self.assertEqual(self.call('get_data'), {'coin_id': 'bitcoin'})
+        self.call('reset_state')
+        self.assertFalse(BotState.objects.exists())
+
+    def test_bucket_is_kept_apart_from_data(self):
+        self.call('update_bucket', bucket={'calls': 1})
+        self.call('set_data', data={'coin_id': 'bitcoin'})
+        self.assertEqual(self.call('get_bucket'), {'calls': 1})
+        self.assertEqual(self.call('get_data', default={'x': 1}), {'coin_id': 'bitcoin'})
+
+
+class PortfolioPagesTests(SimpleTestCase):
+    def setUp(self):
+        from . import bot as bot_module
+        self.bot = bot_module
+        holdings = [Holding(f'coin-{index:03d}', Decimal(index + 1), Decimal(1)) for index in range(500)]
+        self.valuation = value_portfolio(holdings, {holding.coin_id: 2 for holding in holdings})
+
+    def test_pages_fit_a_message(self):
+        self.assertEqual(self.bot.page_count(self.valuation), 50)
+        first = self.bot.render_portfolio(self.valuation, page=0)
+        last = self.bot.render_portfolio(self.valuation, page=49)
+        self.assertLess(max(len(first), len(last)), 4096)
+        # largest positions first, totals on every page
+        self.assertIn('coin-499', first)
+        self.assertIn('coin-000', last)
+        self.assertIn(str(self.valuation.value), last)
+
+    def test_keyboard(self):
+        def callbacks(page, pages):
+            keyboard = self.bot.portfolio_keyboard(page, pages)
+            return keyboard and [button.callback_data for button in keyboard.inline_keyboard[0]]
+
+        self.assertIsNone(callbacks(0, 1))
+        self.assertEqual(callbacks(0, 3), ['portfolio:0', 'portfolio:1'])
+        self.assertEqual(callbacks(1, 3), ['portfolio:0', 'portfolio:1', 'portfolio:2'])
+        self.assertEqual(callbacks(2, 3), ['portfolio:1', 'portfolio:2'])
+        keyboard = self.bot.portfolio_keyboard(0, 3, (7, 55, 'eur'))
+        self.assertEqual(keyboard.inline_keyboard[0][1].callback_data, 'portfolio:1:7:55:eur')
+
+    def test_page_turn_reads_the_first_pages_snapshot(self):
+        query = types.CallbackQuery(**{
+            'id': '1', 'chat_instance': '1', 'data': 'portfolio:3:7:55:eur',
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+            'message': {'message_id': 9, 'date': 0, 'chat': {'id': 1, 'type': 'private'}},
+        })
+        sender = mock.Mock(edit_text=mock.AsyncMock())
+        with mock.patch.object(self.bot, 'bot', mock.Mock(answer_callback_query=mock.AsyncMock())), \
+                mock.patch.object(self.bot, 'sender', sender), \
+                mock.patch.object(self.bot.repository, 'load_snapshot', mock.AsyncMock(return_value=self.valuation)) as load_snapshot, \
+                mock.patch.object(self.bot.repository, 'load_portfolio') as load_portfolio:
+            asyncio.run(self.bot.process_callback_portfolio(query))
+        load_snapshot.assert_awaited_once_with(1, 7, 55, 'eur')
+        load_portfolio.assert_not_called()
+        text = sender.edit_text.call_args.args[2]
+        self.assertIn('стр. 4/50', text)
+        self.assertIn('€', text)
+
+
+class PnlTests(SimpleTestCase):
+    def test_render_pnl(self):
+        from . import bot as bot_module
+        pnl = PortfolioPnl(
+            'lifo', realized=Decimal('50.00'), unrealized=Decimal('-20.00'), missing_price=['delisted'], unpriced=['cleared'],
+        )
+        risk = RiskMetrics(portfolio_volatility=0.8123, portfolio_drawdown=0.25)
+        text = bot_module.render_pnl(Analytics(pnl, risk))
+        self.assertIn('LIFO', text)
+        self.assertIn('`$-20.00`', text)
+        self.assertIn('`81.23%`', text)
+        self.assertIn('`delisted`', text)
+        self.assertIn('не учтена: `cleared`', text)
+        self.assertNotIn('просадка', bot_module.render_pnl(Analytics(pnl, RiskMetrics())))
+
+
+class QuantityInputTests(SimpleTestCase):
+    def setUp(self):
+        from . import bot as bot_module
+        self.bot = bot_module
+
+    def test_parse_quantity(self):
+        self.assertEqual(self.bot.parse_quantity(' 0.5 '), Decimal('0.5'))
+        self.assertEqual(self.bot.parse_quantity('9999999999.99999999'), Decimal('9999999999.99999999'))
+        for text in ['abc', '', None, '0', '-1', '0.000000001', 'nan', 'sNaN', 'Infinity', '-inf', '1e10', '12345678901']:
+            self.assertIsNone(self.bot.parse_quantity(text), text)
+
+    def test_bad_quantity_keeps_the_form_open(self):
+        storage = MemoryStorage()
+        state = FSMContext(storage, chat=1, user=1)
+        message = types.Message(**{
+            'message_id': 1, 'date': 0, 'text': 'nan',
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+        })
+
+        async def main():
+            await state.set_state(self.bot.SellForm.quantity)
+            await state.update_data(coin_id='bitcoin')
+            await self.bot.process_sell_quantity(message, state)
+            return await state.get_state()
+
+        sender = mock.Mock(send=mock.AsyncMock())
+        with mock.patch.object(self.bot, 'sender', sender):
+            self.assertEqual(asyncio.run(main()), self.bot.SellForm.quantity.state)
+        sender.send.assert_awaited_once_with(1, "Неправильный ввод. Введите действительное число.")
+
+    def test_holding_over_the_limit_is_refused(self):
+        storage = MemoryStorage()
+        state = FSMContext(storage, chat=1, user=1)
+        message = types.Message(**{
+            'message_id': 1, 'date': 0, 'text': '5',
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+        })
+
+        async def main():
+            await state.set_state(self.bot.Form.quantity)
+            await state.update_data(coin_id='bitcoin', price=100)
+            await self.bot.process_quantity(message, state)
+            return await state.get_state()
+
+        sender = mock.Mock(send=mock.AsyncMock())
+        buy = mock.AsyncMock(side_effect=QuantityTooLarge('bitcoin'))
+        with mock.patch.object(self.bot, 'sender', sender), mock.patch('portfolio.repository.buy', buy):
+            self.assertIsNone(asyncio.run(main()))
+        buy.assert_awaited_once_with(1, 'bitcoin', 100, Decimal(5))
+        sender.send.assert_awaited_once_with(
+            1, "Слишком много монет: в портфеле может быть не больше 9999999999.99999999 монет bitcoin.",
+        )
+
+
+class ImportTests(SimpleTestCase):
+    def test_upload_is_read_from_memory(self):
+        from . import bot as bot_module
+        message = types.Message(**{
+            'message_id': 1, 'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+            'document': {'file_id': 'f', 'file_unique_id': 'u', 'file_name': 'trades.csv', 'file_size': 40},
+        })
+        uploaded = []
+
+        async def download(destination):
+            # aiogram opens anything that is not an io.IOBase as a path
+            self.assertIsInstance(destination, io.IOBase)
+            destination.write(b'coin_id,quantity,price\nbitcoin,1,100\n')
+            destination.seek(0)
+
+        async def import_file(telegram_id, file, fmt, is_known):
+            uploaded.append(file.read())
+            return ImportResult(trades=1, coins=1, created=1)
+
+        sender = mock.Mock(send=mock.AsyncMock())
+        with mock.patch.object(bot_module, 'sender', sender), \
+                mock.patch.object(types.Document, 'download', lambda self, destination: download(destination)), \
+                mock.patch('portfolio.repository.import_file', import_file):
+            asyncio.run(bot_module.process_import(message))
+        self.assertEqual(uploaded, [b'coin_id,quantity,price\nbitcoin,1,100\n'])
+        sender.send.assert_awaited_once_with(1, "Импортировано сделок: 1, монет: 1 (новых: 1).")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ThrottlingTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.replies = []
+        self.handled = []
+        self.release = None
+        self.ids = itertools.count(1)
+
+    def make_dispatcher(self, **kwargs):
+        dp = Dispatcher(Bot(token='1:test'), storage=MemoryStorage())
+        dp.middleware.setup(ThrottlingMiddleware(
+            lambda chat_id, text: self.replies.append((chat_id, text)), clock=self.clock, **kwargs,
+        ))
+
+        async def handler(message):
+            self.handled.append((message.chat.id, message.text))
+            if self.release is not None and message.text == '/portfolio':
+                await self.release.wait()
+
+        dp.register_message_handler(handler)
+        return dp
+
+    async def started(self):
+        while not self.handled:
+            await asyncio.sleep(0)
+
+    def update(self, chat_id, text):
+        return types.Update(update_id=next(self.ids), message={
+            'message_id': next(self.ids),
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            if text.startswith('/') else [],
+        })
+
+    def test_rate_per_user_and_command(self):
+        dp = self.make_dispatcher(rate=1, burst=2)
+
+        async def main():
+            for text in ['/portfolio', '/portfolio', '/portfolio', '/portfolio', '/history']:
+                await dp.process_update(self.update(1, text))
+            await dp.process_update(self.update(2, '/portfolio'))
+            self.clock.now = 1
+            await dp.process_update(self.update(1, '/portfolio'))
+
+        asyncio.run(main())
+        self.assertEqual(self.handled, [(1, '/portfolio')] * 2 + [(1, '/history'), (2, '/portfolio'), (1, '/portfolio')])
+        self.assertEqual(len(self.replies), 1)  # told to wait once, not on every message
+
+    def test_duplicates_in_flight_are_coalesced(self):
+        dp = self.make_dispatcher(burst=10)
+
+        async def main():
+            self.release = asyncio.Event()
+            first = asyncio.ensure_future(dp.process_update(self.update(1, '/portfolio')))
+            await self.started()
+            await dp.process_update(self.update(1, '/portfolio'))
+            await dp.process_update(self.update(1, '/add bitcoin'))
+            self.release.set()
+            await first
+            await dp.process_update(self.update(1, '/portfolio'))
+
+        asyncio.run(main())
+        self.assertEqual(self.handled, [(1, '/portfolio'), (1, '/add bitcoin'), (1, '/portfolio')])
+        self.assertEqual(self.replies, [])
+
+    def test_overload_is_turned_away(self):
+        dp = self.make_dispatcher(max_in_flight=1)
+
+        async def main():
+            self.release = asyncio.Event()
+            first = asyncio.ensure_future(dp.process_update(self.update(1, '/portfolio')))
+            await self.started()
+            await dp.process_update(self.update(2, '/portfolio'))
+            self.release.set()
+            await first
+
+        asyncio.run(main())
+        self.assertEqual(self.handled, [(1, '/portfolio')])
+        self.assertEqual([chat_id for chat_id, _ in self.replies], [2])
+
+
+class CatalogRefreshTests(SimpleTestCase):
+    def test_follower_retries_until_the_catalog_is_stored(self):
+        from . import bot as bot_module
+        sleeps = []
+        # empty at startup and on two retries, then the leader's download is in the database
+        loads = mock.AsyncMock(side_effect=[0, 0, 0, 5])
+
+        async def sleep(delay):
+            sleeps.append(delay)
+            if len(sleeps) == 3:
+                raise asyncio.CancelledError
+
+        with mock.patch.object(bot_module, 'load_catalog', loads), \
+                mock.patch.object(bot_module, 'acquire_lease', return_value=False), \
+                mock.patch.object(bot_module.asyncio, 'sleep', sleep):
+            with self.assertRaises(asyncio.CancelledError):
+                asyncio.run(bot_module.update_catalog_async())
+        retry, refresh = bot_module.CATALOG_RETRY_INTERVAL, bot_module.CATALOG_REFRESH_INTERVAL
+        self.assertEqual(sleeps, [retry, retry, refresh])
+
+
+class Stop(Exception):
+    pass
+
+
+class PriceLeaderTests(TestCase):
+    def setUp(self):
+        from . import bot as bot_module
+        self.bot = bot_module
+        self.sleeps = 0
+
+    async def sleep(self, delay):
+        self.sleeps += 1
+        if self.sleeps == 2:
+            raise Stop
+
+    def test_alerts_fire_while_runjobs_refreshes_prices(self):
+        user = TelegramUser.objects.create(user=User.objects.create(username='watcher'), telegram_id=7)
+        PriceAlert.objects.create(user=user, coin_id='bitcoin', direction=PriceAlert.ABOVE, threshold=70000)
+        # `runjobs` in another process holds the price lease and stores what it fetched
+        acquire_lease(PRICE_LEASE, holder='jobs-host:1', ttl=60)
+        save_prices({'bitcoin': 65000})
+        sender = mock.Mock()
+
+        async def main():
+            await self.bot.update_coin_prices_async()
+
+        async def store_next_prices(delay):
+            await sync_to_async(save_prices)({'bitcoin': 71000})
+            await self.sleep(delay)
+
+        with mock.patch.object(self.bot, 'sender', sender), \
+                mock.patch.object(self.bot, 'alert_index', AlertIndex()), \
+                mock.patch.object(self.bot, 'make_feed', side_effect=AssertionError("the job refreshes prices")), \
+                mock.patch.object(self.bot.asyncio, 'sleep', store_next_prices):
+            with self.assertRaises(Stop):
+                async_to_sync(main)()
+        sender.broadcast.assert_called_once_with(7, "🔔 Цена bitcoin поднялась выше 70000")
+        self.assertTrue(PriceAlert.objects.get().triggered_at)
+
+    def test_long_jobs_do_not_hold_up_the_leader_loop(self):
+        started = []
+
+        async def run_job(job):
+            started.append(job.name)
+            await asyncio.Event().wait()
+
+        class IdleFeed:
+            def set_coins(self, coin_ids):
+                pass
+
+            async def run(self):
+                await asyncio.Event().wait()
+
+        async def main():
+            try:
+                with self.assertRaises(Stop):
+                    await self.bot.update_coin_prices_async()
+                return [task.done() for task in self.bot.job_tasks.values()]
+            finally:
+                await self.bot.stop_feed()
+                for task in self.bot.job_tasks.values():
+                    task.cancel()
+                self.bot.job_tasks.clear()
+
+        with mock.patch.object(self.bot, 'run_job', run_job), \
+                mock.patch.object(self.bot, 'make_feed', lambda bus: IdleFeed()), \
+                mock.patch.object(self.bot.fx_rates, 'refresh', mock.AsyncMock()), \
+                mock.patch.object(self.bot.asyncio, 'sleep', self.sleep):
+            running = async_to_sync(main)()
+        # two passes of the loop, each job started once and still running
+        self.assertEqual(self.sleeps, 2)
+        self.assertEqual(started, ['snapshots', 'cleanup'])
+        self.assertEqual(running, [False, False])
+
+
+class StartupTests(SimpleTestCase):
+    def test_make_storage(self):
+        self.assertIsInstance(make_storage('memory'), MemoryStorage)
+        self.assertIsInstance(make_storage('database'), DatabaseStorage)
+
+    def test_importing_the_package_is_cheap(self):
+        script = "import sys, bot; print(sorted(m for m in ('aiogram', 'aiohttp', 'bot.bot', 'django.db') if m in sys.modules))"
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, check=True, capture_output=True, text=True,
+        ).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_create_dispatcher(self):
+        from . import bot as bot_module
+        with self.assertLogs('bot.bot', 'INFO'):
+            dp = bot_module.create_dispatcher('1:test', storage=MemoryStorage())
+        self.assertIs(bot_module.dp, dp)
+        self.assertEqual(bot_module.sender.bot, dp.bot)
+        commands = {
+            command
+            for handler in dp.message_handlers.handlers
+            for handler_filter in handler.filters
+            for command in getattr(handler_filter.filter, 'commands', ())
+        }
+        self.assertTrue({'start', 'add', 'sell', 'portfolio', 'pnl', 'clear'} <= commands)
+
+    def test_shutdown_stops_the_feed_and_the_bus(self):
+        from . import bot as bot_module
+
+        class IdleFeed:
+            def set_coins(self, coin_ids):
+                pass
+
+            async def run(self):
+                await asyncio.Event().wait()
+
+        async def idle():
+            await asyncio.Event().wait()
+
+        async def main():
+            with self.assertLogs('bot.bot', 'INFO'):
+                bot_module.create_dispatcher('1:test', storage=MemoryStorage())
+                await bot_module.on_startup(bot_module.dp)
+            bot_module.start_feed()
+            feed_task = bot_module.feed_task
+            bus_tasks = list(bot_module.price_bus._tasks)
+            await asyncio.sleep(0)
+            await bot_module.on_shutdown(bot_module.dp)
+            await bot_module.bot.session.close()
+            return feed_task, bus_tasks
+
+        with mock.patch.object(bot_module, 'make_feed', lambda bus: IdleFeed()), \
+                mock.patch.object(bot_module, 'update_coin_prices_async', idle), \
+                mock.patch.object(bot_module, 'update_catalog_async', idle):
+            feed_task, bus_tasks = asyncio.run(main())
+        self.assertEqual(len(bus_tasks), 3)
+        self.assertTrue(all(task.cancelled() for task in [feed_task, *bus_tasks]))
+
+    def test_polling_bot_serves_metrics(self):
+        from . import bot as bot_module
+        serve_metrics = bot_module.serve_metrics
+
+        async def idle():
+            await asyncio.Event().wait()
+
+        async def main():
+            with self.assertLogs('bot.bot', 'INFO'):
+                dp = bot_module.create_dispatcher('1:test', storage=MemoryStorage())
+                await bot_module.on_polling_startup(dp)
+            port = dp['metrics_server'].addresses[0][1]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                    status, body = response.status, await response.text()
+            await bot_module.on_polling_shutdown(dp)
+            await dp.bot.session.close()
+            return status, body
+
+        with mock.patch.object(bot_module, 'serve_metrics', lambda port: serve_metrics(0, '127.0.0.1')), \
+                mock.patch.object(bot_module, 'update_coin_prices_async', idle), \
+                mock.patch.object(bot_module, 'update_catalog_async', idle):
+            status, body = asyncio.run(main())
+        self.assertEqual(status, 200)
+        self.assertIn('bot_send_queue_depth', body)
+        self.assertIsNone(bot_module.feed_task)
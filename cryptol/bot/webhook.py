@@ -0,0 +1,52 @@
+"""Webhook entrypoint, so the bot can run in several worker processes:
+
+    gunicorn bot.webhook:create_app --bind 0.0.0.0:8080 --workers 4 --worker-class aiohttp.GunicornWebWorker
+
+FSM state is shared through settings.BOT_FSM_STORAGE and background jobs
+elect a single leader, so any number of workers can serve updates.
+
+Every worker serves its own metrics registry at /metrics, so Prometheus has
+to scrape each worker and sum the series; a request through a load balancer
+only sees whichever worker answered. The polling bot (python -m bot.bot)
+serves the same page on settings.BOT_METRICS_PORT, and Django's /metrics
+only covers the web process.
+"""
+import os
+
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY, get_new_configured_app
+from aiohttp import web
+
+from . import setup_django
+
+setup_django()
+
+from django.conf import settings
+
+from .bot import create_dispatcher, metrics_view, on_shutdown, on_startup
+
+
+async def startup(app):
+    dp = app[BOT_DISPATCHER_KEY]
+    # Every worker sets the same URL, so the call is idempotent
+    await dp.bot.set_webhook(settings.BOT_WEBHOOK_HOST + settings.BOT_WEBHOOK_PATH)
+    await on_startup(dp)
+
+
+async def shutdown(app):
+    dp = app[BOT_DISPATCHER_KEY]
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await dp.bot.close()
+
+
+async def create_app():
+    app = get_new_configured_app(dispatcher=create_dispatcher(), path=settings.BOT_WEBHOOK_PATH)
+    app.router.add_get('/metrics', metrics_view)
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -82,6 +83,28 @@ DATABASES = {
 }
 
 
+# Cache
+# Valuations are cached per portfolio in the 'portfolio' cache: a local LRU
+# by default, or a shared backend such as
+# PORTFOLIO_CACHE_BACKEND=django.core.cache.backends.memcached.PyMemcacheCache
+# PORTFOLIO_CACHE_LOCATION=127.0.0.1:11211
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'portfolio': {
+        'BACKEND': os.environ.get('PORTFOLIO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('PORTFOLIO_CACHE_LOCATION', 'portfolio'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('PORTFOLIO_CACHE_MAX_ENTRIES', 10000)),
+        },
+    },
+}
+
+PORTFOLIO_CACHE = 'portfolio'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -122,3 +145,60 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Logging: one key=value line per event on stderr
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'kv': {'format': 'time=%(asctime)s level=%(levelname)s logger=%(name)s msg="%(message)s"'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'kv'},
+    },
+    'root': {'handlers': ['console'], 'level': os.environ.get('LOG_LEVEL', 'INFO')},
+    # one line per HTTP request is noise next to the bot's own events
+    'loggers': {
+        'aiohttp.access': {'level': 'WARNING'},
+    },
+}
+
+
+# Read API under /api/portfolios/: staff sessions, or dashboards sending
+# "Authorization: Bearer <PORTFOLIO_API_TOKEN>". Without a token only staff get in.
+PORTFOLIO_API_TOKEN = os.environ.get('PORTFOLIO_API_TOKEN', '')
+
+
+# Telegram bot
+
+# Where FSM conversations live: 'database' is shared by all bot workers and
+# survives restarts, 'redis' needs aioredis, 'memory' is a single process only.
+BOT_FSM_STORAGE = os.environ.get('BOT_FSM_STORAGE', 'database')
+
+BOT_REDIS = {
+    'host': os.environ.get('BOT_REDIS_HOST', 'localhost'),
+    'port': int(os.environ.get('BOT_REDIS_PORT', 6379)),
+    'db': int(os.environ.get('BOT_REDIS_DB', 0)),
+}
+
+# Public base URL of the webhook workers, e.g. https://bot.example.com
+BOT_WEBHOOK_HOST = os.environ.get('BOT_WEBHOOK_HOST', '')
+BOT_WEBHOOK_PATH = os.environ.get('BOT_WEBHOOK_PATH', '/webhook')
+
+# Per user and command: BOT_THROTTLE_RATE commands a second, bursts of
+# BOT_THROTTLE_BURST; above BOT_MAX_IN_FLIGHT updates at once a worker sheds load.
+BOT_THROTTLE_RATE = float(os.environ.get('BOT_THROTTLE_RATE', 1))
+BOT_THROTTLE_BURST = int(os.environ.get('BOT_THROTTLE_BURST', 3))
+BOT_MAX_IN_FLIGHT = int(os.environ.get('BOT_MAX_IN_FLIGHT', 100))
+
+# Port of /metrics in the polling bot (python -m bot.bot), 0 to turn it off.
+# Webhook workers serve /metrics on their own port instead, each its own registry.
+BOT_METRICS_PORT = int(os.environ.get('BOT_METRICS_PORT', 9100))
+
+# Source of live prices: 'rest' polls CoinGecko every PRICE_FEED_INTERVAL
+# seconds, 'stream' listens to the WebSocket relay at PRICE_FEED_URL.
+PRICE_FEED = os.environ.get('PRICE_FEED', 'rest')
+PRICE_FEED_URL = os.environ.get('PRICE_FEED_URL', '')
+PRICE_FEED_INTERVAL = int(os.environ.get('PRICE_FEED_INTERVAL', 20))
@@ -0,0 +1,65 @@
+"""
+Production settings for cryptol project.
+
+Select with DJANGO_SETTINGS_MODULE=cryptol.settings_production. The database
+is chosen by DB_ENGINE: 'sqlite' (default, tuned for several concurrent
+writers) or 'postgresql'.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+
+ALLOWED_HOSTS = [host for host in os.environ.get('DJANGO_ALLOWED_HOSTS', '').split(',') if host]
+
+
+# Database
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'cryptol'),
+            'USER': os.environ.get('DB_USER', 'cryptol'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # Keep connections open between requests and bot updates instead of
+            # reconnecting every time; a pooler like PgBouncer can sit in front.
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+    # PgBouncer in transaction pooling mode cannot keep server-side cursors
+    # open across transactions.
+    if os.environ.get('DB_PGBOUNCER'):
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'OPTIONS': {
+                # Seconds a writer waits for the lock instead of failing with
+                # "database is locked"
+                'timeout': 20,
+            },
+        }
+    }
+
+    # Applied to every new connection, see portfolio.db.configure_sqlite.
+    # WAL lets the bot's readers run while the price refresher writes.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 20000,
+    }
@@ -15,8 +15,12 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path
+
+from portfolio.views import prometheus_metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('api/', include('portfolio.urls')),
+    path('metrics', prometheus_metrics, name='metrics'),
 ]
@@ -1,3 +1,101 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import CatalogCoin, CoinPrice, Portfolio, PriceAlert, TelegramUser, Trade, UserCoin
+from .queries import with_totals
+from .valuation import to_cents
+
+
+class UserCoinInline(admin.TabularInline):
+    # read-only: holdings change through the ledger, which records the trade and bumps
+    # Portfolio.version so cached valuations and ETags see the change
+    model = UserCoin
+    fields = ('coin_id', 'quantity', 'price', 'purchase_price', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """View only, for rows the bot keeps in sync with state the admin cannot update.
+
+    Trades feed the per-version lot cache, which only a Portfolio.version bump
+    invalidates; alerts are matched from the bot's in-memory AlertIndex.
+    """
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Portfolio)
+class PortfolioAdmin(admin.ModelAdmin):
+    # totals are correlated subqueries of the list query: two queries per page however many portfolios
+    list_display = ('id', 'user', 'telegram_id', 'coins', 'total_cost', 'total_value', 'version')
+    list_select_related = ('user__telegramuser',)
+    search_fields = ('user__username', 'user__telegramuser__telegram_id')
+    readonly_fields = ('version',)
+    inlines = [UserCoinInline]
+
+    def get_queryset(self, request):
+        return with_totals(super().get_queryset(request))
+
+    @admin.display(description='Telegram ID', ordering='user__telegramuser__telegram_id')
+    def telegram_id(self, portfolio):
+        telegram_user = getattr(portfolio.user, 'telegramuser', None)
+        return telegram_user and telegram_user.telegram_id
+
+    @admin.display(ordering='coins')
+    def coins(self, portfolio):
+        return portfolio.coins
+
+    @admin.display(description='Cost', ordering='cost')
+    def total_cost(self, portfolio):
+        return to_cents(portfolio.cost)
+
+    @admin.display(description='Value', ordering='value')
+    def total_value(self, portfolio):
+        return to_cents(portfolio.value)
+
+
+@admin.register(TelegramUser)
+class TelegramUserAdmin(admin.ModelAdmin):
+    list_display = ('telegram_id', 'user', 'currency')
+    list_select_related = ('user',)
+    search_fields = ('telegram_id', 'user__username')
+
+
+@admin.register(Trade)
+class TradeAdmin(ReadOnlyAdmin):
+    list_display = ('created_at', 'portfolio', 'coin_id', 'side', 'quantity', 'price')
+    list_filter = ('side',)
+    list_select_related = ('portfolio__user',)
+    search_fields = ('coin_id',)
+    date_hierarchy = 'created_at'
+
+
+@admin.register(PriceAlert)
+class PriceAlertAdmin(ReadOnlyAdmin):
+    list_display = ('user', 'coin_id', 'direction', 'threshold', 'created_at', 'triggered_at')
+    list_filter = ('direction',)
+    list_select_related = ('user__user',)
+    search_fields = ('coin_id',)
+
+
+@admin.register(CoinPrice)
+class CoinPriceAdmin(admin.ModelAdmin):
+    list_display = ('coin_id', 'price', 'updated_at')
+    search_fields = ('coin_id',)
+
+
+@admin.register(CatalogCoin)
+class CatalogCoinAdmin(admin.ModelAdmin):
+    list_display = ('coin_id', 'symbol', 'name', 'updated_at')
+    search_fields = ('coin_id', 'symbol', 'name')
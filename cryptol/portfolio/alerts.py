@@ -0,0 +1,90 @@
+from bisect import bisect_left, insort
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PriceAlert, TelegramUser
+
+
+class AlertIndex:
+    """Pending price alerts per coin, sorted so that a tick only touches crossed alerts.
+
+    Both lists are ordered so that the alerts crossed by a price form their
+    tail: `above` alerts by descending threshold, `below` alerts by ascending
+    threshold. Matching a tick is one bisect per coin plus popping the fired
+    alerts, O(log n + fired).
+    """
+
+    def __init__(self):
+        self._above = defaultdict(list)  # coin_id -> [(-threshold, alert_id)]
+        self._below = defaultdict(list)  # coin_id -> [(threshold, alert_id)]
+        self._alerts = {}  # alert_id -> (coin_id, direction, threshold)
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def add(self, alert_id, coin_id, direction, threshold):
+        threshold = Decimal(threshold)
+        if direction == PriceAlert.ABOVE:
+            insort(self._above[coin_id], (-threshold, alert_id))
+        else:
+            insort(self._below[coin_id], (threshold, alert_id))
+        self._alerts[alert_id] = (coin_id, direction, threshold)
+        self.last_id = max(self.last_id, alert_id)
+
+    def remove(self, alert_id):
+        coin_id, direction, threshold = self._alerts.pop(alert_id)
+        if direction == PriceAlert.ABOVE:
+            self._above[coin_id].remove((-threshold, alert_id))
+        else:
+            self._below[coin_id].remove((threshold, alert_id))
+
+    def _pop_tail(self, alerts, key):
+        start = bisect_left(alerts, (key, -1))
+        fired = [alert_id for _, alert_id in alerts[start:]]
+        del alerts[start:]
+        return fired
+
+    def match(self, prices):
+        """Remove and return the ids of alerts crossed by {coin_id: price}."""
+        fired = []
+        for coin_id, price in prices.items():
+            price = Decimal(str(price))
+            if self._above.get(coin_id):
+                fired += self._pop_tail(self._above[coin_id], -price)
+            if self._below.get(coin_id):
+                fired += self._pop_tail(self._below[coin_id], price)
+        for alert_id in fired:
+            del self._alerts[alert_id]
+        return fired
+
+
+def load_new_alerts(index):
+    """Add pending alerts created since the last call; cheap enough to run every tick."""
+    rows = PriceAlert.objects.filter(triggered_at__isnull=True, pk__gt=index.last_id).order_by('pk')
+    for alert_id, coin_id, direction, threshold in rows.values_list('pk', 'coin_id', 'direction', 'threshold'):
+        index.add(alert_id, coin_id, direction, threshold)
+
+
+def mark_fired(alert_ids):
+    """Mark alerts as triggered and return what to notify, as
+    (telegram_id, coin_id, direction, threshold) tuples.
+
+    Alerts deleted or already triggered elsewhere are skipped.
+    """
+    with transaction.atomic():
+        pending = PriceAlert.objects.select_for_update().filter(pk__in=alert_ids, triggered_at__isnull=True)
+        notifications = list(pending.values_list('user__telegram_id', 'coin_id', 'direction', 'threshold'))
+        pending.update(triggered_at=timezone.now())
+    return notifications
+
+
+def create_alert(telegram_id, coin_id, direction, threshold):
+    user = TelegramUser.objects.get(telegram_id=telegram_id)
+    return PriceAlert.objects.create(user=user, coin_id=coin_id, direction=direction, threshold=threshold)
+
+
+alert_index = AlertIndex()
@@ -0,0 +1,237 @@
+import math
+from dataclasses import dataclass, field
+from datetime import timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.utils import timezone
+
+from .cache import valuation_cache
+from .models import PriceCandle, Trade
+from .valuation import ZERO, to_cents
+
+FIFO = 'fifo'
+LIFO = 'lifo'
+AVERAGE = 'average'
+COST_METHODS = (FIFO, LIFO, AVERAGE)
+
+# daily candles change slowly, risk metrics are recomputed at most this often
+RISK_TTL = 60 * 60
+PERIODS_PER_YEAR = 365  # crypto trades every day
+
+
+@dataclass
+class Lot:
+    quantity: Decimal
+    price: Decimal
+
+
+@dataclass
+class Position:
+    """Open lots of one coin and the P&L its sells realized."""
+    coin_id: str
+    lots: List[Lot] = field(default_factory=list)
+    realized: Decimal = ZERO
+    # sold quantity without a recorded price: its lots are closed, its P&L is unknown
+    unpriced: Decimal = ZERO
+
+    @property
+    def quantity(self):
+        return sum((lot.quantity for lot in self.lots), ZERO)
+
+    @property
+    def cost(self):
+        return sum((lot.quantity * lot.price for lot in self.lots), ZERO)
+
+
+@dataclass
+class CoinPnl:
+    coin_id: str
+    quantity: Decimal
+    cost: Decimal
+    value: Decimal
+    realized: Decimal
+    unrealized: Decimal
+
+
+@dataclass
+class PortfolioPnl:
+    method: str
+    coins: List[CoinPnl] = field(default_factory=list)
+    missing_price: List[str] = field(default_factory=list)
+    # coins sold at least partly without a price (clears included): their realized P&L is incomplete
+    unpriced: List[str] = field(default_factory=list)
+    realized: Decimal = ZERO
+    unrealized: Decimal = ZERO
+
+
+@dataclass
+class RiskMetrics:
+    """Annualized volatility and max drawdown (fractions) of daily closes, per coin and overall."""
+    coin_ids: List[str] = field(default_factory=list)
+    volatility: Dict[str, float] = field(default_factory=dict)
+    max_drawdown: Dict[str, float] = field(default_factory=dict)
+    # correlation of daily returns, rows and columns in `coin_ids` order
+    correlation: List[List[float]] = field(default_factory=list)
+    portfolio_volatility: Optional[float] = None
+    portfolio_drawdown: Optional[float] = None
+
+
+def _close(position, quantity, method):
+    """Take `quantity` off the open lots; returns the cost of what was taken."""
+    if method == AVERAGE and position.lots:
+        # a single pooled lot at the running average price
+        lot = position.lots[0]
+        taken = min(quantity, lot.quantity)
+        lot.quantity -= taken
+        if not lot.quantity:
+            position.lots.clear()
+        return taken * lot.price
+    cost = ZERO
+    index = 0 if method == FIFO else -1
+    while quantity > 0 and position.lots:
+        lot = position.lots[index]
+        taken = min(quantity, lot.quantity)
+        cost += taken * lot.price
+        lot.quantity -= taken
+        quantity -= taken
+        if not lot.quantity:
+            position.lots.pop(index)
+    return cost
+
+
+def replay_trades(trades, method=FIFO):
+    """Rebuild open lots and realized P&L from (coin_id, side, quantity, price) rows, oldest first."""
+    if method not in COST_METHODS:
+        raise ValueError(f"unknown cost method: {method}")
+    positions = {}
+    for coin_id, side, quantity, price in trades:
+        position = positions.get(coin_id)
+        if position is None:
+            position = positions[coin_id] = Position(coin_id)
+        if side == Trade.BUY:
+            if method == AVERAGE and position.lots:
+                lot = position.lots[0]
+                total = lot.quantity + quantity
+                lot.price = (lot.quantity * lot.price + quantity * price) / total
+                lot.quantity = total
+            else:
+                position.lots.append(Lot(quantity, price))
+        else:
+            cost = _close(position, quantity, method)
+            if price is None:
+                position.unpriced += quantity
+            else:
+                position.realized += quantity * price - cost
+    return positions
+
+
+def load_trades(portfolio):
+    rows = Trade.objects.filter(portfolio=portfolio).order_by('created_at', 'pk')
+    return list(rows.values_list('coin_id', 'side', 'quantity', 'price'))
+
+
+def positions(portfolio, method=FIFO):
+    """Open lots per coin, replayed from the ledger once per portfolio version."""
+    key = f'positions:{portfolio.pk}:{portfolio.version}:{method}'
+    cache = valuation_cache()
+    result = cache.get(key)
+    if result is None:
+        result = replay_trades(load_trades(portfolio), method)
+        cache.set(key, result, None)  # a new version is a new key
+    return result
+
+
+def portfolio_pnl(portfolio, prices, method=FIFO):
+    """Realized and unrealized P&L against a {coin_id: price} snapshot."""
+    result = PortfolioPnl(method)
+    realized = unrealized = ZERO
+    for coin_id, position in sorted(positions(portfolio, method).items()):
+        quantity, cost = position.quantity, position.cost
+        # realized P&L comes from the ledger alone, whatever the current quote
+        realized += position.realized
+        if position.unpriced:
+            result.unpriced.append(coin_id)
+        price = prices.get(coin_id)
+        if quantity and price is None:
+            result.missing_price.append(coin_id)
+            continue
+        value = quantity * Decimal(str(price)) if quantity else ZERO
+        result.coins.append(CoinPnl(
+            coin_id=coin_id,
+            quantity=quantity,
+            cost=to_cents(cost),
+            value=to_cents(value),
+            realized=to_cents(position.realized),
+            unrealized=to_cents(value - cost),
+        ))
+        unrealized += value - cost
+    result.realized = to_cents(realized)
+    result.unrealized = to_cents(unrealized)
+    return result
+
+
+def price_matrix(coin_ids, start):
+    """Daily closes as a (days, coins) float array, forward-filled; one query for all coins."""
+    rows = PriceCandle.objects.filter(coin_id__in=coin_ids, resolution='1d', start__gte=start)
+    rows = rows.order_by('start').values_list('start', 'coin_id', 'close')
+    days = {}
+    column = {coin_id: index for index, coin_id in enumerate(coin_ids)}
+    for day, coin_id, close in rows:
+        days.setdefault(day, [math.nan] * len(coin_ids))[column[coin_id]] = float(close)
+    matrix = np.array(list(days.values()), dtype=float).reshape(len(days), len(coin_ids))
+    for row in range(1, len(matrix)):
+        gaps = np.isnan(matrix[row])
+        matrix[row, gaps] = matrix[row - 1, gaps]
+    return matrix
+
+
+def _max_drawdown(series):
+    series = series[~np.isnan(series)]
+    if len(series) < 2:
+        return None
+    return float(np.max(1 - series / np.maximum.accumulate(series)))
+
+
+def _volatility(returns):
+    returns = returns[~np.isnan(returns)]
+    if len(returns) < 2:
+        return None
+    return float(np.std(returns, ddof=1) * math.sqrt(PERIODS_PER_YEAR))
+
+
+def compute_risk(coin_ids, quantities, matrix):
+    """Risk metrics of a closes matrix; `quantities` weight the coins in the portfolio series."""
+    result = RiskMetrics(coin_ids=list(coin_ids))
+    if len(matrix) < 2 or not coin_ids:
+        return result
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = np.diff(np.log(matrix), axis=0)
+    for index, coin_id in enumerate(coin_ids):
+        result.volatility[coin_id] = _volatility(returns[:, index])
+        result.max_drawdown[coin_id] = _max_drawdown(matrix[:, index])
+    complete = returns[~np.isnan(returns).any(axis=1)]
+    if len(complete) >= 2:
+        correlation = np.corrcoef(complete, rowvar=False).reshape(len(coin_ids), len(coin_ids))
+        result.correlation = np.round(correlation, 6).tolist()
+    # the value of today's holdings along the price history, days where every coin has a price
+    values = matrix[~np.isnan(matrix).any(axis=1)] @ np.asarray(quantities, dtype=float)
+    if len(values) >= 2 and values.all():
+        result.portfolio_volatility = _volatility(np.diff(np.log(values)))
+        result.portfolio_drawdown = _max_drawdown(values)
+    return result
+
+
+def portfolio_risk(portfolio, days=90):
+    """Volatility, drawdown and correlation of the open positions over `days` of daily closes."""
+    key = f'risk:{portfolio.pk}:{portfolio.version}:{days}'
+    cache = valuation_cache()
+    result = cache.get(key)
+    if result is None:
+        held = {coin_id: position.quantity for coin_id, position in positions(portfolio, AVERAGE).items()}
+        coin_ids = sorted(coin_id for coin_id, quantity in held.items() if quantity)
+        matrix = price_matrix(coin_ids, timezone.now() - timedelta(days=days))
+        result = compute_risk(coin_ids, [held[coin_id] for coin_id in coin_ids], matrix)
+        cache.set(key, result, RISK_TTL)
+    return result
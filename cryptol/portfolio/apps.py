@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class PortfolioConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'portfolio'
+
+    def ready(self):
+        from .db import configure_sqlite
+        from .metrics import install_query_counter
+        connection_created.connect(configure_sqlite)
+        connection_created.connect(install_query_counter)
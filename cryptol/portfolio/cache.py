@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import metrics
+from .quotes import price_cache
+
+# long enough to page through a portfolio; /portfolio itself only ever reads the current period
+VALUATION_TTL = 15 * 60
+
+
+def valuation_cache():
+    """The cache backend of PORTFOLIO_CACHE: a local LRU by default, shared if configured."""
+    return caches[settings.PORTFOLIO_CACHE]
+
+
+def price_stamp(clock=time.time):
+    """The current price period, one price cache `ttl` long.
+
+    Taken before the prices a valuation is computed from, so prices stored
+    meanwhile can only make the entry older than its key says, never newer.
+    Every worker derives the same stamp from the clock, so a shared
+    PORTFOLIO_CACHE serves one worker's valuation to all of them.
+    """
+    return int(clock() // price_cache.ttl)
+
+
+def valuation_key(portfolio_id, version, currency, stamp):
+    # a new holdings version or a new price period is a new key, stale entries just age out
+    return f'valuation:{portfolio_id}:{version}:{currency}:{stamp}'
+
+
+def get_valuation(portfolio_id, version, currency, stamp):
+    """The cached PortfolioValuation of holdings `version` in price period `stamp`, or None."""
+    valuation = valuation_cache().get(valuation_key(portfolio_id, version, currency, stamp))
+    metrics.inc('portfolio_cache_requests_total', result='miss' if valuation is None else 'hit')
+    return valuation
+
+
+def store_valuation(portfolio_id, version, currency, stamp, valuation):
+    """Cache a valuation computed from prices read after `stamp` was taken."""
+    valuation_cache().set(valuation_key(portfolio_id, version, currency, stamp), valuation, VALUATION_TTL)
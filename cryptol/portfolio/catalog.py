@@ -0,0 +1,129 @@
+import difflib
+from bisect import bisect_left
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+
+from .coingecko import client
+from .models import CatalogCoin
+
+BATCH_SIZE = 500
+
+
+class CoinCatalog:
+    """In-memory index of the CoinGecko coin list.
+
+    Ids and symbols are kept in one sorted list of (key, coin_id) pairs, so an
+    existence check is a dict lookup and a prefix search is a bisect. Fuzzy
+    suggestions only compare against keys with the same first letter and a
+    similar length.
+    """
+
+    def __init__(self, coins=()):
+        self.load(coins)
+
+    def load(self, coins):
+        """Rebuild the index from (coin_id, symbol, name) tuples."""
+        self._coins = {}
+        keys = set()
+        for coin_id, symbol, name in coins:
+            self._coins[coin_id] = (symbol, name)
+            keys.add((coin_id.lower(), coin_id))
+            if symbol:
+                keys.add((symbol.lower(), coin_id))
+        self._keys = sorted(keys)
+        self._owners = defaultdict(list)
+        for key, coin_id in self._keys:
+            self._owners[key].append(coin_id)
+        self._buckets = defaultdict(list)
+        for key in self._owners:
+            self._buckets[key[0], len(key)].append(key)
+
+    def __len__(self):
+        return len(self._coins)
+
+    def exists(self, coin_id):
+        return coin_id in self._coins
+
+    def describe(self, coin_id):
+        symbol, name = self._coins[coin_id]
+        return {'id': coin_id, 'symbol': symbol, 'name': name}
+
+    def prefix(self, prefix, limit=10):
+        prefix = prefix.lower()
+        found = []
+        for key, coin_id in self._keys[bisect_left(self._keys, (prefix, '')):]:
+            if not key.startswith(prefix) or len(found) >= limit:
+                break
+            if coin_id not in found:
+                found.append(coin_id)
+        return found
+
+    def suggest(self, query, limit=5):
+        """Coin ids for a "did you mean" reply: prefix matches first, then close spellings."""
+        query = query.lower()
+        if not query:
+            return []
+        found = self.prefix(query, limit)
+        if len(found) < limit:
+            candidates = [
+                key
+                for length in range(len(query) - 2, len(query) + 3)
+                for key in self._buckets.get((query[0], length), ())
+            ]
+            for key in difflib.get_close_matches(query, candidates, n=limit, cutoff=0.75):
+                found.extend(coin_id for coin_id in self._owners[key] if coin_id not in found)
+        return found[:limit]
+
+
+def load_catalog_rows():
+    return list(CatalogCoin.objects.values_list('coin_id', 'symbol', 'name'))
+
+
+def sync_catalog(coins):
+    """Apply a fresh `/coins/list` payload to CatalogCoin, touching only rows that changed.
+
+    Returns a (created, updated, deleted) tuple.
+    """
+    fresh = {coin['id']: (coin.get('symbol') or '', coin.get('name') or '') for coin in coins}
+    now = timezone.now()
+    with transaction.atomic():
+        existing = {
+            coin_id: (pk, symbol, name)
+            for pk, coin_id, symbol, name in CatalogCoin.objects.values_list('pk', 'coin_id', 'symbol', 'name')
+        }
+        created = [
+            CatalogCoin(coin_id=coin_id, symbol=symbol, name=name, updated_at=now)
+            for coin_id, (symbol, name) in fresh.items()
+            if coin_id not in existing
+        ]
+        changed = [
+            CatalogCoin(pk=pk, coin_id=coin_id, symbol=fresh[coin_id][0], name=fresh[coin_id][1], updated_at=now)
+            for coin_id, (pk, symbol, name) in existing.items()
+            if coin_id in fresh and fresh[coin_id] != (symbol, name)
+        ]
+        removed = [pk for coin_id, (pk, _, _) in existing.items() if coin_id not in fresh]
+        CatalogCoin.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        CatalogCoin.objects.bulk_update(changed, ['symbol', 'name', 'updated_at'], batch_size=BATCH_SIZE)
+        for start in range(0, len(removed), BATCH_SIZE):
+            CatalogCoin.objects.filter(pk__in=removed[start:start + BATCH_SIZE]).delete()
+    return len(created), len(changed), len(removed)
+
+
+async def load_catalog():
+    """Fill the in-memory index from the local table, without any network call."""
+    catalog.load(await sync_to_async(load_catalog_rows)())
+    return len(catalog)
+
+
+async def refresh_catalog():
+    """Download `/coins/list`, store the difference locally and rebuild the index."""
+    coins = await client.coins_list()
+    result = await sync_to_async(sync_catalog)(coins)
+    catalog.load((coin['id'], coin.get('symbol') or '', coin.get('name') or '') for coin in coins)
+    return result
+
+
+catalog = CoinCatalog()
@@ -0,0 +1,122 @@
+import asyncio
+from collections import Counter
+
+import aiohttp
+from yarl import URL
+
+from .metrics import metrics
+
+API_URL = 'https://api.coingecko.com/api/v3'
+
+
+class CoinGeckoError(Exception):
+    def __init__(self, status, url):
+        super().__init__(f"CoinGecko responded {status} for {url}")
+        self.status = status
+        self.url = url
+
+
+class CoinNotFound(CoinGeckoError):
+    pass
+
+
+class CoinGeckoClient:
+    """Long-lived async client for the CoinGecko API.
+
+    One keep-alive `ClientSession` is reused for every request, at most
+    `max_concurrency` requests are on the wire at once, HTTP 429 responses are
+    retried after `Retry-After` (or an exponential backoff) and identical
+    in-flight URLs share a single request.
+    """
+
+    def __init__(self, base_url=API_URL, max_concurrency=4, max_retries=3, backoff=1.0, timeout=15):
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = Counter()
+        self._session = None
+        self._semaphore = None
+        self._inflight = {}
+
+    def _get_session(self):
+        # Created lazily so that the session and semaphore belong to the running loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency * 2, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _retry_delay(self, response, attempt):
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            return self.backoff * 2 ** attempt
+
+    async def _request(self, url):
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                self.stats['requests'] += 1
+                async with session.get(url) as response:
+                    if response.status == 404:
+                        raise CoinNotFound(response.status, url)
+                    if response.status != 429:
+                        if response.status >= 400:
+                            raise CoinGeckoError(response.status, url)
+                        return await response.json()
+                    self.stats['rate_limited'] += 1
+                    delay = self._retry_delay(response, attempt)
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        raise CoinGeckoError(429, url)
+
+    async def get_json(self, path, **params):
+        url = str(URL(self.base_url + path).with_query(params or None))
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._request(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        else:
+            self.stats['coalesced'] += 1
+        # shield: a cancelled caller must not cancel the request shared with others
+        return await asyncio.shield(task)
+
+    async def simple_price(self, coin_ids, vs_currencies='usd'):
+        return await self.get_json('/simple/price', ids=','.join(coin_ids), vs_currencies=vs_currencies)
+
+    async def coins_markets(self, coin_ids, vs_currency='usd', per_page=250, page=1):
+        return await self.get_json(
+            '/coins/markets', vs_currency=vs_currency, ids=','.join(coin_ids), per_page=per_page, page=page,
+        )
+
+    async def coins_list(self):
+        return await self.get_json('/coins/list')
+
+    async def coin_exists(self, coin_id):
+        try:
+            await self.get_json(
+                f'/coins/{coin_id}',
+                localization='false', tickers='false', market_data='false',
+                community_data='false', developer_data='false',
+            )
+        except CoinNotFound:
+            return False
+        return True
+
+
+client = CoinGeckoClient()
+
+metrics.collect('coingecko_requests_total', lambda: client.stats['requests'], 'counter')
+metrics.collect('coingecko_rate_limited_total', lambda: client.stats['rate_limited'], 'counter')
+metrics.collect('coingecko_coalesced_total', lambda: client.stats['coalesced'], 'counter')
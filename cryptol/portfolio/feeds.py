@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+from django.conf import settings
+
+from .metrics import metrics
+from .quotes import price_cache
+from .refresher import CHUNK_SIZE, chunked
+
+logger = logging.getLogger(__name__)
+
+
+class PriceBus:
+    """asyncio pub/sub for price updates: every subscriber gets each {coin_id: price} batch.
+
+    A slow subscriber never blocks the feed: updates queued for it are merged,
+    so it only ever sees the latest price of each coin.
+    """
+
+    def __init__(self):
+        self._queues = []
+        self._tasks = []
+
+    def publish(self, prices):
+        if not prices:
+            return
+        for queue in self._queues:
+            queue.put_nowait(dict(prices))
+
+    def subscribe(self, handler):
+        """Run `await handler(prices)` for every published batch, in a task of its own."""
+        queue = asyncio.Queue()
+        self._queues.append(queue)
+        task = asyncio.ensure_future(self._consume(queue, handler))
+        self._tasks.append(task)
+        return task
+
+    async def _consume(self, queue, handler):
+        while True:
+            prices = await queue.get()
+            while not queue.empty():
+                prices.update(queue.get_nowait())
+            try:
+                await handler(prices)
+            except Exception:
+                logger.exception("Price subscriber %r failed", handler)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queues.clear()
+        self._tasks.clear()
+
+
+class PriceFeed:
+    """Source of price updates for a set of coins, published to a PriceBus."""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.coins = set()
+
+    def set_coins(self, coin_ids):
+        self.coins = set(coin_ids)
+
+    async def run(self):
+        raise NotImplementedError
+
+
+class RestPollingFeed(PriceFeed):
+    """Polls CoinGecko `simple/price` every `interval` seconds and publishes coins that moved."""
+
+    def __init__(self, bus, interval=20, cache=price_cache):
+        super().__init__(bus)
+        self.interval = interval
+        self.cache = cache
+        self._last = {}
+
+    async def poll(self):
+        started = time.monotonic()
+        prices = {}
+        for chunk in chunked(sorted(self.coins), CHUNK_SIZE):
+            prices.update(await self.cache.refresh(chunk))
+        moved = {coin_id: price for coin_id, price in prices.items() if self._last.get(coin_id) != price}
+        self._last = prices
+        self.bus.publish(moved)
+        # the same series as the `prices` job, whichever of the two is refreshing
+        metrics.observe('price_refresh_seconds', time.monotonic() - started, source='feed')
+        return moved
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Cannot poll prices")
+            await asyncio.sleep(self.interval)
+
+
+class StreamingFeed(PriceFeed):
+    """WebSocket adapter for a streaming price relay.
+
+    Protocol: the client sends {"action": "subscribe" | "unsubscribe", "coins": [...]}
+    and the server pushes {"prices": {coin_id: price}} whenever a coin moves.
+    Subscriptions follow `set_coins`, and the connection is re-established
+    with an exponential backoff.
+    """
+
+    def __init__(self, bus, url, max_backoff=60):
+        super().__init__(bus)
+        self.url = url
+        self.max_backoff = max_backoff
+        self._ws = None
+        self._subscribed = set()
+
+    def set_coins(self, coin_ids):
+        super().set_coins(coin_ids)
+        if self._ws is not None and not self._ws.closed:
+            asyncio.ensure_future(self._sync_subscriptions()).add_done_callback(self._synced)
+
+    @staticmethod
+    def _synced(task):
+        # nobody awaits the sync started by set_coins, its errors would go unseen
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Cannot update price stream subscriptions: %s", task.exception())
+
+    async def _sync_subscriptions(self):
+        added = sorted(self.coins - self._subscribed)
+        removed = sorted(self._subscribed - self.coins)
+        # marked only once sent, so a failed message is retried by the next sync
+        if added:
+            await self._ws.send_json({'action': 'subscribe', 'coins': added})
+            self._subscribed.update(added)
+        if removed:
+            await self._ws.send_json({'action': 'unsubscribe', 'coins': removed})
+            self._subscribed.difference_update(removed)
+
+    async def listen(self, session):
+        async with session.ws_connect(self.url, heartbeat=30) as ws:
+            self._ws = ws
+            self._subscribed = set()
+            try:
+                await self._sync_subscriptions()
+                async for message in ws:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    prices = json.loads(message.data).get('prices', {})
+                    self.bus.publish({coin_id: price for coin_id, price in prices.items() if coin_id in self.coins})
+            finally:
+                self._ws = None
+
+    async def run(self):
+        backoff = 1
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    await self.listen(session)
+                    backoff = 1
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logger.warning("Price stream disconnected: %s", e)
+                    backoff = min(backoff * 2, self.max_backoff)
+                except Exception:
+                    # a malformed message must not end the feed, only this connection
+                    logger.exception("Price stream failed")
+                    backoff = min(backoff * 2, self.max_backoff)
+                await asyncio.sleep(backoff)
+
+
+def make_feed(bus):
+    """Price feed selected by settings.PRICE_FEED: 'rest' (default) or 'stream'."""
+    if settings.PRICE_FEED == 'stream':
+        return StreamingFeed(bus, settings.PRICE_FEED_URL)
+    return RestPollingFeed(bus, interval=settings.PRICE_FEED_INTERVAL)
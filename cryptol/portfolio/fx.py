@@ -0,0 +1,82 @@
+import time
+from decimal import Decimal
+
+from .coingecko import client
+from .models import TelegramUser
+
+BASE_CURRENCY = 'usd'
+# Every coin is priced in every currency, so one coin's prices give all the cross rates
+REFERENCE_COIN = 'bitcoin'
+
+# fiat only: valuations are rounded to cents, which would zero out amounts shown in BTC or ETH
+CURRENCY_SYMBOLS = {
+    'usd': '$',
+    'eur': '€',
+    'gbp': '£',
+    'rub': '₽',
+    'uah': '₴',
+    'kzt': '₸',
+    'byn': 'Br',
+    'cny': '¥',
+    'jpy': '¥',
+    'try': '₺',
+}
+
+
+def currency_symbol(currency):
+    return CURRENCY_SYMBOLS.get(currency, currency.upper() + ' ')
+
+
+async def fetch_reference_prices(currencies):
+    """Prices of REFERENCE_COIN in several currencies with a single `simple/price` request."""
+    data = await client.simple_price([REFERENCE_COIN], ','.join(currencies))
+    return data.get(REFERENCE_COIN, {})
+
+
+def display_currencies():
+    """Currencies users have picked for display, in one DISTINCT query."""
+    rows = TelegramUser.objects.filter(currency__in=CURRENCY_SYMBOLS).values_list('currency', flat=True)
+    return set(rows.distinct())
+
+
+class FxRates:
+    """Cached matrix of cross rates between display currencies.
+
+    All rates come from one reference-coin request covering every known
+    currency; the matrix is reused for `ttl` seconds, so converting a
+    portfolio never needs a network call of its own.
+    """
+
+    def __init__(self, fetcher=fetch_reference_prices, ttl=300, clock=time.monotonic):
+        self._fetcher = fetcher
+        self._clock = clock
+        self._prices = {}  # currency -> price of the reference coin
+        self._fetched_at = None
+        self.currencies = {BASE_CURRENCY}
+        self.ttl = ttl
+
+    def _fresh(self):
+        return self._fetched_at is not None and self._clock() - self._fetched_at < self.ttl
+
+    async def refresh(self, currencies=()):
+        """Fetch the reference coin in all known currencies plus `currencies`."""
+        self.currencies |= set(currencies)
+        prices = await self._fetcher(sorted(self.currencies))
+        self._prices = {currency: Decimal(str(price)) for currency, price in prices.items() if price}
+        self._fetched_at = self._clock()
+        # currencies CoinGecko does not know are not asked for again
+        self.currencies = set(self._prices) | {BASE_CURRENCY}
+        return self._prices
+
+    async def rate(self, quote, base=BASE_CURRENCY):
+        """How many `quote` units one `base` unit buys, or None for an unknown currency."""
+        if quote == base:
+            return Decimal(1)
+        if not self._fresh() or quote not in self._prices or base not in self._prices:
+            await self.refresh([quote, base])
+        if quote not in self._prices or base not in self._prices:
+            return None
+        return self._prices[quote] / self._prices[base]
+
+
+fx_rates = FxRates()
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import PriceCandle, PricePoint
+
+BATCH_SIZE = 500
+
+RESOLUTIONS = {
+    '1m': timedelta(minutes=1),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+# How long rows are kept; daily candles are kept forever
+RAW_RETENTION = timedelta(days=2)
+CANDLE_RETENTION = {
+    '1m': timedelta(days=7),
+    '1h': timedelta(days=365),
+}
+
+
+def bucket_start(at, step):
+    seconds = at.timestamp()
+    return datetime.fromtimestamp(seconds - seconds % step.total_seconds(), tz=dt_timezone.utc)
+
+
+def append_prices(prices, at=None):
+    """Append one tick of {coin_id: price} and fold it into the 1m/1h/1d candles.
+
+    Ticks are appended in time order, so a candle only ever needs its
+    high/low/close adjusted: a few bulk queries per resolution, however many
+    coins are in the tick.
+    """
+    at = at or timezone.now()
+    prices = {coin_id: Decimal(str(price)) for coin_id, price in prices.items()}
+    with transaction.atomic():
+        PricePoint.objects.bulk_create(
+            [PricePoint(coin_id=coin_id, date=at, price=price) for coin_id, price in prices.items()],
+            batch_size=BATCH_SIZE,
+        )
+        for resolution, step in RESOLUTIONS.items():
+            start = bucket_start(at, step)
+            candles = PriceCandle.objects.filter(resolution=resolution, start=start, coin_id__in=list(prices))
+            existing = {candle.coin_id: candle for candle in candles}
+            created = []
+            for coin_id, price in prices.items():
+                candle = existing.get(coin_id)
+                if candle is None:
+                    created.append(PriceCandle(
+                        coin_id=coin_id, resolution=resolution, start=start,
+                        open=price, high=price, low=price, close=price,
+                    ))
+                else:
+                    candle.high = max(candle.high, price)
+                    candle.low = min(candle.low, price)
+                    candle.close = price
+            PriceCandle.objects.bulk_update(existing.values(), ['high', 'low', 'close'], batch_size=BATCH_SIZE)
+            PriceCandle.objects.bulk_create(created, batch_size=BATCH_SIZE)
+
+
+def prune_history(now=None):
+    """Delete raw ticks and fine candles past their retention; returns rows deleted."""
+    now = now or timezone.now()
+    deleted, _ = PricePoint.objects.filter(date__lt=now - RAW_RETENTION).delete()
+    for resolution, retention in CANDLE_RETENTION.items():
+        count, _ = PriceCandle.objects.filter(resolution=resolution, start__lt=now - retention).delete()
+        deleted += count
+    return deleted
+
+
+def price_series(coin_id, start, end=None, resolution=None):
+    """(date, price) pairs for one coin, oldest first, read through the (coin_id, date) index.
+
+    Without `resolution` raw ticks are returned, otherwise candle close prices.
+    """
+    end = end or timezone.now()
+    if resolution is None:
+        rows = PricePoint.objects.filter(coin_id=coin_id, date__gte=start, date__lte=end).order_by('date')
+        return list(rows.values_list('date', 'price'))
+    # candles that began before `start` but still cover it are included
+    rows = PriceCandle.objects.filter(
+        coin_id=coin_id, resolution=resolution, start__gt=start - RESOLUTIONS[resolution], start__lte=end,
+    ).order_by('start')
+    return list(rows.values_list('start', 'close'))
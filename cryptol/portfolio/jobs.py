@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Awaitable, Callable, Optional
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+
+from .history import prune_history
+from .leases import acquire_lease, claim_slot
+from .metrics import metrics
+from .models import Lease
+from .refresher import refresh_prices
+from .snapshots import take_snapshots
+
+logger = logging.getLogger(__name__)
+
+PRICE_INTERVAL = 60
+# held by whoever refreshes prices: the bot leader running its price feed, or the `prices` job
+PRICE_LEASE = 'price-refresher'
+SNAPSHOT_INTERVAL = 15 * 60
+CLEANUP_INTERVAL = 60 * 60
+
+
+@dataclass
+class Job:
+    name: str
+    func: Callable[[], Awaitable]
+    interval: float
+    jitter: float = 0.1
+    timeout: Optional[float] = None
+    # a leader lease shared with a long-running worker; the job is skipped while someone else holds it
+    lease: Optional[str] = None
+
+    @property
+    def run_timeout(self):
+        # half the slot by default: work handed to a thread by sync_to_async keeps running
+        # after the cancel, the rest of the slot gives it time to finish
+        return self.timeout or self.interval * (1 - self.jitter) / 2
+
+    @property
+    def slot_ttl(self):
+        # a little shorter than the earliest next run, so the next attempt finds the slot free,
+        # and at least twice the timeout, so a cancelled run is over before anyone starts another
+        return max(self.interval * (1 - self.jitter), 2 * self.run_timeout)
+
+    @property
+    def lease_ttl(self):
+        # kept until after the latest next run, so leadership is not lost between runs
+        return self.interval * (1 + self.jitter) + self.run_timeout
+
+
+async def run_job(job):
+    """Run `job` unless another worker claimed it in the current interval or holds its lease.
+
+    Returns 'ok', 'error', 'timeout' or 'skipped'.
+    """
+    try:
+        claimed = await sync_to_async(claim_slot)(f'job:{job.name}', job.slot_ttl)
+        if claimed and job.lease:
+            claimed = await sync_to_async(acquire_lease)(job.lease, ttl=job.lease_ttl)
+    except Exception:
+        logger.exception("cannot claim job name=%s", job.name)
+        claimed = None
+    if not claimed:
+        result = 'skipped' if claimed is False else 'error'
+        metrics.inc('job_runs_total', job=job.name, result=result)
+        return result
+    started = time.perf_counter()
+    try:
+        summary = await asyncio.wait_for(job.func(), job.run_timeout)
+    except asyncio.TimeoutError:
+        result, summary = 'timeout', None
+        logger.warning("job timed out name=%s seconds=%.3f", job.name, time.perf_counter() - started)
+    except Exception:
+        result, summary = 'error', None
+        logger.exception("job failed name=%s", job.name)
+    else:
+        result = 'ok'
+    elapsed = time.perf_counter() - started
+    metrics.inc('job_runs_total', job=job.name, result=result)
+    metrics.observe('job_seconds', elapsed, job=job.name)
+    if result == 'ok':
+        logger.info("job finished name=%s seconds=%.3f %s", job.name, elapsed, summary or '')
+    return result
+
+
+class JobRunner:
+    """Runs jobs forever, each every `interval` seconds give or take `jitter`.
+
+    Runs are claimed through leases, so any number of runners (and the bot's
+    leader loop) can run side by side without doing the same work twice.
+    """
+
+    def __init__(self, jobs, clock=time.monotonic, rng=random):
+        self.jobs = list(jobs)
+        self._clock = clock
+        self._rng = rng
+        self._next = {}
+
+    def schedule(self, job, first=False):
+        spread = job.interval * job.jitter
+        # first runs are spread out so that restarted workers do not hit the API together
+        delay = self._rng.uniform(0, spread) if first else job.interval + self._rng.uniform(-spread, spread)
+        self._next[job.name] = self._clock() + delay
+        return self._next[job.name]
+
+    def next_job(self):
+        return min(self.jobs, key=lambda job: self._next[job.name])
+
+    async def run(self):
+        for job in self.jobs:
+            self.schedule(job, first=True)
+        while True:
+            job = self.next_job()
+            delay = self._next[job.name] - self._clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await run_job(job)
+            self.schedule(job)
+
+
+async def refresh_tracked_prices():
+    """Market prices for held coins and coins with pending alerts, through the refresher."""
+    result = await refresh_prices()
+    return f"coins={result.coins} rows={result.rows}"
+
+
+async def snapshot_portfolios():
+    return f"portfolios={await sync_to_async(take_snapshots)()}"
+
+
+def cleanup():
+    pruned = prune_history()
+    leases, _ = Lease.objects.filter(expires_at__lt=timezone.now() - timedelta(days=1)).delete()
+    return f"history_rows={pruned} leases={leases}"
+
+
+async def cleanup_job():
+    return await sync_to_async(cleanup)()
+
+
+PRICES = Job('prices', refresh_tracked_prices, PRICE_INTERVAL, lease=PRICE_LEASE)
+SNAPSHOTS = Job('snapshots', snapshot_portfolios, SNAPSHOT_INTERVAL)
+CLEANUP = Job('cleanup', cleanup_job, CLEANUP_INTERVAL)
+JOBS = [PRICES, SNAPSHOTS, CLEANUP]
@@ -0,0 +1,59 @@
+import os
+import socket
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Lease
+
+
+def process_holder():
+    """Identifies this process among all bot and job workers (evaluated after fork)."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire_lease(name, holder=None, ttl=60):
+    """Take or renew the named lease; True if `holder` owns it for the next `ttl` seconds.
+
+    Used for leader election: only the process holding the lease runs the job,
+    the others take over once it stops renewing and the lease expires.
+    """
+    holder = holder or process_holder()
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+    taken = Lease.objects.filter(name=name).filter(Q(holder=holder) | Q(expires_at__lte=now)).update(
+        holder=holder, expires_at=expires_at,
+    )
+    if taken:
+        return True
+    return _create_lease(name, holder, expires_at)
+
+
+def claim_slot(name, ttl, holder=None):
+    """Take the named lease only if nobody holds it, this process included.
+
+    Scheduled jobs use it as a "ran recently" marker shared by every worker:
+    whoever claims the slot runs the job and nobody runs it again until `ttl`
+    seconds have passed.
+    """
+    holder = holder or process_holder()
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=ttl)
+    if Lease.objects.filter(name=name, expires_at__lte=now).update(holder=holder, expires_at=expires_at):
+        return True
+    return _create_lease(name, holder, expires_at)
+
+
+def _create_lease(name, holder, expires_at):
+    try:
+        with transaction.atomic():
+            Lease.objects.create(name=name, holder=holder, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    return True
+
+
+def release_lease(name, holder=None):
+    Lease.objects.filter(name=name, holder=holder or process_holder()).delete()
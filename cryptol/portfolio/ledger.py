@@ -0,0 +1,98 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+
+from .models import CoinHistory, Portfolio, Trade, UserCoin
+
+PRICE_PLACES = Decimal('0.00000001')
+# UserCoin and Trade keep quantities in DecimalField(max_digits=18, decimal_places=8)
+MIN_QUANTITY = PRICE_PLACES
+MAX_QUANTITY = Decimal('1e10')
+
+
+class InsufficientQuantity(Exception):
+    pass
+
+
+class QuantityTooLarge(Exception):
+    """The holding would reach MAX_QUANTITY, more than its column can store."""
+
+
+def bump_version(portfolio):
+    """Mark the holdings of `portfolio` as changed, so cached valuations are not reused."""
+    Portfolio.objects.filter(pk=portfolio.pk).update(version=F('version') + 1)
+
+
+def record_buy(portfolio, coin_id, price, quantity):
+    """Add a purchase to the holding and the ledger in one transaction.
+
+    The holding row is locked while its average price is recomputed from the
+    previous average, so concurrent buys of the same coin cannot lose updates.
+    Raises QuantityTooLarge if the holding would reach MAX_QUANTITY.
+    """
+    price = Decimal(str(price))
+    quantity = Decimal(str(quantity))
+    if quantity <= 0:
+        raise ValueError("Quantity must be positive")
+    if quantity >= MAX_QUANTITY:
+        raise QuantityTooLarge(coin_id)
+    with transaction.atomic():
+        user_coin, created = UserCoin.objects.select_for_update().get_or_create(
+            portfolio=portfolio,
+            coin_id=coin_id,
+            defaults={'price': price, 'purchase_price': price, 'quantity': quantity},
+        )
+        if not created:
+            old_quantity = user_coin.quantity or 0
+            total_quantity = old_quantity + quantity
+            if total_quantity >= MAX_QUANTITY:
+                raise QuantityTooLarge(coin_id)
+            user_coin.price = ((user_coin.price * old_quantity + price * quantity) / total_quantity).quantize(PRICE_PLACES)
+            user_coin.quantity = total_quantity
+            user_coin.save(update_fields=['price', 'quantity'])
+        Trade.objects.create(portfolio=portfolio, coin_id=coin_id, side=Trade.BUY, quantity=quantity, price=price)
+        CoinHistory.objects.create(user_coin=user_coin, price=price)
+        bump_version(portfolio)
+    return user_coin
+
+
+def record_sell(portfolio, coin_id, quantity, price=None):
+    """Take `quantity` off the holding with a conditional UPDATE and log the sale.
+
+    Raises UserCoin.DoesNotExist if the coin is not held and InsufficientQuantity
+    if less than `quantity` is held.
+    """
+    quantity = Decimal(str(quantity))
+    if quantity <= 0:
+        raise ValueError("Quantity must be positive")
+    with transaction.atomic():
+        holding = UserCoin.objects.filter(portfolio=portfolio, coin_id=coin_id)
+        if not holding.filter(quantity__gte=quantity).update(quantity=F('quantity') - quantity):
+            if holding.exists():
+                raise InsufficientQuantity(coin_id)
+            raise UserCoin.DoesNotExist(coin_id)
+        Trade.objects.create(
+            portfolio=portfolio,
+            coin_id=coin_id,
+            side=Trade.SELL,
+            quantity=quantity,
+            price=None if price is None else Decimal(str(price)),
+        )
+        bump_version(portfolio)
+
+
+def clear_holdings(portfolio):
+    """Delete every holding of the portfolio, closing each in the ledger with an unpriced sale.
+
+    Lots are rebuilt from the ledger, so without the closing trades the
+    cleared coins would still count as open positions.
+    """
+    with transaction.atomic():
+        holdings = UserCoin.objects.select_for_update().filter(portfolio=portfolio)
+        Trade.objects.bulk_create([
+            Trade(portfolio=portfolio, coin_id=coin_id, side=Trade.SELL, quantity=quantity)
+            for coin_id, quantity in holdings.filter(quantity__gt=0).values_list('coin_id', 'quantity')
+        ])
+        holdings.delete()
+        bump_version(portfolio)
@@ -0,0 +1,251 @@
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from portfolio.models import CatalogCoin, CoinPrice, Portfolio, TelegramUser, UserCoin
+
+BATCH_SIZE = 500
+
+# Cold starts timed in fresh interpreters: a non-bot entry point and building the bot
+STARTUP_SCRIPTS = {
+    'startup_manage_check': [os.path.join(settings.BASE_DIR, 'manage.py'), 'check'],
+    'startup_bot': ['-c', 'from bot.bot import create_dispatcher; create_dispatcher("1:benchmark")'],
+}
+
+
+class QueryCounter:
+    """Execute wrapper counting the queries of every connection it is installed on."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class MockApi:
+    """Local stand-in for CoinGecko `simple/price` and the Telegram Bot API.
+
+    Prices drift a little on every request, so each price cycle has work to do.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.tick = 0
+        self.app = web.Application()
+        self.app.router.add_get('/coingecko/simple/price', self.simple_price)
+        self.app.router.add_post(r'/telegram/bot{token}/{method}', self.telegram)
+
+    async def simple_price(self, request):
+        self.calls['coingecko'] += 1
+        self.tick += 1
+        currencies = request.query['vs_currencies'].split(',')
+        return web.json_response({
+            coin_id: {currency: round(100 + index % 1000 + self.tick * 0.01, 2) for currency in currencies}
+            for index, coin_id in enumerate(request.query['ids'].split(','))
+        })
+
+    async def telegram(self, request):
+        method = request.match_info['method']
+        self.calls['telegram'] += 1
+        if method.lower() != 'sendmessage':
+            return web.json_response({'ok': True, 'result': True})
+        data = await request.post()
+        chat_id = int(data['chat_id'])
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self.calls['telegram'],
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': data.get('text', ''),
+        }})
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def seed(users, coins, holdings):
+    """N users with `holdings` coins each out of M catalog coins, with stored prices."""
+    coin_ids = [f'coin-{index:05d}' for index in range(coins)]
+    CatalogCoin.objects.bulk_create(
+        [CatalogCoin(coin_id=coin_id, symbol=coin_id[-3:], name=coin_id.title()) for coin_id in coin_ids],
+        batch_size=BATCH_SIZE,
+    )
+    CoinPrice.objects.bulk_create([CoinPrice(coin_id=coin_id, price=100) for coin_id in coin_ids], batch_size=BATCH_SIZE)
+    telegram_ids = [1000 + index for index in range(users)]
+    User.objects.bulk_create([User(username=str(telegram_id)) for telegram_id in telegram_ids], batch_size=BATCH_SIZE)
+    auth_users = User.objects.filter(username__in=[str(telegram_id) for telegram_id in telegram_ids])
+    TelegramUser.objects.bulk_create(
+        [TelegramUser(user=user, telegram_id=int(user.username)) for user in auth_users],
+        batch_size=BATCH_SIZE,
+    )
+    Portfolio.objects.bulk_create([Portfolio(user=user) for user in auth_users], batch_size=BATCH_SIZE)
+    rng = random.Random(0)
+    rows = []
+    held = {}
+    for portfolio_id, username in Portfolio.objects.values_list('pk', 'user__username'):
+        held[int(username)] = rng.sample(coin_ids, min(holdings, coins))
+        rows += [
+            UserCoin(portfolio_id=portfolio_id, coin_id=coin_id, quantity=10, price=90, purchase_price=90)
+            for coin_id in held[int(username)]
+        ]
+    UserCoin.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return coin_ids, held
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a temporary database, serve CoinGecko and Telegram from a local mock and "
+        "report latency, query and HTTP call counts of the bot's hot paths."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--coins', type=int, default=1000)
+        parser.add_argument('--holdings', type=int, default=10, help="Coins held by each user.")
+        parser.add_argument('--iterations', type=int, default=200, help="Updates sent per command.")
+        parser.add_argument('--cycles', type=int, default=10, help="Price pipeline cycles to run.")
+        parser.add_argument('--startups', type=int, default=3, help="Cold starts timed per entry point.")
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = path
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            coin_ids, held = seed(options['users'], options['coins'], options['holdings'])
+            counter = QueryCounter()
+            counter.install(connection=connection)
+            connection_created.connect(counter.install)
+            try:
+                results = asyncio.run(self.run(counter, coin_ids, held, options))
+            finally:
+                connection_created.disconnect(counter.install)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        results.update(self.time_startups(options['startups']))
+        self.report(results)
+
+    def time_startups(self, count):
+        results = {}
+        for name, args in STARTUP_SCRIPTS.items():
+            latency = []
+            for _ in range(count):
+                started = time.perf_counter()
+                subprocess.run([sys.executable, *args], cwd=settings.BASE_DIR, check=True, capture_output=True)
+                latency.append(time.perf_counter() - started)
+            if latency:
+                results[name] = {'latency': latency, 'queries': [0] * count, 'http': [0] * count}
+        return results
+
+    async def run(self, counter, coin_ids, held, options):
+        from aiogram import Bot, Dispatcher, types
+        from aiogram.bot.api import TelegramAPIServer
+
+        from bot import bot as bot_module
+        from portfolio.catalog import load_catalog
+        from portfolio.coingecko import client
+        from portfolio.feeds import RestPollingFeed
+        from portfolio.refresher import tracked_coin_ids
+        from portfolio.sender import SendQueue
+
+        mock = MockApi()
+        results = defaultdict(lambda: {'latency': [], 'queries': [], 'http': []})
+
+        async def measure(name, coroutine):
+            queries, calls, started = counter.count, sum(mock.calls.values()), time.perf_counter()
+            await coroutine
+            result = results[name]
+            result['latency'].append(time.perf_counter() - started)
+            result['queries'].append(counter.count - queries)
+            result['http'].append(sum(mock.calls.values()) - calls)
+
+        update_ids = iter(range(1, 10 ** 9))
+
+        def update(telegram_id, text):
+            return types.Update(update_id=next(update_ids), message={
+                'message_id': next(update_ids),
+                'date': int(time.time()),
+                'chat': {'id': telegram_id, 'type': 'private'},
+                'from': {'id': telegram_id, 'is_bot': False, 'first_name': 'Bench'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+                if text.startswith('/') else [],
+            })
+
+        async with TestServer(mock.app) as server:
+            # measure the handlers, not the per-user throttling
+            with override_settings(BOT_THROTTLE_RATE=10 ** 6, BOT_THROTTLE_BURST=10 ** 6, BOT_MAX_IN_FLIGHT=10 ** 6):
+                dp = bot_module.create_dispatcher('1:benchmark')
+            bot = dp.bot
+            bot.server = TelegramAPIServer.from_base(str(server.make_url('/telegram')))
+            client.base_url = str(server.make_url('/coingecko'))
+            # measure the handlers, not Telegram's rate limits
+            bot_module.sender = SendQueue(bot, rate=10 ** 6, chat_rate=10 ** 6, chat_burst=10 ** 6)
+            bot_module.sender.start()
+            Bot.set_current(bot)
+            Dispatcher.set_current(dp)
+            await load_catalog()
+
+            # process_updates runs every update in a task of its own, as polling does,
+            # so state cached in context variables does not leak between updates
+            rng = random.Random(1)
+            telegram_ids = sorted(held)
+            for _ in range(options['iterations']):
+                telegram_id = rng.choice(telegram_ids)
+                await measure('cmd_portfolio', dp.process_updates([update(telegram_id, '/portfolio')]))
+                await measure('cmd_add', dp.process_updates([update(telegram_id, f'/add {rng.choice(coin_ids)}')]))
+                await measure('process_quantity', dp.process_updates([update(telegram_id, '1.5')]))
+                await measure('cmd_sell', dp.process_updates([update(telegram_id, f'/sell {held[telegram_id][0]}')]))
+                await measure('process_sell_quantity', dp.process_updates([update(telegram_id, '0.001')]))
+
+            # one cycle of update_coin_prices_async: poll the feed and run its subscribers
+            feed = RestPollingFeed(bot_module.price_bus, interval=0)
+
+            async def price_cycle():
+                feed.set_coins(await sync_to_async(tracked_coin_ids)())
+                moved = await feed.poll()
+                await bot_module.record_prices(moved)
+                await bot_module.check_alerts(moved)
+
+            for _ in range(options['cycles']):
+                await measure('price_cycle', price_cycle())
+
+            await bot_module.sender.close()
+            await client.close()
+            await bot.session.close()
+            await dp.storage.close()
+            await sync_to_async(connections.close_all)()
+        return results
+
+    def report(self, results):
+        self.stdout.write(f"{'command':<24}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}{'queries':>10}{'http':>8}")
+        for name, result in results.items():
+            latency = result['latency']
+            self.stdout.write(
+                f"{name:<24}{len(latency):>6}"
+                f"{percentile(latency, 0.5) * 1000:>10.1f}{percentile(latency, 0.99) * 1000:>10.1f}"
+                f"{sum(result['queries']) / len(latency):>10.1f}{sum(result['http']) / len(latency):>8.2f}"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.models import Portfolio
+from portfolio.transfer import export_trades
+
+
+class Command(BaseCommand):
+    help = "Stream a user's trade ledger as CSV or JSON, to a file or stdout."
+
+    def add_arguments(self, parser):
+        parser.add_argument('telegram_id', type=int)
+        parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+        parser.add_argument('--output', help="Defaults to stdout.")
+
+    def handle(self, *args, **options):
+        try:
+            portfolio = Portfolio.objects.get(user__telegramuser__telegram_id=options['telegram_id'])
+        except Portfolio.DoesNotExist:
+            raise CommandError(f"No portfolio for Telegram user {options['telegram_id']}.")
+        chunks = export_trades(portfolio, options['format'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
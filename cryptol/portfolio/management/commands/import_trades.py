@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio.models import Portfolio, TelegramUser
+from portfolio.transfer import TradeImportError, import_trades, read_records
+
+
+class Command(BaseCommand):
+    help = "Import a CSV or JSON trade file (coin_id, side, quantity, price, date) into a user's portfolio."
+
+    def add_arguments(self, parser):
+        parser.add_argument('telegram_id', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'json'], help="Defaults to the file extension.")
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if fmt not in ('csv', 'json'):
+            raise CommandError("Cannot tell the file format, pass --format csv or --format json.")
+        try:
+            telegram_user = TelegramUser.objects.select_related('user').get(telegram_id=options['telegram_id'])
+        except TelegramUser.DoesNotExist:
+            raise CommandError(f"Unknown Telegram user {options['telegram_id']}.")
+        portfolio, _ = Portfolio.objects.get_or_create(user=telegram_user.user)
+        with open(options['path'], encoding='utf-8-sig', newline='') as stream:
+            try:
+                result = import_trades(portfolio, read_records(stream, fmt))
+            except TradeImportError as e:
+                raise CommandError("Nothing imported:\n" + "\n".join(f"record {line}: {error}" for line, error in e.errors))
+            except ValueError as e:
+                raise CommandError(f"Cannot read {options['path']}: {e}")
+        self.stdout.write(f"Imported {result.trades} trades in {result.coins} coins ({result.created} new holdings).")
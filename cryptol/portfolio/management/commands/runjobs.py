@@ -0,0 +1,37 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand
+
+from portfolio.coingecko import client
+from portfolio.jobs import JOBS, JobRunner, run_job
+from portfolio.leases import release_lease
+
+
+class Command(BaseCommand):
+    help = "Run the scheduled jobs (price refresh, portfolio snapshots, cleanup) in this process."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--job', action='append', choices=[job.name for job in JOBS], dest='jobs',
+            help="Only run this job; may be repeated.",
+        )
+        parser.add_argument('--once', action='store_true', help="Run each job once and exit.")
+
+    def handle(self, *args, **options):
+        jobs = [job for job in JOBS if not options['jobs'] or job.name in options['jobs']]
+        asyncio.run(self.run(jobs, options['once']))
+
+    async def run(self, jobs, once):
+        try:
+            if once:
+                for job in jobs:
+                    self.stdout.write(f"{job.name}: {await run_job(job)}")
+            else:
+                await JobRunner(jobs).run()
+        finally:
+            # hand leader leases (the price refresh) back to the bot right away
+            for job in jobs:
+                if job.lease:
+                    await sync_to_async(release_lease)(job.lease)
+            await client.close()
@@ -0,0 +1,104 @@
+import contextvars
+from bisect import bisect_left
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Query counter of the update being handled; sync_to_async copies it into its thread
+current_queries = contextvars.ContextVar('current_queries', default=None)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, labels, value):
+    if labels:
+        name += '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+    return f'{name} {value:g}' if isinstance(value, float) else f'{name} {value}'
+
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format.
+
+    Collectors are callables returning a value, or {labels: value} with
+    labels as ((name, value), ...) tuples; they read counters other modules
+    keep anyway (client stats, queue depth) at scrape time.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(int)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = {}  # name -> (type, callback)
+
+    def inc(self, name, value=1, **labels):
+        self._counters[name, _labels(labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = name, _labels(labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        index = bisect_left(LATENCY_BUCKETS, value)
+        if index < len(LATENCY_BUCKETS):
+            histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self, name, callback, kind='gauge'):
+        self._collectors[name] = (kind, callback)
+
+    def value(self, name, **labels):
+        return self._counters.get((name, _labels(labels)), 0)
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(self._counters.items()):
+            declare(name, 'counter')
+            lines.append(_format(name, labels, value))
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append(_format(f'{name}_bucket', labels + (('le', bound),), cumulative))
+            lines.append(_format(f'{name}_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+            lines.append(_format(f'{name}_sum', labels, histogram[-2]))
+            lines.append(_format(f'{name}_count', labels, histogram[-1]))
+        for name, (kind, callback) in sorted(self._collectors.items()):
+            declare(name, kind)
+            values = callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for labels, value in sorted(values.items()):
+                lines.append(_format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class QueryCount:
+    def __init__(self):
+        self.count = 0
+
+
+def count_queries(execute, sql, params, many, context):
+    counter = current_queries.get()
+    if counter is not None:
+        counter.count += 1
+    metrics.inc('db_queries_total')
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """connection_created receiver: count the queries of every new connection."""
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+metrics = Metrics()
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:18
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0006_usercoin_purchase_price'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200, unique=True)),
+                ('price', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0007_coinprice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogCoin',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200, unique=True)),
+                ('symbol', models.CharField(max_length=100)),
+                ('name', models.CharField(max_length=200)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0009_auto_20261018_0821'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceCandle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200)),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('start', models.DateTimeField()),
+                ('open', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('high', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('low', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('close', models.DecimalField(decimal_places=8, max_digits=18)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PricePoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('price', models.DecimalField(decimal_places=8, max_digits=18)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='coinhistory',
+            index=models.Index(fields=['user_coin', 'date'], name='coin_history_coin_date'),
+        ),
+        migrations.AddIndex(
+            model_name='pricepoint',
+            index=models.Index(fields=['coin_id', 'date'], name='price_point_coin_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='pricecandle',
+            constraint=models.UniqueConstraint(fields=('coin_id', 'resolution', 'start'), name='unique_price_candle'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0010_auto_20261018_0823'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('value', models.DecimalField(decimal_places=2, max_digits=24)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=24)),
+                ('assets', models.JSONField(default=dict)),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfolio.portfolio')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='portfoliosnapshot',
+            index=models.Index(fields=['portfolio', 'taken_at'], name='snapshot_portfolio_taken_at'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0011_auto_20261018_0824'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='telegramuser',
+            name='telegram_id',
+            field=models.BigIntegerField(unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='usercoin',
+            index=models.Index(fields=['portfolio', 'coin_id'], name='user_coin_portfolio_coin'),
+        ),
+    ]
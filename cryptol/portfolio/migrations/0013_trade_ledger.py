@@ -0,0 +1,59 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def merge_duplicate_coins(apps, schema_editor):
+    """Fold duplicate (portfolio, coin_id) holdings into one row and open the ledger with them."""
+    UserCoin = apps.get_model('portfolio', 'UserCoin')
+    CoinHistory = apps.get_model('portfolio', 'CoinHistory')
+    Trade = apps.get_model('portfolio', 'Trade')
+    kept = {}
+    for coin in UserCoin.objects.order_by('pk'):
+        key = (coin.portfolio_id, coin.coin_id)
+        first = kept.get(key)
+        if first is None:
+            kept[key] = coin
+            continue
+        quantity = (first.quantity or 0) + (coin.quantity or 0)
+        if quantity:
+            first.price = (first.price * (first.quantity or 0) + coin.price * (coin.quantity or 0)) / quantity
+        first.quantity = quantity
+        first.save()
+        CoinHistory.objects.filter(user_coin=coin).update(user_coin=first)
+        coin.delete()
+    Trade.objects.bulk_create([
+        Trade(portfolio_id=coin.portfolio_id, coin_id=coin.coin_id, side='buy',
+              quantity=coin.quantity, price=coin.price, created_at=coin.created_at)
+        for coin in kept.values()
+        if coin.quantity
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0012_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200)),
+                ('side', models.CharField(choices=[('buy', 'Buy'), ('sell', 'Sell')], max_length=4)),
+                ('quantity', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('price', models.DecimalField(blank=True, decimal_places=8, max_digits=18, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='portfolio',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfolio.portfolio'),
+        ),
+        migrations.RunPython(merge_duplicate_coins, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # kept apart from the data step of 0013: PostgreSQL refuses to ALTER a table
+    # with pending trigger events in the same transaction
+
+    dependencies = [
+        ('portfolio', '0013_trade_ledger'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='usercoin',
+            name='user_coin_portfolio_coin',
+        ),
+        migrations.AddConstraint(
+            model_name='usercoin',
+            constraint=models.UniqueConstraint(fields=('portfolio', 'coin_id'), name='unique_user_coin'),
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['portfolio', 'coin_id', 'created_at'], name='trade_portfolio_coin_date'),
+        ),
+    ]
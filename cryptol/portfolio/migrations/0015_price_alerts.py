@@ -0,0 +1,31 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0014_unique_user_coin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin_id', models.CharField(max_length=200)),
+                ('direction', models.CharField(choices=[('above', 'Above'), ('below', 'Below')], max_length=5)),
+                ('threshold', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('triggered_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='portfolio.telegramuser')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pricealert',
+            index=models.Index(fields=['triggered_at', 'id'], name='price_alert_pending'),
+        ),
+    ]
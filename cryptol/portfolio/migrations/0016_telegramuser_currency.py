@@ -0,0 +1,18 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0015_price_alerts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramuser',
+            name='currency',
+            field=models.CharField(default='usd', max_length=10),
+        ),
+    ]
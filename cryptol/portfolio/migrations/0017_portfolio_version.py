@@ -0,0 +1,18 @@
+# Generated by Django 3.2.5 on 2026-10-18 08:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio', '0016_telegramuser_currency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfolio',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
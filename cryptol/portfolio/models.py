@@ -5,10 +5,13 @@ from django.utils import timezone
 
 class TelegramUser(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    telegram_id = models.IntegerField(unique=True)
+    telegram_id = models.BigIntegerField(unique=True)
+    currency = models.CharField(max_length=10, default='usd')
 
 class Portfolio(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
+    # bumped on every change of the holdings; part of the cached valuation key
+    version = models.PositiveIntegerField(default=0)
 
 class UserCoin(models.Model):
     portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
@@ -18,7 +21,118 @@ class UserCoin(models.Model):
     quantity = models.DecimalField(max_digits=18, decimal_places=8, null=True, blank=True)
     created_at = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['portfolio', 'coin_id'], name='unique_user_coin'),
+        ]
+
 class CoinHistory(models.Model):
     user_coin = models.ForeignKey(UserCoin, on_delete=models.CASCADE)
     date = models.DateTimeField(auto_now_add=True)
     price = models.DecimalField(max_digits=18, decimal_places=8)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_coin', 'date'], name='coin_history_coin_date'),
+        ]
+
+class CoinPrice(models.Model):
+    coin_id = models.CharField(max_length=200, unique=True)
+    price = models.DecimalField(max_digits=18, decimal_places=8)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+class CatalogCoin(models.Model):
+    coin_id = models.CharField(max_length=200, unique=True)
+    symbol = models.CharField(max_length=100)
+    name = models.CharField(max_length=200)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+class BotState(models.Model):
+    chat = models.CharField(max_length=64)
+    user = models.CharField(max_length=64)
+    state = models.CharField(max_length=200, null=True, blank=True)
+    data = models.JSONField(default=dict)
+    bucket = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='unique_bot_state_address'),
+        ]
+
+class Lease(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=200)
+    expires_at = models.DateTimeField()
+
+class PricePoint(models.Model):
+    coin_id = models.CharField(max_length=200)
+    date = models.DateTimeField(default=timezone.now)
+    price = models.DecimalField(max_digits=18, decimal_places=8)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['coin_id', 'date'], name='price_point_coin_date'),
+        ]
+
+class PriceCandle(models.Model):
+    RESOLUTIONS = [('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')]
+
+    coin_id = models.CharField(max_length=200)
+    resolution = models.CharField(max_length=2, choices=RESOLUTIONS)
+    start = models.DateTimeField()
+    open = models.DecimalField(max_digits=18, decimal_places=8)
+    high = models.DecimalField(max_digits=18, decimal_places=8)
+    low = models.DecimalField(max_digits=18, decimal_places=8)
+    close = models.DecimalField(max_digits=18, decimal_places=8)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coin_id', 'resolution', 'start'], name='unique_price_candle'),
+        ]
+
+class PortfolioSnapshot(models.Model):
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    taken_at = models.DateTimeField(default=timezone.now)
+    value = models.DecimalField(max_digits=24, decimal_places=2)
+    cost = models.DecimalField(max_digits=24, decimal_places=2)
+    assets = models.JSONField(default=dict)  # coin_id -> {"value": "...", "cost": "..."}
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'taken_at'], name='snapshot_portfolio_taken_at'),
+        ]
+
+class Trade(models.Model):
+    BUY = 'buy'
+    SELL = 'sell'
+    SIDES = [(BUY, 'Buy'), (SELL, 'Sell')]
+
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE)
+    coin_id = models.CharField(max_length=200)
+    side = models.CharField(max_length=4, choices=SIDES)
+    quantity = models.DecimalField(max_digits=18, decimal_places=8)
+    price = models.DecimalField(max_digits=18, decimal_places=8, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['portfolio', 'coin_id', 'created_at'], name='trade_portfolio_coin_date'),
+        ]
+
+class PriceAlert(models.Model):
+    ABOVE = 'above'
+    BELOW = 'below'
+    DIRECTIONS = [(ABOVE, 'Above'), (BELOW, 'Below')]
+
+    user = models.ForeignKey(TelegramUser, on_delete=models.CASCADE)
+    coin_id = models.CharField(max_length=200)
+    direction = models.CharField(max_length=5, choices=DIRECTIONS)
+    threshold = models.DecimalField(max_digits=18, decimal_places=8)
+    created_at = models.DateTimeField(default=timezone.now)
+    triggered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['triggered_at', 'id'], name='price_alert_pending'),
+        ]
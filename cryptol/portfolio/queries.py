@@ -0,0 +1,62 @@
+from django.db.models import (
+    Count, DecimalField, ExpressionWrapper, F, IntegerField, OuterRef, Subquery, Sum,
+)
+from django.db.models.functions import Coalesce
+
+from .models import CoinPrice, UserCoin
+
+AMOUNT = DecimalField(max_digits=36, decimal_places=16)
+
+
+def current_price():
+    """Stored price of the row's `coin_id`, as a subquery."""
+    return Subquery(CoinPrice.objects.filter(coin_id=OuterRef('coin_id')).values('price')[:1])
+
+
+def valued_holdings(portfolio_id):
+    """Holdings of one portfolio with current price, value and cost computed by the database."""
+    return (
+        UserCoin.objects.filter(portfolio_id=portfolio_id)
+        .annotate(current_price=current_price())
+        .annotate(
+            value=ExpressionWrapper(F('quantity') * F('current_price'), output_field=AMOUNT),
+            cost=ExpressionWrapper(F('quantity') * F('price'), output_field=AMOUNT),
+        )
+    )
+
+
+def holdings_cost(portfolio_id):
+    """What the holdings of one portfolio cost, priced or not."""
+    return UserCoin.objects.filter(portfolio_id=portfolio_id).aggregate(
+        cost=Sum(F('quantity') * F('price'), output_field=AMOUNT),
+    )['cost']
+
+
+def holdings_totals(portfolio_id):
+    """Summed cost and value of one portfolio's holdings; coins without a stored price count in neither."""
+    # aggregated from the expressions, not the annotations: Django 3.2 loses those when it wraps the query
+    return UserCoin.objects.filter(portfolio_id=portfolio_id, coin_id__in=CoinPrice.objects.values('coin_id')).aggregate(
+        cost=Sum(F('quantity') * F('price'), output_field=AMOUNT),
+        value=Sum(F('quantity') * current_price(), output_field=AMOUNT),
+    )
+
+
+def _per_portfolio(aggregate, output_field=AMOUNT):
+    # a correlated subquery per column: holdings are never joined into the portfolio rows
+    rows = UserCoin.objects.filter(portfolio=OuterRef('pk')).order_by().values('portfolio')
+    return Coalesce(Subquery(rows.annotate(result=aggregate).values('result')[:1]), 0, output_field=output_field)
+
+
+def prices_updated():
+    """When the stored price of any coin the portfolio holds last changed."""
+    held = UserCoin.objects.filter(portfolio=OuterRef(OuterRef('pk'))).values('coin_id')
+    return Subquery(CoinPrice.objects.filter(coin_id__in=held).order_by('-updated_at').values('updated_at')[:1])
+
+
+def with_totals(portfolios):
+    """Annotate portfolios with coin count, cost and value at stored prices, in the same query."""
+    return portfolios.annotate(
+        coins=_per_portfolio(Count('pk'), IntegerField()),
+        cost=_per_portfolio(Sum(F('quantity') * F('price'), output_field=AMOUNT)),
+        value=_per_portfolio(Sum(F('quantity') * current_price(), output_field=AMOUNT)),
+    )
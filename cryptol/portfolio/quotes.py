@@ -0,0 +1,115 @@
+import time
+from collections import Counter, OrderedDict
+
+from .coingecko import client
+from .metrics import metrics
+
+
+async def fetch_simple_prices(coin_ids, vs_currency='usd'):
+    """Fetch USD prices for several coins with a single `simple/price` request."""
+    data = await client.simple_price(coin_ids, vs_currency)
+    return {
+        coin_id: data[coin_id][vs_currency]
+        for coin_id in coin_ids
+        if vs_currency in data.get(coin_id, {})
+    }
+
+
+async def fetch_market_prices(coin_ids, vs_currency='usd', chunk_size=250, per_page=250):
+    """Current prices from the paginated `coins/markets` endpoint.
+
+    Ids are sent `chunk_size` at a time and every page of each answer is
+    read, so no coin is cut off by the page size.
+    """
+    prices = {}
+    for start in range(0, len(coin_ids), chunk_size):
+        chunk = coin_ids[start:start + chunk_size]
+        page = 1
+        while True:
+            markets = await client.coins_markets(chunk, vs_currency, per_page=per_page, page=page)
+            prices.update(
+                (market['id'], market['current_price'])
+                for market in markets
+                if market.get('current_price') is not None
+            )
+            if len(markets) < per_page or page * per_page >= len(chunk):
+                break
+            page += 1
+    return prices
+
+
+class PriceCache:
+    """In-process quote cache shared by all bot handlers.
+
+    Entries live for `ttl` seconds; above `maxsize` the least recently used
+    coin is evicted. All misses of one `get_many` call are merged into a
+    single `fetcher` request.
+    """
+
+    def __init__(self, fetcher=fetch_simple_prices, ttl=30, maxsize=5000, clock=time.monotonic):
+        self._fetcher = fetcher
+        self._clock = clock
+        self._entries = OrderedDict()  # coin_id -> (price, fetched_at)
+        self.stats = Counter()
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, coin_id, now):
+        entry = self._entries.get(coin_id)
+        if entry is None:
+            return None
+        if now - entry[1] >= self.ttl:
+            del self._entries[coin_id]
+            return None
+        self._entries.move_to_end(coin_id)
+        return entry[0]
+
+    def _store(self, prices, now):
+        for coin_id, price in prices.items():
+            self._entries[coin_id] = (price, now)
+            self._entries.move_to_end(coin_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def update(self, prices):
+        """Store prices pushed by a price feed."""
+        self._store(prices, self._clock())
+
+    async def refresh(self, coin_ids):
+        """Fetch prices bypassing the cache and store them."""
+        coin_ids = list(dict.fromkeys(coin_ids))
+        if not coin_ids:
+            return {}
+        prices = await self._fetcher(coin_ids)
+        self._store(prices, self._clock())
+        return prices
+
+    async def get_many(self, coin_ids):
+        """Return {coin_id: price}; unknown coins are left out of the result."""
+        now = self._clock()
+        result = {}
+        misses = []
+        for coin_id in dict.fromkeys(coin_ids):
+            price = self._lookup(coin_id, now)
+            if price is None:
+                misses.append(coin_id)
+            else:
+                result[coin_id] = price
+        self.stats['hits'] += len(result)
+        self.stats['misses'] += len(misses)
+        if misses:
+            result.update(await self.refresh(misses))
+        return result
+
+    async def get(self, coin_id):
+        return (await self.get_many([coin_id])).get(coin_id)
+
+
+price_cache = PriceCache()
+
+metrics.collect('price_cache_hits_total', lambda: price_cache.stats['hits'], 'counter')
+metrics.collect('price_cache_misses_total', lambda: price_cache.stats['misses'], 'counter')
+metrics.collect('price_cache_entries', lambda: len(price_cache))
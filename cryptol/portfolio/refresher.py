@@ -0,0 +1,96 @@
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils import timezone
+
+from .history import append_prices
+from .metrics import metrics
+from .models import CoinPrice, PriceAlert, UserCoin
+from .quotes import fetch_market_prices, price_cache
+
+# CoinGecko accepts a few hundred ids per simple/price call before the URL gets too long
+CHUNK_SIZE = 250
+
+
+@dataclass
+class RefreshResult:
+    coins: int
+    rows: int
+    duration: float
+    prices: dict = field(default_factory=dict)
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def held_coin_ids():
+    """Distinct coin ids held by at least one user, in a single query."""
+    return list(UserCoin.objects.order_by().values_list('coin_id', flat=True).distinct())
+
+
+def tracked_coin_ids():
+    """Held coins plus coins with pending price alerts, deduplicated by one UNION query."""
+    held = UserCoin.objects.order_by().values_list('coin_id', flat=True)
+    alerted = PriceAlert.objects.filter(triggered_at__isnull=True).order_by().values_list('coin_id', flat=True)
+    return list(held.union(alerted))
+
+
+def store_prices(prices, updated_at=None):
+    """Upsert {coin_id: price} into CoinPrice with bulk queries; returns rows written."""
+    updated_at = updated_at or timezone.now()
+    with transaction.atomic():
+        existing = CoinPrice.objects.in_bulk(list(prices), field_name='coin_id')
+        changed = []
+        created = []
+        for coin_id, price in prices.items():
+            price = Decimal(str(price))
+            row = existing.get(coin_id)
+            if row is None:
+                created.append(CoinPrice(coin_id=coin_id, price=price, updated_at=updated_at))
+            else:
+                row.price = price
+                row.updated_at = updated_at
+                changed.append(row)
+        CoinPrice.objects.bulk_update(changed, ['price', 'updated_at'], batch_size=CHUNK_SIZE)
+        CoinPrice.objects.bulk_create(created, batch_size=CHUNK_SIZE)
+    return len(changed) + len(created)
+
+
+def stored_prices(since=None):
+    """({coin_id: price}, newest updated_at) of the CoinPrice rows written after `since`."""
+    rows = CoinPrice.objects.all() if since is None else CoinPrice.objects.filter(updated_at__gt=since)
+    prices = {}
+    for coin_id, price, updated_at in rows.values_list('coin_id', 'price', 'updated_at'):
+        prices[coin_id] = price
+        since = updated_at if since is None else max(since, updated_at)
+    return prices, since
+
+
+def save_prices(prices):
+    """Store the latest prices and append them to the price history."""
+    now = timezone.now()
+    with transaction.atomic():
+        rows = store_prices(prices, now)
+        append_prices(prices, now)
+    return rows
+
+
+async def refresh_prices(fetch=fetch_market_prices, cache=price_cache, chunk_size=CHUNK_SIZE):
+    """One refresher cycle: each tracked coin is fetched once, whatever the number of holders.
+
+    Prices are bulk-written to CoinPrice and the history and warm `cache`;
+    the cycle duration is observed as price_refresh_seconds{source="job"}.
+    """
+    started = time.monotonic()
+    coin_ids = await sync_to_async(tracked_coin_ids)()
+    prices = await fetch(coin_ids, chunk_size=chunk_size)
+    cache.update(prices)
+    rows = await sync_to_async(save_prices)(prices) if prices else 0
+    duration = time.monotonic() - started
+    metrics.observe('price_refresh_seconds', duration, source='job')
+    return RefreshResult(coins=len(coin_ids), rows=rows, duration=duration, prices=prices)
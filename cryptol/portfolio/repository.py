@@ -0,0 +1,168 @@
+"""Coarse-grained async data access for the bot handlers.
+
+Each function is a single thread hop that runs all the queries it needs
+and returns plain records, so handlers never touch the ORM, querysets or
+lazily loaded attributes. Unregistered users raise TelegramUser.DoesNotExist.
+"""
+import io
+import tempfile
+from dataclasses import dataclass
+from typing import List, Optional
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+
+from . import cache
+from .alerts import create_alert
+from .analytics import FIFO, PortfolioPnl, RiskMetrics, portfolio_pnl, portfolio_risk, positions
+from .ledger import clear_holdings, record_buy, record_sell
+from .models import CoinPrice, Portfolio, TelegramUser
+from .snapshots import portfolio_history
+from .transfer import export_trades, import_trades, read_records
+from .valuation import Holding, PortfolioValuation, load_holdings
+
+# exported files are spooled to disk above this size
+SPOOL_SIZE = 1024 * 1024
+
+
+class Account:
+    """A registered user and their portfolio."""
+
+    __slots__ = ('telegram_id', 'currency', 'portfolio_id', 'version')
+
+    def __init__(self, telegram_id, currency, portfolio_id, version):
+        self.telegram_id = telegram_id
+        self.currency = currency
+        self.portfolio_id = portfolio_id
+        self.version = version
+
+
+@dataclass
+class PortfolioView:
+    account: Account
+    # the cached valuation, or the holdings to value when there is none
+    valuation: Optional[PortfolioValuation]
+    holdings: Optional[List[Holding]]
+    # price period the valuation belongs to, taken before any price is read
+    stamp: int
+
+
+@dataclass
+class Analytics:
+    pnl: PortfolioPnl
+    risk: RiskMetrics
+
+
+def _load(telegram_id):
+    """(TelegramUser, Portfolio) in one query; the portfolio is created on first use."""
+    telegram_user = TelegramUser.objects.select_related('user__portfolio').get(telegram_id=telegram_id)
+    try:
+        portfolio = telegram_user.user.portfolio
+    except Portfolio.DoesNotExist:
+        portfolio, _ = Portfolio.objects.get_or_create(user=telegram_user.user)
+    return telegram_user, portfolio
+
+
+def _account(telegram_user, portfolio):
+    return Account(telegram_user.telegram_id, telegram_user.currency, portfolio.pk, portfolio.version)
+
+
+@sync_to_async
+def register(telegram_id):
+    """Create the user on /start; returns True for a new user."""
+    user, created = User.objects.get_or_create(username=telegram_id)
+    TelegramUser.objects.get_or_create(user=user, telegram_id=telegram_id)
+    return created
+
+
+@sync_to_async
+def load_portfolio(telegram_id):
+    """User, portfolio and either the cached valuation or the holdings, in one hop."""
+    stamp = cache.price_stamp()
+    telegram_user, portfolio = _load(telegram_id)
+    account = _account(telegram_user, portfolio)
+    valuation = cache.get_valuation(account.portfolio_id, account.version, account.currency, stamp)
+    holdings = load_holdings(portfolio) if valuation is None else None
+    return PortfolioView(account, valuation, holdings, stamp)
+
+
+@sync_to_async
+def load_snapshot(telegram_id, version, stamp, currency):
+    """The valuation an earlier /portfolio was rendered from, or None once holdings changed or it expired."""
+    _, portfolio = _load(telegram_id)
+    if portfolio.version != version:
+        return None
+    return cache.get_valuation(portfolio.pk, version, currency, stamp)
+
+
+@sync_to_async
+def store_valuation(view, currency, valuation):
+    """Cache a valuation of `view`'s holdings under the stamp `view` was loaded with."""
+    cache.store_valuation(view.account.portfolio_id, view.account.version, currency, view.stamp, valuation)
+
+
+@sync_to_async
+def buy(telegram_id, coin_id, price, quantity):
+    _, portfolio = _load(telegram_id)
+    record_buy(portfolio, coin_id, price, quantity)
+
+
+@sync_to_async
+def sell(telegram_id, coin_id, quantity, price):
+    """Raises UserCoin.DoesNotExist or InsufficientQuantity like record_sell."""
+    _, portfolio = _load(telegram_id)
+    record_sell(portfolio, coin_id, quantity, price)
+
+
+@sync_to_async
+def clear(telegram_id):
+    _, portfolio = _load(telegram_id)
+    clear_holdings(portfolio)
+
+
+@sync_to_async
+def set_currency(telegram_id, currency):
+    if not TelegramUser.objects.filter(telegram_id=telegram_id).update(currency=currency):
+        raise TelegramUser.DoesNotExist(telegram_id)
+
+
+@sync_to_async
+def history(telegram_id, days):
+    _, portfolio = _load(telegram_id)
+    return portfolio_history(portfolio, days=days)
+
+
+@sync_to_async
+def analytics(telegram_id, method=FIFO, days=90):
+    """P&L of the ledger's lots at the stored CoinPrice prices and risk metrics, in one hop."""
+    _, portfolio = _load(telegram_id)
+    held = [coin_id for coin_id, position in positions(portfolio, method).items() if position.quantity]
+    prices = dict(CoinPrice.objects.filter(coin_id__in=held).values_list('coin_id', 'price'))
+    return Analytics(portfolio_pnl(portfolio, prices, method), portfolio_risk(portfolio, days))
+
+
+@sync_to_async
+def add_alert(telegram_id, coin_id, direction, threshold):
+    create_alert(telegram_id, coin_id, direction, threshold)
+
+
+@sync_to_async
+def import_file(telegram_id, file, fmt, is_known=None):
+    """Import a binary trade file; see transfer.import_trades for the errors raised."""
+    _, portfolio = _load(telegram_id)
+    stream = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        return import_trades(portfolio, read_records(stream, fmt), is_known=is_known)
+    finally:
+        stream.detach()  # the caller owns and closes the file
+
+
+@sync_to_async
+def export_file(telegram_id, fmt):
+    """The trade ledger as a binary file positioned at its start; the caller closes it."""
+    _, portfolio = _load(telegram_id)
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in export_trades(portfolio, fmt):
+        file.write(chunk.encode())
+    file.seek(0)
+    return file
@@ -0,0 +1,201 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import Counter, defaultdict
+
+from aiogram.utils.exceptions import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Lanes, served in this order
+INTERACTIVE = 0
+BROADCAST = 1
+LANES = {INTERACTIVE: 'interactive', BROADCAST: 'broadcast'}
+
+
+class TokenBucket:
+    """`rate` tokens per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+    def __init__(self, chat_id, payload, kwargs, future, method='send_message'):
+        self.chat_id = chat_id
+        self.payload = payload
+        self.kwargs = kwargs
+        self.method = method
+        self.future = future
+        self.attempts = 0
+
+
+class SendQueue:
+    """Single outlet for messages to Telegram.
+
+    Messages wait in a priority queue, interactive replies ahead of
+    broadcasts, and leave it at most `rate` per second overall and
+    `chat_rate` per second per chat. A throttled chat is set aside without
+    holding up the others, and messages to one chat are delivered one at a
+    time, in order. On RetryAfter the whole queue pauses for the time
+    Telegram asked and the message is sent again.
+    """
+
+    def __init__(self, bot, rate=30, chat_rate=1, chat_burst=3, max_retries=3, clock=time.monotonic):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.stats = Counter()
+        self._clock = clock
+        self._bucket = TokenBucket(rate, rate, clock)
+        self._chat_buckets = {}
+        self._seq = itertools.count()
+        self._depth = Counter()
+        self._sending = set()
+        self._parked = defaultdict(list)  # chat_id -> items waiting for the chat to be free
+        self._paused_until = 0
+        self._queue = None
+        self._task = None
+
+    def _get_queue(self):
+        # Created lazily so that the queue belongs to the running loop
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        return self._queue
+
+    def depth(self):
+        """Messages waiting to be sent, per lane."""
+        return {name: self._depth[lane] for lane, name in LANES.items()}
+
+    def _put(self, lane, message):
+        self._depth[lane] += 1
+        self._get_queue().put_nowait((lane, next(self._seq), message))
+
+    def send(self, chat_id, text, **kwargs):
+        """Queue an interactive reply; the returned future resolves to the sent Message."""
+        future = asyncio.get_event_loop().create_future()
+        self._put(INTERACTIVE, OutgoingMessage(chat_id, text, kwargs, future))
+        return future
+
+    def send_document(self, chat_id, document, **kwargs):
+        """Queue a file as an interactive reply, paced like any other message."""
+        future = asyncio.get_event_loop().create_future()
+        self._put(INTERACTIVE, OutgoingMessage(chat_id, document, kwargs, future, method='send_document'))
+        return future
+
+    def edit_text(self, chat_id, message_id, text, **kwargs):
+        """Queue an edit of a sent message, e.g. to turn a page; paced like a reply."""
+        future = asyncio.get_event_loop().create_future()
+        kwargs['message_id'] = message_id
+        self._put(INTERACTIVE, OutgoingMessage(chat_id, text, kwargs, future, method='edit_message_text'))
+        return future
+
+    def broadcast(self, chat_id, text, **kwargs):
+        """Queue a notification behind interactive replies; failures are only logged."""
+        self._put(BROADCAST, OutgoingMessage(chat_id, text, kwargs, None))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, self._clock)
+        return bucket
+
+    async def _requeue_later(self, delay, item):
+        await asyncio.sleep(delay)
+        self._get_queue().put_nowait(item)
+
+    async def _run(self):
+        queue = self._get_queue()
+        while True:
+            item = await queue.get()
+            lane, _, message = item
+            if message.chat_id in self._sending:
+                self._parked[message.chat_id].append(item)
+                continue
+            wait = self._chat_bucket(message.chat_id).wait_time()
+            if wait > 0:
+                self.stats['throttled'] += 1
+                asyncio.ensure_future(self._requeue_later(wait, item))
+                continue
+            wait = max(self._paused_until - self._clock(), self._bucket.wait_time())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._bucket.consume()
+            self._chat_bucket(message.chat_id).consume()
+            self._depth[lane] -= 1
+            self._sending.add(message.chat_id)
+            asyncio.ensure_future(self._deliver(item))
+
+    async def _deliver(self, item):
+        lane, _, message = item
+        try:
+            message.attempts += 1
+            send = getattr(self.bot, message.method)
+            if message.method == 'edit_message_text':
+                # the only Bot API method here that takes the text first
+                result = await send(message.payload, message.chat_id, **message.kwargs)
+            else:
+                result = await send(message.chat_id, message.payload, **message.kwargs)
+        except RetryAfter as e:
+            if message.attempts > self.max_retries:
+                self._fail(message, e)
+            else:
+                self.stats['retried'] += 1
+                self._paused_until = max(self._paused_until, self._clock() + e.timeout)
+                self._depth[lane] += 1
+                self._get_queue().put_nowait(item)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            self.stats['sent'] += 1
+            if message.future is not None and not message.future.done():
+                message.future.set_result(result)
+        finally:
+            self._sending.discard(message.chat_id)
+            for parked in self._parked.pop(message.chat_id, ()):
+                self._get_queue().put_nowait(parked)
+
+    def _fail(self, message, error):
+        self.stats['failed'] += 1
+        if message.future is None:
+            logger.warning("Cannot send message to %s: %s", message.chat_id, error)
+        elif not message.future.done():
+            message.future.set_exception(error)
@@ -0,0 +1,69 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .models import CoinPrice, Portfolio, PortfolioSnapshot, UserCoin
+from .valuation import Holding, percent, value_portfolio
+
+BATCH_SIZE = 500
+
+
+def take_snapshots(at=None):
+    """Value every portfolio against the stored CoinPrice table and save the results.
+
+    A fixed number of queries however many portfolios there are: prices,
+    portfolio ids, all holdings and the bulk insert.
+    """
+    at = at or timezone.now()
+    prices = dict(CoinPrice.objects.values_list('coin_id', 'price'))
+    holdings = defaultdict(list)
+    for portfolio_id, coin_id, quantity, average_price in UserCoin.objects.values_list(
+            'portfolio_id', 'coin_id', 'quantity', 'price'):
+        holdings[portfolio_id].append(Holding(coin_id, quantity, average_price))
+    snapshots = []
+    for portfolio_id in Portfolio.objects.values_list('pk', flat=True):
+        valuation = value_portfolio(holdings[portfolio_id], prices)
+        snapshots.append(PortfolioSnapshot(
+            portfolio_id=portfolio_id,
+            taken_at=at,
+            value=valuation.value,
+            cost=valuation.cost,
+            assets={coin.coin_id: {'value': str(coin.value), 'cost': str(coin.cost)} for coin in valuation.coins},
+        ))
+    PortfolioSnapshot.objects.bulk_create(snapshots, batch_size=BATCH_SIZE)
+    return len(snapshots)
+
+
+def portfolio_history(portfolio, days=30):
+    """P&L series and best/worst asset of a portfolio, read from snapshots only."""
+    since = timezone.now() - timedelta(days=days)
+    rows = list(
+        PortfolioSnapshot.objects.filter(portfolio=portfolio, taken_at__gte=since)
+        .order_by('taken_at')
+        .values_list('taken_at', 'value', 'cost', 'assets')
+    )
+    history = {
+        'series': [
+            {'date': taken_at, 'value': value, 'cost': cost, 'pnl': value - cost}
+            for taken_at, value, cost, _ in rows
+        ],
+        'pnl': None,
+        'pnl_percent': None,
+        'best': None,
+        'worst': None,
+    }
+    if not rows:
+        return history
+    _, value, cost, assets = rows[-1]
+    history['pnl'] = value - cost
+    history['pnl_percent'] = percent(value - cost, cost)
+    pnl = sorted(
+        (Decimal(asset['value']) - Decimal(asset['cost']), coin_id)
+        for coin_id, asset in assets.items()
+    )
+    if pnl:
+        history['worst'] = {'coin_id': pnl[0][1], 'pnl': pnl[0][0]}
+        history['best'] = {'coin_id': pnl[-1][1], 'pnl': pnl[-1][0]}
+    return history
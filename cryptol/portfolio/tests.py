@@ -1,3 +1,1218 @@
-from django.test import TestCase
+import asyncio
+import io
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from aiogram.utils.exceptions import BotBlocked, RetryAfter
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .alerts import AlertIndex, load_new_alerts, mark_fired
+from .analytics import AVERAGE, FIFO, LIFO, compute_risk, portfolio_pnl, portfolio_risk, replay_trades
+from .cache import get_valuation, price_stamp, store_valuation, valuation_cache
+from .catalog import CoinCatalog, sync_catalog
+from .coingecko import CoinGeckoClient, CoinGeckoError
+from .db import configure_sqlite
+from .feeds import PriceBus, RestPollingFeed, StreamingFeed
+from .fx import FxRates, display_currencies
+from .history import append_prices, price_series, prune_history
+from .jobs import PRICES, Job, JobRunner, run_job
+from .leases import acquire_lease, claim_slot, release_lease
+from .ledger import InsufficientQuantity, QuantityTooLarge, clear_holdings, record_buy, record_sell
+from .management.commands.benchmark import QueryCounter, percentile, seed
+from .metrics import Metrics, QueryCount, current_queries
+from .models import (
+    CatalogCoin, CoinHistory, CoinPrice, Lease, Portfolio, PortfolioSnapshot, PriceAlert, PriceCandle, PricePoint,
+    TelegramUser, Trade, UserCoin,
+)
+from .queries import with_totals
+from .quotes import PriceCache, fetch_market_prices, price_cache
+from . import repository
+from .refresher import refresh_prices, tracked_coin_ids
+from .sender import SendQueue, TokenBucket
+from .snapshots import portfolio_history, take_snapshots
+from .transfer import TradeImportError, export_trades, import_trades, iter_json_array, read_records
+from .valuation import Holding, load_holdings, value_portfolio
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class PriceCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.clock = FakeClock()
+
+        async def fetcher(coin_ids):
+            self.calls.append(list(coin_ids))
+            return {coin_id: 1.5 for coin_id in coin_ids if coin_id != 'unknown'}
+
+        self.cache = PriceCache(fetcher=fetcher, ttl=10, maxsize=3, clock=self.clock)
+
+    def test_misses_are_merged_into_one_request(self):
+        prices = asyncio.run(self.cache.get_many(['bitcoin', 'ethereum', 'bitcoin', 'unknown']))
+        self.assertEqual(prices, {'bitcoin': 1.5, 'ethereum': 1.5})
+        self.assertEqual(self.calls, [['bitcoin', 'ethereum', 'unknown']])
+
+    def test_warm_cache_makes_no_request(self):
+        asyncio.run(self.cache.get_many(['bitcoin', 'ethereum']))
+        asyncio.run(self.cache.get_many(['ethereum', 'bitcoin']))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_expired_entries_are_refetched(self):
+        asyncio.run(self.cache.get('bitcoin'))
+        self.clock.now = 10
+        asyncio.run(self.cache.get('bitcoin'))
+        self.assertEqual(self.calls, [['bitcoin'], ['bitcoin']])
+
+    def test_hits_and_misses_are_counted(self):
+        asyncio.run(self.cache.get_many(['bitcoin', 'ethereum']))
+        asyncio.run(self.cache.get_many(['bitcoin', 'dogecoin']))
+        self.assertEqual((self.cache.stats['hits'], self.cache.stats['misses']), (1, 3))
+
+    def test_least_recently_used_coin_is_evicted(self):
+        asyncio.run(self.cache.get_many(['a', 'b', 'c']))
+        asyncio.run(self.cache.get('a'))
+        asyncio.run(self.cache.get('d'))
+        self.assertEqual(len(self.cache), 3)
+        asyncio.run(self.cache.get_many(['a', 'c', 'd']))
+        self.assertEqual(self.calls[-1], ['d'])
+        asyncio.run(self.cache.get('b'))
+        self.assertEqual(self.calls[-1], ['b'])
+
+
+def make_portfolio(username, holdings):
+    portfolio = Portfolio.objects.create(user=User.objects.create(username=username))
+    for coin_id, quantity, price in holdings:
+        UserCoin.objects.create(portfolio=portfolio, coin_id=coin_id, quantity=quantity, price=price)
+    return portfolio
+
+
+class RefresherTests(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        async def fetch(coin_ids, chunk_size):
+            self.calls += [sorted(coin_ids[start:start + chunk_size]) for start in range(0, len(coin_ids), chunk_size)]
+            return {coin_id: 2 for coin_id in coin_ids}
+
+        self.fetch = fetch
+        self.cache = PriceCache()
+        for n in range(5):
+            make_portfolio(f'user{n}', [('bitcoin', 1, 10), ('ethereum', 2, 5)])
+
+    def refresh(self, **kwargs):
+        return async_to_sync(refresh_prices)(fetch=self.fetch, cache=self.cache, **kwargs)
+
+    def test_each_held_coin_is_fetched_once(self):
+        registry = Metrics()
+        with mock.patch('portfolio.refresher.metrics', registry):
+            result = self.refresh(chunk_size=1)
+        self.assertEqual(sorted(self.calls), [['bitcoin'], ['ethereum']])
+        self.assertEqual((result.coins, result.rows), (2, 2))
+        self.assertEqual(
+            dict(CoinPrice.objects.values_list('coin_id', 'price')),
+            {'bitcoin': Decimal(2), 'ethereum': Decimal(2)},
+        )
+        self.assertEqual(async_to_sync(self.cache.get_many)(['bitcoin', 'ethereum']), {'bitcoin': 2, 'ethereum': 2})
+        self.assertIn('price_refresh_seconds_count{source="job"} 1', registry.render())
+
+    def test_coins_with_pending_alerts_are_refreshed(self):
+        user = TelegramUser.objects.create(user=User.objects.create(username='watcher'), telegram_id=1)
+        PriceAlert.objects.create(user=user, coin_id='solana', direction=PriceAlert.ABOVE, threshold=100)
+        result = self.refresh()
+        self.assertEqual(result.coins, 3)
+        self.assertIn('solana', result.prices)
+
+    def test_refresh_keeps_average_buy_price(self):
+        self.refresh()
+        self.refresh()
+        self.assertEqual(CoinPrice.objects.count(), 2)
+        self.assertEqual(set(UserCoin.objects.values_list('price', flat=True)), {Decimal(10), Decimal(5)})
+
+
+class CoinGeckoClientTests(SimpleTestCase):
+    """Runs the client against a local stub of the CoinGecko API."""
+
+    def setUp(self):
+        self.hits = []
+        self.rate_limited = 0
+
+    async def simple_price(self, request):
+        self.hits.append(request.path_qs)
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return web.Response(status=429, headers={'Retry-After': '0'})
+        await asyncio.sleep(0.05)
+        ids = request.query['ids'].split(',')
+        return web.json_response({coin_id: {'usd': 1} for coin_id in ids})
+
+    async def coin(self, request):
+        self.hits.append(request.path_qs)
+        if request.match_info['coin_id'] != 'bitcoin':
+            return web.json_response({'error': 'coin not found'}, status=404)
+        return web.json_response({'id': 'bitcoin'})
+
+    def run_with_client(self, scenario, **kwargs):
+        async def main():
+            app = web.Application()
+            app.router.add_get('/simple/price', self.simple_price)
+            app.router.add_get('/coins/{coin_id}', self.coin)
+            async with TestServer(app) as server:
+                client = CoinGeckoClient(base_url=str(server.make_url('')), backoff=0, **kwargs)
+                try:
+                    return await scenario(client)
+                finally:
+                    await client.close()
+        return asyncio.run(main())
+
+    def test_identical_inflight_requests_are_coalesced(self):
+        async def scenario(client):
+            return await asyncio.gather(*(client.simple_price(['bitcoin']) for _ in range(5)))
+
+        results = self.run_with_client(scenario)
+        self.assertEqual(results, [{'bitcoin': {'usd': 1}}] * 5)
+        self.assertEqual(len(self.hits), 1)
+
+    def test_rate_limited_requests_are_retried(self):
+        self.rate_limited = 2
+        result = self.run_with_client(lambda client: client.simple_price(['bitcoin']))
+        self.assertEqual(result, {'bitcoin': {'usd': 1}})
+        self.assertEqual(len(self.hits), 3)
+
+    def test_gives_up_after_max_retries(self):
+        self.rate_limited = 10
+        with self.assertRaises(CoinGeckoError):
+            self.run_with_client(lambda client: client.simple_price(['bitcoin']), max_retries=1)
+        self.assertEqual(len(self.hits), 2)
+
+    def test_coin_exists(self):
+        async def scenario(client):
+            return await client.coin_exists('bitcoin'), await client.coin_exists('nope')
+
+        self.assertEqual(self.run_with_client(scenario), (True, False))
+
+
+class CoinCatalogTests(SimpleTestCase):
+    def setUp(self):
+        self.catalog = CoinCatalog([
+            ('bitcoin', 'btc', 'Bitcoin'),
+            ('bitcoin-cash', 'bch', 'Bitcoin Cash'),
+            ('ethereum', 'eth', 'Ethereum'),
+            ('wrapped-bitcoin', 'wbtc', 'Wrapped Bitcoin'),
+        ])
+
+    def test_exists(self):
+        self.assertTrue(self.catalog.exists('ethereum'))
+        self.assertFalse(self.catalog.exists('eth'))
+
+    def test_prefix_matches_ids_and_symbols(self):
+        self.assertEqual(self.catalog.prefix('bitc'), ['bitcoin', 'bitcoin-cash'])
+        self.assertEqual(self.catalog.prefix('WB'), ['wrapped-bitcoin'])
+
+    def test_suggest_falls_back_to_close_spellings(self):
+        self.assertEqual(self.catalog.suggest('etherium'), ['ethereum'])
+        self.assertEqual(self.catalog.suggest('zzz'), [])
+
+
+class SyncCatalogTests(TestCase):
+    def test_only_changed_rows_are_written(self):
+        coins = [
+            {'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin'},
+            {'id': 'ethereum', 'symbol': 'eth', 'name': 'Ethereum'},
+        ]
+        self.assertEqual(sync_catalog(coins), (2, 0, 0))
+        self.assertEqual(sync_catalog(coins), (0, 0, 0))
+        coins = [
+            {'id': 'bitcoin', 'symbol': 'btc', 'name': 'Bitcoin Core'},
+            {'id': 'solana', 'symbol': 'sol', 'name': 'Solana'},
+        ]
+        self.assertEqual(sync_catalog(coins), (1, 1, 1))
+        self.assertEqual(
+            sorted(CatalogCoin.objects.values_list('coin_id', 'name')),
+            [('bitcoin', 'Bitcoin Core'), ('solana', 'Solana')],
+        )
+
+
+class ValuationTests(TestCase):
+    def test_values_portfolio_in_one_pass(self):
+        holdings = [
+            Holding('bitcoin', Decimal('0.5'), Decimal('20000')),
+            Holding('ethereum', Decimal('2'), Decimal('1500.129')),
+            Holding('dogecoin', None, Decimal('0.1')),
+            Holding('delisted', Decimal('1'), Decimal('3')),
+        ]
+        valuation = value_portfolio(holdings, {'bitcoin': 30000.5, 'ethereum': 1000, 'dogecoin': 0.2})
+        bitcoin, ethereum = valuation.coins
+        self.assertEqual((bitcoin.value, bitcoin.cost, bitcoin.pnl), (Decimal('15000.25'), Decimal('10000.00'), Decimal('5000.25')))
+        self.assertEqual(bitcoin.pnl_percent, Decimal('50.00'))
+        self.assertEqual((ethereum.average_price, ethereum.pnl), (Decimal('1500.12'), Decimal('-1000.24')))
+        self.assertEqual(valuation.missing_quantity, ['dogecoin'])
+        self.assertEqual(valuation.missing_price, ['delisted'])
+        self.assertEqual((valuation.value, valuation.cost), (Decimal('17000.25'), Decimal('13000.24')))
+        self.assertEqual((valuation.pnl, valuation.pnl_percent), (Decimal('4000.01'), Decimal('30.76')))
+
+    def test_converts_to_display_currency_before_rounding(self):
+        valuation = value_portfolio([Holding('bitcoin', Decimal('2'), Decimal('100'))], {'bitcoin': 150}, Decimal('0.9'))
+        coin = valuation.coins[0]
+        self.assertEqual((coin.average_price, coin.current_price), (Decimal('90.00'), Decimal('135.00')))
+        self.assertEqual((valuation.value, valuation.pnl), (Decimal('270.00'), Decimal('90.00')))
+
+    def test_empty_portfolio(self):
+        valuation = value_portfolio([], {})
+        self.assertEqual((valuation.value, valuation.pnl_percent), (Decimal('0.00'), Decimal('0.00')))
+
+    def test_holdings_are_loaded_in_one_query(self):
+        portfolio = make_portfolio('holder', [('bitcoin', 1, 10), ('ethereum', 2, 5)])
+        with self.assertNumQueries(1):
+            holdings = load_holdings(portfolio)
+        self.assertEqual([holding.coin_id for holding in holdings], ['bitcoin', 'ethereum'])
+
+
+class ValuationCacheTests(TestCase):
+    def setUp(self):
+        valuation_cache().clear()
+        self.portfolio = make_portfolio('cached', [('bitcoin', 1, 10)])
+
+    def store(self):
+        valuation = value_portfolio(load_holdings(self.portfolio), {'bitcoin': 20})
+        store_valuation(self.portfolio.pk, self.portfolio.version, 'usd', 1, valuation)
+
+    def cached(self, currency, stamp=1):
+        return get_valuation(self.portfolio.pk, self.portfolio.version, currency, stamp)
+
+    def test_hit_after_store(self):
+        self.assertIsNone(self.cached('usd'))
+        self.store()
+        self.assertEqual(self.cached('usd').value, Decimal('20.00'))
+        self.assertIsNone(self.cached('eur'))
+
+    def test_next_price_period_misses(self):
+        self.store()
+        self.assertIsNone(self.cached('usd', stamp=2))
+
+    def test_every_worker_derives_the_same_stamp(self):
+        ttl = price_cache.ttl
+        self.assertEqual(price_stamp(lambda: 10 * ttl), price_stamp(lambda: 11 * ttl - 0.5))
+        self.assertEqual(price_stamp(lambda: 11 * ttl), price_stamp(lambda: 10 * ttl) + 1)
+
+    def test_changed_holdings_miss(self):
+        for change in (
+            lambda: record_buy(self.portfolio, 'bitcoin', 10, 1),
+            lambda: record_sell(self.portfolio, 'bitcoin', 1),
+            lambda: clear_holdings(self.portfolio),
+        ):
+            self.store()
+            change()
+            self.portfolio.refresh_from_db()
+            self.assertIsNone(self.cached('usd'))
+        self.assertEqual(self.portfolio.version, 3)
+        self.assertFalse(UserCoin.objects.filter(portfolio=self.portfolio).exists())
+
+
+@mock.patch('portfolio.cache.price_stamp', mock.Mock(return_value=1))
+class RepositoryTests(TestCase):
+    def setUp(self):
+        valuation_cache().clear()
+
+    def test_unregistered_user(self):
+        with self.assertRaises(TelegramUser.DoesNotExist):
+            async_to_sync(repository.load_portfolio)(404)
+
+    def test_portfolio_in_one_hop(self):
+        self.assertTrue(async_to_sync(repository.register)(3003))
+        self.assertFalse(async_to_sync(repository.register)(3003))
+        view = async_to_sync(repository.load_portfolio)(3003)  # creates the portfolio
+        self.assertEqual((view.account.currency, view.account.version, view.holdings), ('usd', 0, []))
+        async_to_sync(repository.buy)(3003, 'bitcoin', 100, 2)
+        with self.assertNumQueries(2):  # user with portfolio, holdings
+            view = async_to_sync(repository.load_portfolio)(3003)
+        self.assertEqual(view.account.version, 1)
+        self.assertEqual([(holding.coin_id, holding.quantity) for holding in view.holdings], [('bitcoin', 2)])
+
+        async_to_sync(repository.store_valuation)(view, 'usd', value_portfolio(view.holdings, {'bitcoin': 150}))
+        with self.assertNumQueries(1):
+            view = async_to_sync(repository.load_portfolio)(3003)
+        self.assertEqual((view.valuation.value, view.holdings), (Decimal('300.00'), None))
+
+        with self.assertNumQueries(1):
+            snapshot = async_to_sync(repository.load_snapshot)(3003, 1, view.stamp, 'usd')
+        self.assertEqual(snapshot.value, Decimal('300.00'))
+
+        async_to_sync(repository.sell)(3003, 'bitcoin', 1, None)
+        view = async_to_sync(repository.load_portfolio)(3003)
+        self.assertIsNone(view.valuation)
+        self.assertEqual(view.holdings[0].quantity, 1)
+        self.assertIsNone(async_to_sync(repository.load_snapshot)(3003, 1, view.stamp, 'usd'))
+
+
+class AnalyticsTests(TestCase):
+    TRADES = [
+        ('bitcoin', Trade.BUY, Decimal('1'), Decimal('100')),
+        ('bitcoin', Trade.BUY, Decimal('1'), Decimal('200')),
+        ('bitcoin', Trade.SELL, Decimal('1.5'), Decimal('300')),
+        ('ethereum', Trade.BUY, Decimal('2'), Decimal('10')),
+        ('ethereum', Trade.SELL, Decimal('1'), None),
+    ]
+
+    def setUp(self):
+        valuation_cache().clear()
+
+    def test_cost_methods(self):
+        fifo = replay_trades(self.TRADES, FIFO)['bitcoin']
+        self.assertEqual((fifo.quantity, fifo.cost, fifo.realized), (Decimal('0.5'), Decimal('100'), Decimal('250')))
+        lifo = replay_trades(self.TRADES, LIFO)['bitcoin']
+        self.assertEqual((lifo.quantity, lifo.cost, lifo.realized), (Decimal('0.5'), Decimal('50'), Decimal('200')))
+        average = replay_trades(self.TRADES, AVERAGE)['bitcoin']
+        self.assertEqual((average.quantity, average.cost, average.realized), (Decimal('0.5'), Decimal('75'), Decimal('225')))
+        ethereum = replay_trades(self.TRADES, FIFO)['ethereum']
+        self.assertEqual((ethereum.quantity, ethereum.realized, ethereum.unpriced), (1, 0, 1))
+        with self.assertRaises(ValueError):
+            replay_trades(self.TRADES, 'hifo')
+
+    def test_pnl_is_memoized_per_version(self):
+        portfolio = make_portfolio('analyst', [])
+        record_buy(portfolio, 'bitcoin', 100, 1)
+        record_buy(portfolio, 'bitcoin', 200, 1)
+        record_sell(portfolio, 'bitcoin', Decimal('1.5'), price=300)
+        portfolio.refresh_from_db()
+        pnl = portfolio_pnl(portfolio, {'bitcoin': 400})
+        self.assertEqual((pnl.realized, pnl.unrealized), (Decimal('250.00'), Decimal('100.00')))
+        with self.assertNumQueries(0):
+            portfolio_pnl(portfolio, {'bitcoin': 500})
+        record_buy(portfolio, 'ethereum', 10, 1)
+        portfolio.refresh_from_db()
+        pnl = portfolio_pnl(portfolio, {'bitcoin': 400})
+        self.assertEqual(pnl.missing_price, ['ethereum'])
+
+    def test_cleared_coins_are_closed(self):
+        portfolio = make_portfolio('cleared', [])
+        record_buy(portfolio, 'bitcoin', 100, 2)
+        clear_holdings(portfolio)
+        portfolio.refresh_from_db()
+        self.assertEqual(
+            list(Trade.objects.filter(side=Trade.SELL).values_list('coin_id', 'quantity', 'price')),
+            [('bitcoin', 2, None)],
+        )
+        pnl = portfolio_pnl(portfolio, {})
+        self.assertEqual((pnl.unrealized, pnl.missing_price, pnl.unpriced), (0, [], ['bitcoin']))
+        self.assertEqual(portfolio_risk(portfolio).coin_ids, [])
+
+    def test_realized_pnl_does_not_need_a_current_price(self):
+        portfolio = make_portfolio('unquoted', [])
+        record_buy(portfolio, 'bitcoin', 10, 2)
+        record_sell(portfolio, 'bitcoin', 1, price=20)
+        portfolio.refresh_from_db()
+        quoted = portfolio_pnl(portfolio, {'bitcoin': 30})
+        unquoted = portfolio_pnl(portfolio, {})
+        self.assertEqual((quoted.realized, unquoted.realized), (Decimal('10.00'), Decimal('10.00')))
+        self.assertEqual((unquoted.unrealized, unquoted.missing_price), (0, ['bitcoin']))
+
+    def test_repository_values_lots_at_stored_prices(self):
+        async_to_sync(repository.register)(4004)
+        async_to_sync(repository.buy)(4004, 'bitcoin', 100, 2)
+        async_to_sync(repository.sell)(4004, 'bitcoin', 1, 150)
+        CoinPrice.objects.create(coin_id='bitcoin', price=300)
+        result = async_to_sync(repository.analytics)(4004, LIFO)
+        self.assertEqual((result.pnl.method, result.pnl.realized, result.pnl.unrealized), (LIFO, 50, 200))
+        self.assertEqual(result.risk.coin_ids, ['bitcoin'])
+
+    def test_risk_metrics(self):
+        matrix = np.array([[100, 10], [110, 11], [99, 9.9], [121, 12.1]], dtype=float)
+        risk = compute_risk(['bitcoin', 'ethereum'], [1, 10], matrix)
+        self.assertAlmostEqual(risk.max_drawdown['bitcoin'], 0.1)
+        self.assertAlmostEqual(risk.correlation[0][1], 1.0)
+        self.assertAlmostEqual(risk.volatility['bitcoin'], risk.volatility['ethereum'])
+        self.assertAlmostEqual(risk.portfolio_drawdown, 0.1)
+        self.assertEqual(compute_risk(['bitcoin'], [1], matrix[:1, :1]).volatility, {})
+
+    def test_risk_reads_daily_candles(self):
+        portfolio = make_portfolio('risky', [])
+        record_buy(portfolio, 'bitcoin', 100, 1)
+        portfolio.refresh_from_db()
+        day = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        for offset, close in enumerate([100, 50, 75]):
+            PriceCandle.objects.create(
+                coin_id='bitcoin', resolution='1d', start=day - timedelta(days=2 - offset),
+                open=close, high=close, low=close, close=close,
+            )
+        risk = portfolio_risk(portfolio, days=10)
+        self.assertEqual(risk.coin_ids, ['bitcoin'])
+        self.assertAlmostEqual(risk.max_drawdown['bitcoin'], 0.5)
+        with self.assertNumQueries(0):
+            portfolio_risk(portfolio, days=10)
+
+
+class LeaseTests(TestCase):
+    def test_only_one_holder_at_a_time(self):
+        self.assertTrue(acquire_lease('job', holder='a', ttl=60))
+        self.assertFalse(acquire_lease('job', holder='b', ttl=60))
+        self.assertTrue(acquire_lease('job', holder='a', ttl=60))
+
+    def test_expired_lease_is_taken_over(self):
+        acquire_lease('job', holder='a', ttl=60)
+        Lease.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(acquire_lease('job', holder='b', ttl=60))
+        self.assertFalse(acquire_lease('job', holder='a', ttl=60))
+
+    def test_release(self):
+        acquire_lease('job', holder='a', ttl=60)
+        release_lease('job', holder='a')
+        self.assertTrue(acquire_lease('job', holder='b', ttl=60))
+
+    def test_slot_is_claimed_once_per_ttl(self):
+        self.assertTrue(claim_slot('job:prices', 60, holder='a'))
+        self.assertFalse(claim_slot('job:prices', 60, holder='a'))
+        self.assertFalse(claim_slot('job:prices', 60, holder='b'))
+        Lease.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(claim_slot('job:prices', 60, holder='b'))
+
+
+class PriceHistoryTests(TestCase):
+    start = datetime(2023, 5, 20, 12, 0, tzinfo=dt_timezone.utc)
+
+    def test_ticks_are_rolled_up_incrementally(self):
+        for minute, price in enumerate([10, 12, 9, 11]):
+            append_prices({'bitcoin': price, 'ethereum': price * 2}, at=self.start + timedelta(seconds=30 * minute))
+        self.assertEqual(PricePoint.objects.count(), 8)
+        hour = PriceCandle.objects.get(coin_id='bitcoin', resolution='1h')
+        self.assertEqual((hour.open, hour.high, hour.low, hour.close), (10, 12, 9, 11))
+        minutes = PriceCandle.objects.filter(coin_id='bitcoin', resolution='1m').order_by('start')
+        self.assertEqual([(c.open, c.close) for c in minutes], [(10, 12), (9, 11)])
+
+    def test_price_series(self):
+        append_prices({'bitcoin': 10}, at=self.start)
+        append_prices({'bitcoin': 20}, at=self.start + timedelta(hours=1))
+        end = self.start + timedelta(hours=2)
+        self.assertEqual([price for _, price in price_series('bitcoin', self.start, end)], [10, 20])
+        self.assertEqual(len(price_series('bitcoin', self.start, end, resolution='1d')), 1)
+        self.assertEqual(price_series('ethereum', self.start, end), [])
+
+    def test_prune_keeps_daily_candles(self):
+        append_prices({'bitcoin': 10}, at=self.start)
+        deleted = prune_history(now=self.start + timedelta(days=30))
+        self.assertEqual(deleted, 2)  # the raw tick and the 1m candle
+        self.assertEqual(
+            sorted(PriceCandle.objects.values_list('resolution', flat=True)),
+            ['1d', '1h'],
+        )
+
+
+API_TOKEN = 'test-token'
+
+
+@override_settings(PORTFOLIO_API_TOKEN=API_TOKEN)
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f'Bearer {API_TOKEN}')
+        CoinPrice.objects.create(coin_id='bitcoin', price=30000)
+        CoinPrice.objects.create(coin_id='ethereum', price=1000)
+        self.portfolio = make_portfolio('1001', [('bitcoin', 1, 20000), ('ethereum', 2, 1500)])
+        TelegramUser.objects.create(user=self.portfolio.user, telegram_id=1001)
+        for n in range(5):
+            make_portfolio(f'other{n}', [('bitcoin', 1, 1)])
+
+    def test_snapshots_use_a_constant_number_of_queries(self):
+        with self.assertNumQueries(4):
+            self.assertEqual(take_snapshots(), 6)
+
+    def test_history_reads_snapshots_only(self):
+        take_snapshots(at=timezone.now() - timedelta(hours=1))
+        CoinPrice.objects.filter(coin_id='bitcoin').update(price=40000)
+        take_snapshots()
+        with self.assertNumQueries(1):
+            history = portfolio_history(self.portfolio)
+        self.assertEqual([point['value'] for point in history['series']], [Decimal(32000), Decimal(42000)])
+        self.assertEqual(history['pnl'], Decimal(19000))
+        self.assertEqual(history['best'], {'coin_id': 'bitcoin', 'pnl': Decimal(20000)})
+        self.assertEqual(history['worst'], {'coin_id': 'ethereum', 'pnl': Decimal(-1000)})
+
+    def test_history_view(self):
+        take_snapshots()
+        response = self.client.get('/api/portfolios/1001/history/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['best']['coin_id'], 'bitcoin')
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.get('/api/portfolios/42/history/').status_code, 404)
+            for days in ('0', '366', '100000000', 'x'):
+                self.assertEqual(self.client.get(f'/api/portfolios/1001/history/?days={days}').status_code, 400)
+
+
+@override_settings(PORTFOLIO_API_TOKEN=API_TOKEN)
+class ReadApiTests(TestCase):
+    def setUp(self):
+        self.client = Client(HTTP_AUTHORIZATION=f'Bearer {API_TOKEN}')
+        CoinPrice.objects.create(coin_id='bitcoin', price=30000)
+        CoinPrice.objects.create(coin_id='ethereum', price=1000)
+        self.portfolio = make_portfolio('1001', [('bitcoin', 1, 20000), ('ethereum', 2, 1500), ('delisted', 1, 5)])
+        TelegramUser.objects.create(user=self.portfolio.user, telegram_id=1001)
+
+    def test_holdings(self):
+        response = self.client.get('/api/portfolios/1001/holdings/')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([row['coin_id'] for row in body['holdings']], ['bitcoin', 'delisted', 'ethereum'])
+        self.assertEqual(Decimal(body['cost']), Decimal('23005.00'))
+        # unchanged holdings are answered from the version alone
+        with self.assertNumQueries(1):
+            cached = self.client.get('/api/portfolios/1001/holdings/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        record_buy(self.portfolio, 'bitcoin', 30000, 1)
+        self.assertEqual(
+            self.client.get('/api/portfolios/1001/holdings/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200,
+        )
+
+    def test_valuation(self):
+        response = self.client.get('/api/portfolios/1001/valuation/')
+        body = response.json()
+        self.assertEqual((Decimal(body['value']), Decimal(body['cost'])), (Decimal('32000.00'), Decimal('23000.00')))
+        self.assertEqual(Decimal(body['pnl']), Decimal('9000.00'))
+        self.assertIsNone(body['coins'][1]['value'])
+        self.assertIn('Last-Modified', response)
+        self.assertEqual(
+            self.client.get('/api/portfolios/1001/valuation/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304,
+        )
+        CoinPrice.objects.filter(coin_id='bitcoin').update(price=40000, updated_at=timezone.now() + timedelta(minutes=1))
+        response = self.client.get('/api/portfolios/1001/valuation/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(Decimal(response.json()['value']), Decimal('42000.00'))
+
+    def test_anonymous_requests_are_rejected(self):
+        urls = [f'/api/portfolios/1001/{name}/' for name in ('holdings', 'valuation', 'history')]
+        with self.assertLogs('django.request', 'WARNING'):
+            for client in (Client(), Client(HTTP_AUTHORIZATION='Bearer wrong')):
+                for url in urls:
+                    response = client.get(url)
+                    self.assertEqual(response.status_code, 401)
+                    self.assertNotIn('ETag', response)
+            # no token configured: a bare "Bearer " header must not match it
+            with override_settings(PORTFOLIO_API_TOKEN=''):
+                self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer ').get(urls[0]).status_code, 401)
+        staff = Client()
+        staff.force_login(User.objects.create_user('staff', is_staff=True))
+        with override_settings(PORTFOLIO_API_TOKEN=''):
+            self.assertEqual(staff.get(urls[0]).status_code, 200)
+
+    def test_unknown_user(self):
+        with self.assertLogs('django.request', 'WARNING'):
+            self.assertEqual(self.client.get('/api/portfolios/42/holdings/').status_code, 404)
+            self.assertEqual(self.client.get('/api/portfolios/42/valuation/').status_code, 404)
+
+    def test_totals_are_computed_in_the_list_query(self):
+        make_portfolio('empty', [])
+        with self.assertNumQueries(1):
+            totals = {
+                portfolio.user.username: (portfolio.coins, portfolio.cost, portfolio.value)
+                for portfolio in with_totals(Portfolio.objects.select_related('user'))
+            }
+        self.assertEqual(totals['1001'], (3, Decimal(23005), Decimal(32000)))
+        self.assertEqual(totals['empty'], (0, 0, 0))
+
+    def test_admin_holdings_are_read_only(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        change_page = self.client.get(f'/admin/portfolio/portfolio/{self.portfolio.pk}/change/')
+        self.assertContains(change_page, 'ethereum')
+        self.assertNotContains(change_page, 'name="usercoin_set-0-quantity"')
+        self.assertNotContains(change_page, 'name="usercoin_set-0-DELETE"')
+
+    def test_admin_trades_and_alerts_are_read_only(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        trade = Trade.objects.create(portfolio=self.portfolio, coin_id='bitcoin', side=Trade.BUY, quantity=1, price=10)
+        user = TelegramUser.objects.get(telegram_id=1001)
+        alert = PriceAlert.objects.create(user=user, coin_id='bitcoin', direction=PriceAlert.ABOVE, threshold=100)
+        for path, obj, field in [('trade', trade, 'quantity'), ('pricealert', alert, 'threshold')]:
+            change_page = self.client.get(f'/admin/portfolio/{path}/{obj.pk}/change/')
+            self.assertContains(change_page, 'bitcoin')
+            self.assertNotContains(change_page, f'name="{field}"')
+            with self.assertLogs('django.request', 'WARNING'):
+                self.assertEqual(self.client.post(f'/admin/portfolio/{path}/{obj.pk}/change/', {field: 5}).status_code, 403)
+                self.assertEqual(self.client.get(f'/admin/portfolio/{path}/add/').status_code, 403)
+                self.assertEqual(self.client.post(f'/admin/portfolio/{path}/{obj.pk}/delete/', {'post': 'yes'}).status_code, 403)
+        self.assertEqual(Trade.objects.get().quantity, 1)
+        self.assertEqual(PriceAlert.objects.get().threshold, 100)
+
+    def test_admin_changelist_query_count_does_not_grow(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+        def changelist_queries():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get('/admin/portfolio/portfolio/').status_code, 200)
+            return len(queries)
+
+        few = changelist_queries()
+        for n in range(5):
+            portfolio = make_portfolio(f'other{n}', [('bitcoin', 1, 1), ('ethereum', 1, 1)])
+            TelegramUser.objects.create(user=portfolio.user, telegram_id=2000 + n)
+        self.assertEqual(changelist_queries(), few)
+
+
+class SqlitePragmaTests(TestCase):
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -4000})
+    def test_pragmas_are_applied_to_new_connections(self):
+        configure_sqlite(sender=None, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -4000)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.portfolio = make_portfolio('trader', [])
+
+    def test_buys_keep_a_running_average(self):
+        record_buy(self.portfolio, 'bitcoin', 100, 1)
+        user_coin = record_buy(self.portfolio, 'bitcoin', 0.00000301, 3)
+        user_coin.refresh_from_db()
+        self.assertEqual(user_coin.quantity, 4)
+        self.assertEqual(user_coin.price, Decimal('25.00000226'))
+        self.assertEqual(user_coin.purchase_price, 100)
+        self.assertEqual(Trade.objects.filter(side=Trade.BUY).count(), 2)
+        self.assertEqual(CoinHistory.objects.filter(user_coin=user_coin).count(), 2)
+
+    def test_sell_is_a_conditional_update(self):
+        record_buy(self.portfolio, 'bitcoin', 100, 2)
+        with self.assertNumQueries(5):  # savepoint, update, insert, version, release
+            record_sell(self.portfolio, 'bitcoin', Decimal('0.5'), price=150)
+        with self.assertRaises(InsufficientQuantity):
+            record_sell(self.portfolio, 'bitcoin', 2)
+        with self.assertRaises(UserCoin.DoesNotExist):
+            record_sell(self.portfolio, 'ethereum', 1)
+        self.assertEqual(UserCoin.objects.get().quantity, Decimal('1.5'))
+        self.assertEqual(list(Trade.objects.filter(side=Trade.SELL).values_list('quantity', 'price')), [(Decimal('0.5'), 150)])
+
+    def test_rejects_non_positive_quantities(self):
+        with self.assertRaises(ValueError):
+            record_buy(self.portfolio, 'bitcoin', 100, 0)
+        with self.assertRaises(ValueError):
+            record_sell(self.portfolio, 'bitcoin', -1)
+
+    def test_holding_stays_below_the_column_limit(self):
+        record_buy(self.portfolio, 'bitcoin', 100, Decimal('9999999999'))
+        with self.assertRaises(QuantityTooLarge):
+            record_buy(self.portfolio, 'bitcoin', 100, 1)
+        with self.assertRaises(QuantityTooLarge):
+            record_buy(self.portfolio, 'ethereum', 100, Decimal('1e10'))
+        self.assertEqual(UserCoin.objects.get().quantity, Decimal('9999999999'))
+        self.assertEqual(Trade.objects.count(), 1)
+
+    def test_one_holding_per_coin(self):
+        UserCoin.objects.create(portfolio=self.portfolio, coin_id='bitcoin', quantity=1)
+        with self.assertRaises(IntegrityError):
+            UserCoin.objects.create(portfolio=self.portfolio, coin_id='bitcoin', quantity=1)
+
+
+class AlertIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = AlertIndex()
+        self.index.add(1, 'bitcoin', PriceAlert.ABOVE, 70000)
+        self.index.add(2, 'bitcoin', PriceAlert.ABOVE, 60000)
+        self.index.add(3, 'bitcoin', PriceAlert.BELOW, 20000)
+        self.index.add(4, 'bitcoin', PriceAlert.BELOW, 25000)
+        self.index.add(5, 'ethereum', PriceAlert.ABOVE, 5000)
+
+    def test_only_crossed_alerts_fire(self):
+        self.assertEqual(self.index.match({'bitcoin': 50000, 'ethereum': 100}), [])
+        self.assertEqual(sorted(self.index.match({'bitcoin': 65000.0})), [2])
+        self.assertEqual(sorted(self.index.match({'bitcoin': 24000, 'ethereum': 5000})), [4, 5])
+        self.assertEqual(len(self.index), 2)
+
+    def test_fired_alerts_do_not_fire_again(self):
+        self.assertEqual(sorted(self.index.match({'bitcoin': 80000})), [1, 2])
+        self.assertEqual(self.index.match({'bitcoin': 80000}), [])
+
+    def test_removed_alerts_do_not_fire(self):
+        self.index.remove(3)
+        self.assertEqual(self.index.match({'bitcoin': 10000}), [4])
+
+
+class PriceAlertTests(TestCase):
+    def setUp(self):
+        portfolio = make_portfolio('alerts', [('solana', 1, 10)])
+        self.user = TelegramUser.objects.create(user=portfolio.user, telegram_id=2002)
+
+    def alert(self, coin_id, direction, threshold):
+        return PriceAlert.objects.create(user=self.user, coin_id=coin_id, direction=direction, threshold=threshold)
+
+    def test_new_alerts_are_loaded_incrementally(self):
+        index = AlertIndex()
+        self.alert('bitcoin', PriceAlert.ABOVE, 100)
+        load_new_alerts(index)
+        self.alert('bitcoin', PriceAlert.BELOW, 50)
+        with self.assertNumQueries(1):
+            load_new_alerts(index)
+        self.assertEqual(len(index), 2)
+
+    def test_mark_fired_skips_deleted_alerts(self):
+        kept = self.alert('bitcoin', PriceAlert.ABOVE, 100)
+        deleted = self.alert('bitcoin', PriceAlert.ABOVE, 90)
+        deleted.delete()
+        self.assertEqual(mark_fired([kept.pk, deleted.pk]), [(2002, 'bitcoin', PriceAlert.ABOVE, Decimal(100))])
+        self.assertEqual(mark_fired([kept.pk]), [])
+
+    def test_coins_with_pending_alerts_are_tracked(self):
+        self.alert('bitcoin', PriceAlert.ABOVE, 100)
+        self.alert('solana', PriceAlert.ABOVE, 100)
+        self.assertEqual(sorted(tracked_coin_ids()), ['bitcoin', 'solana'])
+
+
+class PriceBusTests(SimpleTestCase):
+    def test_every_subscriber_gets_merged_updates(self):
+        async def main():
+            bus = PriceBus()
+            received = {'fast': [], 'slow': []}
+
+            async def fast(prices):
+                received['fast'].append(prices)
+
+            async def slow(prices):
+                received['slow'].append(prices)
+                await asyncio.sleep(0.05)
+
+            bus.subscribe(fast)
+            bus.subscribe(slow)
+            bus.publish({'bitcoin': 1})
+            await asyncio.sleep(0.01)
+            bus.publish({'bitcoin': 2})
+            bus.publish({'ethereum': 3})
+            await asyncio.sleep(0.1)
+            await bus.close()
+            return received
+
+        received = asyncio.run(main())
+        self.assertEqual(received['fast'], [{'bitcoin': 1}, {'bitcoin': 2, 'ethereum': 3}])
+        self.assertEqual(received['slow'], [{'bitcoin': 1}, {'bitcoin': 2, 'ethereum': 3}])
+
+
+class RecordingBus:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, prices):
+        if prices:
+            self.published.append(prices)
+
+
+class PriceFeedTests(SimpleTestCase):
+    def test_polling_feed_publishes_only_moved_coins(self):
+        quotes = {'bitcoin': 1, 'ethereum': 2}
+
+        async def fetcher(coin_ids):
+            return {coin_id: quotes[coin_id] for coin_id in coin_ids}
+
+        bus = RecordingBus()
+        feed = RestPollingFeed(bus, cache=PriceCache(fetcher=fetcher))
+        feed.set_coins(['bitcoin', 'ethereum'])
+        asyncio.run(feed.poll())
+        quotes['ethereum'] = 3
+        asyncio.run(feed.poll())
+        asyncio.run(feed.poll())
+        self.assertEqual(bus.published, [{'bitcoin': 1, 'ethereum': 2}, {'ethereum': 3}])
+
+    def test_streaming_feed_against_a_local_feed_server(self):
+        requests = []
+
+        async def stream(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            async for message in ws:
+                requests.append(message.json())
+                if message.json()['action'] == 'subscribe':
+                    await ws.send_json({'prices': {coin_id: 10 for coin_id in message.json()['coins']}})
+                    await ws.send_json({'prices': {'dogecoin': 1}})
+            return ws
+
+        async def main():
+            app = web.Application()
+            app.router.add_get('/stream', stream)
+            bus = RecordingBus()
+            async with TestServer(app) as server:
+                feed = StreamingFeed(bus, str(server.make_url('/stream')))
+                feed.set_coins(['bitcoin'])
+                task = asyncio.ensure_future(feed.run())
+                await asyncio.sleep(0.2)
+                feed.set_coins(['ethereum'])
+                await asyncio.sleep(0.2)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            return bus.published
+
+        published = asyncio.run(main())
+        self.assertEqual(requests, [
+            {'action': 'subscribe', 'coins': ['bitcoin']},
+            {'action': 'subscribe', 'coins': ['ethereum']},
+            {'action': 'unsubscribe', 'coins': ['bitcoin']},
+        ])
+        self.assertEqual(published, [{'bitcoin': 10}, {'ethereum': 10}])
+
+    def test_streaming_feed_survives_a_malformed_message(self):
+        connections = []
+
+        async def stream(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            connections.append(ws)
+            async for message in ws:
+                # a JSON list instead of an object on the first connection
+                await ws.send_json([1, 2] if len(connections) == 1 else {'prices': {'bitcoin': 10}})
+            return ws
+
+        async def main():
+            app = web.Application()
+            app.router.add_get('/stream', stream)
+            bus = RecordingBus()
+            async with TestServer(app) as server:
+                feed = StreamingFeed(bus, str(server.make_url('/stream')), max_backoff=0.01)
+                feed.set_coins(['bitcoin'])
+                task = asyncio.ensure_future(feed.run())
+                await asyncio.sleep(0.3)
+                self.assertFalse(task.done())
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            return bus.published
+
+        with self.assertLogs('portfolio.feeds', 'ERROR'):
+            published = asyncio.run(main())
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(published, [{'bitcoin': 10}])
+
+
+class FxRatesTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.clock = FakeClock()
+
+        async def fetcher(currencies):
+            self.calls.append(list(currencies))
+            return {currency: price for currency, price in {'usd': 50000, 'eur': 40000, 'rub': 5000000}.items()
+                    if currency in currencies}
+
+        self.rates = FxRates(fetcher=fetcher, ttl=60, clock=self.clock)
+
+    def test_all_currencies_are_fetched_in_one_request(self):
+        async_to_sync(self.rates.refresh)(['eur', 'rub'])
+        self.assertEqual(async_to_sync(self.rates.rate)('eur'), Decimal('0.8'))
+        self.assertEqual(async_to_sync(self.rates.rate)('usd', 'rub'), Decimal('0.01'))
+        self.assertEqual(self.calls, [['eur', 'rub', 'usd']])
+
+    def test_stale_or_unknown_rates_are_refetched(self):
+        async_to_sync(self.rates.rate)('eur')
+        self.clock.now = 60
+        async_to_sync(self.rates.rate)('eur')
+        self.assertIsNone(async_to_sync(self.rates.rate)('xyz'))
+        self.assertEqual(self.calls, [['eur', 'usd'], ['eur', 'usd'], ['eur', 'usd', 'xyz']])
+        self.assertNotIn('xyz', self.rates.currencies)
+
+    def test_display_currencies(self):
+        for telegram_id, currency in [(1, 'usd'), (2, 'eur'), (3, 'eur'), (4, 'btc')]:
+            user = User.objects.create(username=str(telegram_id))
+            TelegramUser.objects.create(user=user, telegram_id=telegram_id, currency=currency)
+        self.assertEqual(display_currencies(), {'usd', 'eur'})
+
+
+class FakeBot:
+    def __init__(self, failures=None):
+        self.sent = []
+        self.failures = failures or {}  # text -> errors raised by the next sends
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        if self.failures.get(text):
+            raise self.failures[text].pop(0)
+        self.sent.append((chat_id, text))
+        return len(self.sent)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.sent.append((chat_id, message_id, text))
+        return True
+
+
+class SendQueueTests(SimpleTestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+        bucket.consume()
+        bucket.consume()
+        self.assertEqual(bucket.wait_time(), 0.5)
+        clock.now = 0.5
+        self.assertEqual(bucket.wait_time(), 0)
+
+    def run_queue(self, queue, fill, duration=0.3):
+        async def main():
+            futures = fill()
+            queue.start()
+            await asyncio.sleep(duration)
+            await queue.close()
+            return futures
+
+        return asyncio.run(main())
+
+    def test_interactive_replies_go_ahead_of_broadcasts(self):
+        bot = FakeBot()
+        queue = SendQueue(bot, chat_rate=100, chat_burst=100)
+
+        def fill():
+            for chat_id in range(3):
+                queue.broadcast(chat_id, 'alert')
+            self.assertEqual(queue.depth(), {'interactive': 0, 'broadcast': 3})
+            return [queue.send(10, 'reply')]
+
+        reply, = self.run_queue(queue, fill)
+        self.assertEqual(bot.sent[0], (10, 'reply'))
+        self.assertEqual(reply.result(), 1)
+        self.assertEqual(queue.depth(), {'interactive': 0, 'broadcast': 0})
+
+    def test_throttled_chat_does_not_hold_up_others(self):
+        bot = FakeBot()
+        queue = SendQueue(bot, chat_rate=10, chat_burst=1)
+
+        def fill():
+            return [queue.send(1, 'first'), queue.send(1, 'second'), queue.send(2, 'other')]
+
+        self.run_queue(queue, fill)
+        self.assertEqual(bot.sent, [(1, 'first'), (2, 'other'), (1, 'second')])
+        self.assertEqual(queue.stats['throttled'], 1)
+
+    def test_retry_after_is_retried(self):
+        bot = FakeBot(failures={'reply': [RetryAfter(0)], 'blocked': [BotBlocked('blocked')]})
+        queue = SendQueue(bot)
+
+        def fill():
+            return [queue.send(1, 'reply'), queue.send(1, 'blocked')]
+
+        reply, blocked = self.run_queue(queue, fill)
+        self.assertEqual(reply.result(), 1)
+        self.assertIsInstance(blocked.exception(), BotBlocked)
+        self.assertEqual((queue.stats['sent'], queue.stats['retried'], queue.stats['failed']), (1, 1, 1))
+
+    def test_edit_text(self):
+        bot = FakeBot()
+        queue = SendQueue(bot)
+
+        def fill():
+            return [queue.edit_text(1, 42, 'page 2', parse_mode='Markdown')]
+
+        edited, = self.run_queue(queue, fill)
+        self.assertIs(edited.result(), True)
+        self.assertEqual(bot.sent, [(1, 42, 'page 2')])
+
+
+class BenchmarkHelperTests(TestCase):
+    def test_percentile(self):
+        latencies = list(range(1, 101))
+        self.assertEqual((percentile(latencies, 0.5), percentile(latencies, 0.99)), (50, 99))
+        self.assertEqual(percentile([7], 0.99), 7)
+
+    def test_seed_and_count_queries(self):
+        coin_ids, held = seed(users=3, coins=20, holdings=5)
+        self.assertEqual(len(coin_ids), 20)
+        self.assertEqual(sorted(held), [1000, 1001, 1002])
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            self.assertEqual(UserCoin.objects.count(), 15)
+            self.assertEqual(TelegramUser.objects.count(), 3)
+        self.assertEqual(counter.count, 2)
+
+
+class MetricsTests(TestCase):
+    def test_render_prometheus_text(self):
+        registry = Metrics()
+        registry.inc('bot_updates_total', handler='cmd_portfolio')
+        registry.inc('bot_updates_total', 2, handler='cmd_portfolio')
+        registry.observe('bot_update_seconds', 0.02, handler='cmd_portfolio')
+        registry.observe('bot_update_seconds', 30, handler='cmd_portfolio')
+        registry.collect('queue_depth', lambda: {(('lane', 'broadcast'),): 4})
+        registry.collect('cache_entries', lambda: 7)
+        text = registry.render()
+        self.assertIn('# TYPE bot_updates_total counter\nbot_updates_total{handler="cmd_portfolio"} 3\n', text)
+        self.assertIn('bot_update_seconds_bucket{handler="cmd_portfolio",le="0.01"} 0\n', text)
+        self.assertIn('bot_update_seconds_bucket{handler="cmd_portfolio",le="0.025"} 1\n', text)
+        self.assertIn('bot_update_seconds_bucket{handler="cmd_portfolio",le="10"} 1\n', text)
+        self.assertIn('bot_update_seconds_bucket{handler="cmd_portfolio",le="+Inf"} 2\n', text)
+        self.assertIn('bot_update_seconds_count{handler="cmd_portfolio"} 2\n', text)
+        self.assertIn('queue_depth{lane="broadcast"} 4\n', text)
+        self.assertIn('cache_entries 7\n', text)
+
+    def test_queries_are_counted_per_update_across_threads(self):
+        async def update():
+            current_queries.set(QueryCount())
+            await sync_to_async(lambda: list(Portfolio.objects.all()))()
+            await sync_to_async(lambda: Portfolio.objects.count())()
+            return current_queries.get().count
+
+        self.assertEqual(async_to_sync(update)(), 2)
+
+    def test_metrics_endpoint(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE coingecko_requests_total counter', response.content)
+
+
+class TradeTransferTests(TestCase):
+    def setUp(self):
+        self.portfolio = make_portfolio('importer', [('bitcoin', 1, 100)])
+        self.known = {'bitcoin', 'ethereum'}.__contains__
+
+    def test_streaming_json_array(self):
+        stream = io.StringIO('[{"coin_id": "a", "note": "[,]"} ,\n {"coin_id": "b", "x": {"y": 1}}]')
+        self.assertEqual(list(iter_json_array(stream, chunk_size=3)), [
+            {'coin_id': 'a', 'note': '[,]'},
+            {'coin_id': 'b', 'x': {'y': 1}},
+        ])
+        self.assertEqual(list(iter_json_array(io.StringIO(' [ ] '))), [])
+        with self.assertRaises(ValueError):
+            list(iter_json_array(io.StringIO('[{"coin_id": "a"}')))
+
+    def test_import_csv_updates_holdings_in_bulk(self):
+        stream = io.StringIO(
+            "coin_id,side,quantity,price,date\n"
+            "bitcoin,buy,1,300,2023-01-02\n"
+            "ethereum,buy,2,10,\n"
+            "ethereum,sell,0.5,,2023-01-03T10:00:00\n"
+        )
+        with self.assertNumQueries(9):
+            result = import_trades(self.portfolio, read_records(stream, 'csv'), is_known=self.known)
+        self.assertEqual((result.trades, result.coins, result.created), (3, 2, 1))
+        holdings = {coin.coin_id: (coin.quantity, coin.price) for coin in UserCoin.objects.filter(portfolio=self.portfolio)}
+        self.assertEqual(holdings, {'bitcoin': (Decimal('2'), Decimal('200')), 'ethereum': (Decimal('1.5'), Decimal('10'))})
+        self.assertEqual(Trade.objects.filter(portfolio=self.portfolio).count(), 3)
+        self.assertEqual(CoinHistory.objects.filter(user_coin__portfolio=self.portfolio).count(), 2)
+
+    def test_invalid_file_changes_nothing(self):
+        records = [
+            {'coin_id': 'ethereum', 'quantity': '1', 'price': '10'},
+            {'coin_id': 'notacoin', 'quantity': '1', 'price': '10'},
+            {'coin_id': 'bitcoin', 'side': 'sell', 'quantity': '5'},
+            {'coin_id': 'bitcoin', 'quantity': 'many', 'price': '1'},
+        ]
+        with self.assertRaises(TradeImportError) as raised:
+            import_trades(self.portfolio, records, is_known=self.known)
+        self.assertEqual([line for line, _ in raised.exception.errors], [2, 3, 4])
+        self.assertFalse(Trade.objects.exists())
+        self.assertEqual(UserCoin.objects.filter(portfolio=self.portfolio).count(), 1)
+
+    def test_quantities_and_prices_fit_the_ledger_columns(self):
+        records = [
+            {'coin_id': 'ethereum', 'quantity': '100000000000', 'price': '1'},
+            {'coin_id': 'ethereum', 'quantity': '1', 'price': '1e10'},
+            {'coin_id': 'ethereum', 'quantity': '0.000000001', 'price': '1'},
+            {'coin_id': 'ethereum', 'quantity': '1', 'price': '1'},
+        ]
+        with self.assertRaises(TradeImportError) as raised:
+            import_trades(self.portfolio, records, is_known=self.known)
+        self.assertEqual([line for line, _ in raised.exception.errors], [1, 2, 3])
+
+        records = [
+            {'coin_id': 'bitcoin', 'quantity': '6000000000', 'price': '1'},
+            {'coin_id': 'bitcoin', 'quantity': '3999999999', 'price': '1'},
+        ]
+        with self.assertRaises(TradeImportError) as raised:
+            import_trades(self.portfolio, records, is_known=self.known)
+        self.assertEqual([line for line, _ in raised.exception.errors], [2])
+        self.assertIn('bitcoin, the limit is 10000000000', raised.exception.errors[0][1])
+        self.assertFalse(Trade.objects.exists())
+
+    def test_export_round_trip(self):
+        import_trades(self.portfolio, [
+            {'coin_id': 'ethereum', 'quantity': '2', 'price': '10.5', 'date': '2023-01-02'},
+            {'coin_id': 'ethereum', 'side': 'sell', 'quantity': '1'},
+        ], is_known=self.known)
+        exported = ''.join(export_trades(self.portfolio, 'json'))
+        records = list(read_records(io.StringIO(exported), 'json'))
+        self.assertEqual([(r['coin_id'], r['side'], r['quantity'], r['price']) for r in records], [
+            ('ethereum', 'buy', '2', '10.5'),
+            ('ethereum', 'sell', '1', None),
+        ])
+        csv_lines = ''.join(export_trades(self.portfolio, 'csv')).splitlines()
+        self.assertEqual(csv_lines[0], 'coin_id,side,quantity,price,date')
+        self.assertTrue(csv_lines[1].startswith('ethereum,buy,2,10.5,2023-01-02T00:00:00'))
+
+
+class FakeMarkets:
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = []
+
+    async def coins_markets(self, coin_ids, vs_currency='usd', per_page=250, page=1):
+        self.calls.append((list(coin_ids), page))
+        found = [{'id': coin_id, 'current_price': self.prices[coin_id]} for coin_id in coin_ids if coin_id in self.prices]
+        return found[(page - 1) * per_page:page * per_page]
+
+
+class JobTests(TestCase):
+    def test_market_prices_are_paginated(self):
+        markets = FakeMarkets({'a': 1, 'b': 2, 'c': 3, 'd': None, 'e': 5})
+        with mock.patch('portfolio.quotes.client', markets):
+            prices = async_to_sync(fetch_market_prices)(['a', 'b', 'c', 'd', 'e'], chunk_size=4, per_page=2)
+        self.assertEqual(prices, {'a': 1, 'b': 2, 'c': 3, 'e': 5})
+        self.assertEqual(markets.calls, [(['a', 'b', 'c', 'd'], 1), (['a', 'b', 'c', 'd'], 2), (['e'], 1)])
+
+    def test_job_runs_once_per_slot(self):
+        runs = []
+
+        async def work():
+            runs.append(1)
+            return "done"
+
+        job = Job('work', work, interval=60)
+        with self.assertLogs('portfolio.jobs', 'INFO') as logs:
+            self.assertEqual(async_to_sync(run_job)(job), 'ok')
+        self.assertIn('job finished name=work', logs.output[0])
+        self.assertEqual(async_to_sync(run_job)(job), 'skipped')
+        self.assertEqual(len(runs), 1)
+        self.assertGreater(Lease.objects.get(name='job:work').expires_at, timezone.now() + timedelta(seconds=50))
+
+    def test_failing_and_slow_jobs(self):
+        async def fail():
+            raise RuntimeError("boom")
+
+        async def hang():
+            await asyncio.sleep(1)
+
+        with self.assertLogs('portfolio.jobs', 'WARNING'):
+            self.assertEqual(async_to_sync(run_job)(Job('fail', fail, interval=60)), 'error')
+            self.assertEqual(async_to_sync(run_job)(Job('hang', hang, interval=0.01, jitter=0)), 'timeout')
+
+    def test_job_waits_for_the_leader_lease(self):
+        runs = []
+
+        async def work():
+            runs.append(1)
+
+        job = Job('prices', work, interval=60, lease='price-refresher')
+        # the bot leader is running its price feed
+        acquire_lease('price-refresher', holder='bot-worker', ttl=60)
+        self.assertEqual(async_to_sync(run_job)(job), 'skipped')
+        Lease.objects.update(expires_at=timezone.now())
+        with self.assertLogs('portfolio.jobs', 'INFO'):
+            self.assertEqual(async_to_sync(run_job)(job), 'ok')
+        self.assertEqual(len(runs), 1)
+        self.assertFalse(acquire_lease('price-refresher', holder='bot-worker'))
+
+    def test_slot_outlives_the_timeout(self):
+        for job in [Job('default', None, interval=60), Job('slow', None, interval=60, timeout=300)]:
+            self.assertGreaterEqual(job.slot_ttl, 2 * job.run_timeout)
+        self.assertEqual((PRICES.run_timeout, PRICES.slot_ttl), (27, 54))
+
+    def test_runner_schedules_with_jitter(self):
+        clock = FakeClock()
+        rng = mock.Mock()
+        rng.uniform.side_effect = lambda low, high: high
+        jobs = [Job('fast', None, interval=10), Job('slow', None, interval=100)]
+        runner = JobRunner(jobs, clock=clock, rng=rng)
+        self.assertEqual([runner.schedule(job, first=True) for job in jobs], [1, 10])
+        self.assertEqual(runner.next_job().name, 'fast')
+        clock.now = 1
+        self.assertEqual(runner.schedule(jobs[0]), 12)
+        self.assertEqual(runner.next_job().name, 'slow')
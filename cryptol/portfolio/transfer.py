@@ -0,0 +1,269 @@
+import csv
+import io
+import json
+from dataclasses import dataclass
+from datetime import datetime, time, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+from typing import Optional
+
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .ledger import MAX_QUANTITY, MIN_QUANTITY, PRICE_PLACES, bump_version
+from .models import CatalogCoin, CoinHistory, Trade, UserCoin
+
+BATCH_SIZE = 500
+MAX_ERRORS = 20
+MAX_JSON_ITEM = 64 * 1024
+FIELDS = ['coin_id', 'side', 'quantity', 'price', 'date']
+
+
+class TradeImportError(Exception):
+    """The file was rejected; `errors` holds (line, message) pairs."""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(f"{line}: {message}" for line, message in errors))
+        self.errors = errors
+
+
+@dataclass
+class ImportResult:
+    trades: int
+    coins: int
+    created: int
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield the objects of a top-level JSON array, reading the stream chunk by chunk."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+
+    def more():
+        nonlocal buffer
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("unexpected end of JSON")
+        buffer += chunk
+
+    def next_char():
+        nonlocal buffer
+        buffer = buffer.lstrip()
+        while not buffer:
+            more()
+            buffer = buffer.lstrip()
+        return buffer[0]
+
+    if next_char() != '[':
+        raise ValueError("expected a JSON array")
+    buffer = buffer[1:]
+    if next_char() == ']':
+        return
+    while True:
+        next_char()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer)
+                break
+            except json.JSONDecodeError:
+                if len(buffer) > MAX_JSON_ITEM:
+                    raise ValueError("invalid JSON")
+                more()
+        if not isinstance(item, dict):
+            raise ValueError("expected an array of objects")
+        yield item
+        buffer = buffer[end:]
+        separator = next_char()
+        buffer = buffer[1:]
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError("invalid JSON")
+
+
+def read_records(stream, fmt):
+    """Raw trade records from a text stream, 'csv' (with a header row) or 'json'."""
+    if fmt == 'csv':
+        return csv.DictReader(stream)
+    if fmt == 'json':
+        return iter_json_array(stream)
+    raise ValueError(f"unknown format: {fmt}")
+
+
+def _decimal(value, name):
+    try:
+        number = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(f"{name} is not a number")
+    if not number.is_finite() or number < 0:
+        raise ValueError(f"{name} must be a non-negative number")
+    # prices and quantities share the DecimalField(18, 8) columns of the ledger
+    if number >= MAX_QUANTITY:
+        raise ValueError(f"{name} must be less than {MAX_QUANTITY:f}")
+    return number
+
+
+def _datetime(value):
+    value = str(value).strip()
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError("date must be YYYY-MM-DD or an ISO 8601 timestamp")
+        parsed = datetime.combine(day, time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+@dataclass
+class TradeRecord:
+    coin_id: str
+    side: str
+    quantity: Decimal
+    price: Optional[Decimal]
+    created_at: datetime
+
+
+def parse_record(record):
+    """Validate one raw record; raises ValueError with a message for the user."""
+    coin_id = str(record.get('coin_id') or '').strip().lower()
+    if not coin_id:
+        raise ValueError("coin_id is required")
+    side = str(record.get('side') or Trade.BUY).strip().lower()
+    if side not in (Trade.BUY, Trade.SELL):
+        raise ValueError("side must be buy or sell")
+    quantity = _decimal(record.get('quantity', ''), 'quantity')
+    if quantity < MIN_QUANTITY:
+        raise ValueError(f"quantity must be at least {MIN_QUANTITY:f}")
+    price = record.get('price')
+    price = None if price in (None, '') else _decimal(price, 'price')
+    if side == Trade.BUY and price is None:
+        raise ValueError("price is required for a buy")
+    date = record.get('date')
+    created_at = timezone.now() if date in (None, '') else _datetime(date)
+    return TradeRecord(coin_id, side, quantity, price, created_at)
+
+
+def catalog_lookup():
+    """Membership test against the local CatalogCoin table, loaded in one query."""
+    known = set(CatalogCoin.objects.values_list('coin_id', flat=True))
+    return known.__contains__
+
+
+def import_trades(portfolio, records, is_known=None):
+    """Validate raw records and store them as trades, holdings and history in one transaction.
+
+    Records are checked one by one as they are read and trades are written
+    in batches, so the whole file is never held in memory; any invalid
+    record rolls everything back and TradeImportError lists what was wrong.
+    Holdings follow the trades in file order, with the same running average
+    price as /add.
+    """
+    is_known = is_known or catalog_lookup()
+    errors = []
+    trades = []
+    history = []  # (coin_id, price) of every buy
+    count = 0
+    with transaction.atomic():
+        holdings = {
+            coin.coin_id: coin
+            for coin in UserCoin.objects.select_for_update().filter(portfolio=portfolio)
+        }
+        existing = set(holdings)
+        changed = set()
+        for line, record in enumerate(records, 1):
+            try:
+                trade = parse_record(record)
+                if not is_known(trade.coin_id):
+                    raise ValueError(f"unknown coin {trade.coin_id}")
+                holding = holdings.get(trade.coin_id)
+                held = (holding.quantity or 0) if holding else 0
+                if trade.side == Trade.SELL and trade.quantity > held:
+                    raise ValueError(f"cannot sell {trade.quantity} {trade.coin_id}, only {held} held")
+                if trade.side == Trade.BUY and held + trade.quantity >= MAX_QUANTITY:
+                    raise ValueError(f"cannot hold {held + trade.quantity} {trade.coin_id}, the limit is {MAX_QUANTITY:f}")
+            except ValueError as e:
+                errors.append((line, str(e)))
+                if len(errors) >= MAX_ERRORS:
+                    break
+                continue
+            if errors:
+                continue  # only validating from here on
+            if trade.side == Trade.BUY:
+                if holding is None:
+                    holding = holdings[trade.coin_id] = UserCoin(
+                        portfolio=portfolio, coin_id=trade.coin_id,
+                        price=trade.price, purchase_price=trade.price, quantity=0,
+                    )
+                total = held + trade.quantity
+                holding.price = ((holding.price * held + trade.price * trade.quantity) / total).quantize(PRICE_PLACES)
+                holding.quantity = total
+                history.append((trade.coin_id, trade.price))
+            else:
+                holding.quantity = held - trade.quantity
+            changed.add(trade.coin_id)
+            trades.append(Trade(
+                portfolio=portfolio, coin_id=trade.coin_id, side=trade.side,
+                quantity=trade.quantity, price=trade.price, created_at=trade.created_at,
+            ))
+            count += 1
+            if len(trades) >= BATCH_SIZE:
+                Trade.objects.bulk_create(trades)
+                trades = []
+        if errors:
+            raise TradeImportError(errors)
+        Trade.objects.bulk_create(trades)
+        UserCoin.objects.bulk_update(
+            [holdings[coin_id] for coin_id in changed & existing], ['price', 'quantity'], batch_size=BATCH_SIZE,
+        )
+        created = [holdings[coin_id] for coin_id in changed - existing]
+        UserCoin.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        # bulk_create does not return primary keys on every backend
+        ids = dict(UserCoin.objects.filter(portfolio=portfolio).values_list('coin_id', 'pk'))
+        CoinHistory.objects.bulk_create(
+            [CoinHistory(user_coin_id=ids[coin_id], price=price) for coin_id, price in history],
+            batch_size=BATCH_SIZE,
+        )
+        bump_version(portfolio)
+    return ImportResult(trades=count, coins=len(changed), created=len(created))
+
+
+def _plain(value):
+    return '' if value is None else f'{value.normalize():f}'
+
+
+def export_trades(portfolio, fmt):
+    """Yield the trade ledger of a portfolio as CSV or JSON text chunks, oldest first.
+
+    Rows are read through a server-side iterator and written out one by one,
+    so exporting a large ledger needs constant memory.
+    """
+    rows = (
+        Trade.objects.filter(portfolio=portfolio)
+        .order_by('created_at', 'pk')
+        .values_list('coin_id', 'side', 'quantity', 'price', 'created_at')
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FIELDS)
+        for coin_id, side, quantity, price, created_at in rows:
+            writer.writerow([coin_id, side, _plain(quantity), _plain(price), created_at.isoformat()])
+            if buffer.tell() >= 8192:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    elif fmt == 'json':
+        yield '['
+        separator = '\n'
+        for coin_id, side, quantity, price, created_at in rows:
+            yield separator + json.dumps(dict(zip(FIELDS, [
+                coin_id, side, _plain(quantity), _plain(price) or None, created_at.isoformat(),
+            ])))
+            separator = ',\n'
+        yield '\n]\n'
+    else:
+        raise ValueError(f"unknown format: {fmt}")
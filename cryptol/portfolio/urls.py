@@ -0,0 +1,9 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('portfolios/<int:telegram_id>/holdings/', views.holdings, name='portfolio-holdings'),
+    path('portfolios/<int:telegram_id>/valuation/', views.valuation, name='portfolio-valuation'),
+    path('portfolios/<int:telegram_id>/history/', views.history, name='portfolio-history'),
+]
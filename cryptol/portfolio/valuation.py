@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+from decimal import Decimal, ROUND_DOWN
+from typing import List
+
+from .models import UserCoin
+
+CENTS = Decimal('0.00')
+ZERO = Decimal(0)
+
+
+def to_cents(value):
+    return value.quantize(CENTS, rounding=ROUND_DOWN)
+
+
+def percent(part, whole):
+    return to_cents(part / whole * 100) if whole else CENTS
+
+
+@dataclass
+class Holding:
+    coin_id: str
+    quantity: Decimal
+    average_price: Decimal
+
+
+@dataclass
+class CoinValuation:
+    coin_id: str
+    quantity: Decimal
+    average_price: Decimal
+    current_price: Decimal
+    value: Decimal
+    cost: Decimal
+    price_change: Decimal
+    pnl: Decimal
+    pnl_percent: Decimal
+
+
+@dataclass
+class PortfolioValuation:
+    coins: List[CoinValuation] = field(default_factory=list)
+    missing_quantity: List[str] = field(default_factory=list)
+    missing_price: List[str] = field(default_factory=list)
+    value: Decimal = CENTS
+    cost: Decimal = CENTS
+    pnl: Decimal = CENTS
+    pnl_percent: Decimal = CENTS
+
+
+def load_holdings(portfolio):
+    """All holdings of a portfolio as plain records, in a single query."""
+    rows = UserCoin.objects.filter(portfolio=portfolio).values_list('coin_id', 'quantity', 'price')
+    return [Holding(coin_id, quantity, average_price) for coin_id, quantity, average_price in rows]
+
+
+def value_portfolio(holdings, prices, rate=1):
+    """Value holdings against a {coin_id: price} snapshot in one pass.
+
+    Prices are in USD; `rate` converts them to the display currency before
+    rounding. Amounts are rounded down to cents the same way /portfolio always
+    showed them, and coins come largest position first. Holdings without a
+    quantity or a price are reported separately instead of being valued.
+    """
+    rate = Decimal(str(rate))
+    result = PortfolioValuation()
+    value = cost = ZERO
+    for holding in holdings:
+        if holding.quantity is None:
+            result.missing_quantity.append(holding.coin_id)
+            continue
+        price = prices.get(holding.coin_id)
+        if price is None:
+            result.missing_price.append(holding.coin_id)
+            continue
+        quantity = to_cents(Decimal(holding.quantity))
+        current_price = to_cents(Decimal(str(price)) * rate)
+        average_price = to_cents(Decimal(holding.average_price) * rate)
+        coin_value = to_cents(quantity * current_price)
+        coin_cost = to_cents(average_price * quantity)
+        price_change = to_cents(current_price - average_price)
+        result.coins.append(CoinValuation(
+            coin_id=holding.coin_id,
+            quantity=quantity,
+            average_price=average_price,
+            current_price=current_price,
+            value=coin_value,
+            cost=coin_cost,
+            price_change=price_change,
+            pnl=to_cents(price_change * quantity),
+            pnl_percent=percent(price_change, average_price),
+        ))
+        value += coin_value
+        cost += coin_cost
+    result.coins.sort(key=lambda coin: coin.value, reverse=True)
+    result.value = to_cents(value)
+    result.cost = to_cents(cost)
+    result.pnl = to_cents(value - cost)
+    result.pnl_percent = percent(value - cost, cost)
+    return result
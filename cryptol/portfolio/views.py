@@ -1,10 +1,127 @@
-from django.shortcuts import render
+from functools import wraps
 
-# Create your views here.
-from apscheduler.schedulers.background import BackgroundScheduler
-from .utils import update_prices
+from django.conf import settings
+from django.db.models import Max
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import condition, require_GET
 
-def start():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(update_prices, 'interval', minutes=1)
-    scheduler.start()
+from .metrics import metrics
+from .models import Portfolio, PortfolioSnapshot
+from .queries import holdings_cost, holdings_totals, prices_updated, valued_holdings
+from .snapshots import portfolio_history
+from .valuation import CENTS, percent, to_cents
+
+# the widest window the history view serves
+HISTORY_MAX_DAYS = 365
+
+def api_auth(view):
+    """Let staff sessions and requests bearing settings.PORTFOLIO_API_TOKEN through, answer 401 otherwise.
+
+    Checked before the conditional-response lookups, so anonymous callers
+    learn nothing from ETags or 404s either.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = settings.PORTFOLIO_API_TOKEN
+        bearer = request.headers.get('Authorization', '')
+        if request.user.is_staff or (token and constant_time_compare(bearer, f'Bearer {token}')):
+            return view(request, *args, **kwargs)
+        return JsonResponse({'error': 'authentication required'}, status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return wrapper
+
+def portfolio_state(request, telegram_id):
+    """(id, version, prices updated at) of the user's portfolio, read once per request.
+
+    The holdings version and the price timestamp are all the conditional
+    responses need, so unchanged data is answered with a 304 after this
+    single query.
+    """
+    if not hasattr(request, 'portfolio_state'):
+        request.portfolio_state = (
+            Portfolio.objects.filter(user__telegramuser__telegram_id=telegram_id)
+            .annotate(prices_updated=prices_updated())
+            .values_list('pk', 'version', 'prices_updated')
+            .first()
+        )
+    if request.portfolio_state is None:
+        raise Http404("No portfolio for this Telegram user")
+    return request.portfolio_state
+
+def holdings_etag(request, telegram_id):
+    portfolio_id, version, _ = portfolio_state(request, telegram_id)
+    return f'{portfolio_id}-{version}'
+
+def valuation_etag(request, telegram_id):
+    portfolio_id, version, updated = portfolio_state(request, telegram_id)
+    return f'{portfolio_id}-{version}-{updated.timestamp() if updated else 0}'
+
+def valuation_last_modified(request, telegram_id):
+    return portfolio_state(request, telegram_id)[2]
+
+def history_last_modified(request, telegram_id):
+    return PortfolioSnapshot.objects.filter(
+        portfolio__user__telegramuser__telegram_id=telegram_id,
+    ).aggregate(latest=Max('taken_at'))['latest']
+
+@require_GET
+@api_auth
+@condition(etag_func=holdings_etag)
+def holdings(request, telegram_id):
+    portfolio_id, version, _ = portfolio_state(request, telegram_id)
+    rows = valued_holdings(portfolio_id).order_by('coin_id')
+    return JsonResponse({
+        'version': version,
+        'holdings': list(rows.values('coin_id', 'quantity', 'price', 'purchase_price', 'created_at')),
+        'cost': to_cents(holdings_cost(portfolio_id) or CENTS),
+    })
+
+@require_GET
+@api_auth
+@condition(etag_func=valuation_etag, last_modified_func=valuation_last_modified)
+def valuation(request, telegram_id):
+    """Holdings valued at the stored CoinPrice table, totals summed by the database."""
+    portfolio_id, _, updated = portfolio_state(request, telegram_id)
+    rows = valued_holdings(portfolio_id).order_by('coin_id')
+    coins = [
+        {
+            'coin_id': coin_id,
+            'quantity': quantity,
+            'current_price': current_price,
+            'value': None if value is None else to_cents(value),
+            'cost': None if cost is None else to_cents(cost),
+        }
+        for coin_id, quantity, current_price, value, cost in rows.values_list(
+            'coin_id', 'quantity', 'current_price', 'value', 'cost',
+        )
+    ]
+    # coins without a stored price are listed but left out of the totals
+    totals = holdings_totals(portfolio_id)
+    value, cost = totals['value'] or CENTS, totals['cost'] or CENTS
+    return JsonResponse({
+        'coins': coins,
+        'value': to_cents(value),
+        'cost': to_cents(cost),
+        'pnl': to_cents(value - cost),
+        'pnl_percent': percent(value - cost, cost),
+        'prices_updated_at': updated,
+    })
+
+@require_GET
+@api_auth
+@condition(last_modified_func=history_last_modified)
+def history(request, telegram_id):
+    portfolio = get_object_or_404(Portfolio, user__telegramuser__telegram_id=telegram_id)
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        return JsonResponse({'error': 'days must be an integer'}, status=400)
+    if not 1 <= days <= HISTORY_MAX_DAYS:
+        return JsonResponse({'error': f'days must be between 1 and {HISTORY_MAX_DAYS}'}, status=400)
+    return JsonResponse(portfolio_history(portfolio, days=days))
+
+@require_GET
+def prometheus_metrics(request):
+    # this process only: bot handler, send queue and CoinGecko series are served by the bot itself
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')